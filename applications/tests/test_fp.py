@@ -0,0 +1,798 @@
+#!/usr/bin/env -S pytest -vvv
+
+
+"""
+Unit tests for the pieces of fp (flair pressure reader) that don't need a camera.
+"""
+
+
+import random
+from pathlib import Path
+from queue import Queue
+
+import cv2
+import numpy as np
+import pytest
+
+from hq.hardware.flair_benchmark import run_benchmark, synthetic_gauge_images
+from hq.hardware.flair_calibration import DialCalibration, PressureMapping
+from hq.hardware.flair_filters import (
+    MAD_SCALE,
+    FilterChain,
+    KalmanFilter,
+    MedianFilter,
+    OutlierFilter,
+)
+from hq.hardware.flair_graph import PressureGraph
+from hq.hardware.flair_pipeline import CameraReader, get_frame, put_latest
+from hq.hardware.flair_shots import ShotRecorder, ShotStore, ShotWriter
+from hq.hardware.stage_timers import NULL_LAP, StageTimers
+from hq.hardware.flair_pressure import (
+    DIAL_X_MAX,
+    DIAL_X_MIN,
+    DIAL_Y_MAX,
+    DIAL_Y_MIN,
+    PRESSURE_FILTERS,
+    FlairPressure,
+    NeedleTracker,
+    ShotTimer,
+    equalisation_lut,
+)
+from hq.hardware.flair_replay import (
+    batched,
+    detect_dataset,
+    frame_paths,
+    image_paths,
+    read_table,
+    read_video,
+    replay_shot,
+    write_table,
+)
+from hq.hardware.vt52 import Vt52Screen
+
+
+# ---------------------------------------------------------------------------
+# Pressure graph tests
+# ---------------------------------------------------------------------------
+
+
+def _plot_rows(rendered: str, rows: int) -> list[str]:
+    """
+    Strip the Y axis labels from the plot area of a rendered graph.
+
+    Args:
+        rendered: Graph as returned by PressureGraph.render.
+        rows: Number of rows in the plot area.
+
+    Returns:
+        Plot area lines, without labels.
+    """
+    return [line[4:] for line in rendered.split("\n")[:rows]]
+
+
+def test_graph_newest_sample_on_left() -> None:
+    """
+    Each sample is plotted one column to the left of the sample before it.
+    """
+    graph = PressureGraph(rows=12, cols=10)
+    for pressure in (0, 5, 10):
+        graph.push(pressure)
+    plot = _plot_rows(graph.render(), rows=12)
+    assert [row.find("*") for row in plot if "*" in row] == [0, 1, 2]
+    assert plot[1] == "*  "
+    assert plot[6] == " * "
+    assert plot[11] == "  *"
+
+
+def test_graph_clamps_out_of_range_pressures() -> None:
+    """
+    Pressures above the top of the plot land on the top row, not the axis.
+    """
+    graph = PressureGraph(rows=12, cols=10)
+    graph.push(15.0)
+    graph.push(-1.0)
+    rendered = graph.render()
+    plot = _plot_rows(rendered, rows=12)
+    assert plot[0] == " *"
+    assert plot[11] == "* "
+    assert "*" not in "".join(rendered.split("\n")[12:])
+
+
+def test_graph_scrolls_once_full() -> None:
+    """
+    Once more samples than columns have been pushed, the oldest scroll off the right.
+    """
+    graph = PressureGraph(rows=12, cols=4)
+    for pressure in (10, 0, 0, 0, 0, 5):
+        graph.push(pressure)
+    plot = _plot_rows(graph.render(), rows=12)
+    assert all(len(row) == 4 for row in plot)
+    assert "*" not in plot[1]
+    assert plot[6] == "*   "
+
+
+def test_graph_renders_incrementally() -> None:
+    """
+    Rendering between pushes gives the same graph as rendering once at the end.
+    """
+    incremental = PressureGraph(rows=12, cols=8)
+    once = PressureGraph(rows=12, cols=8)
+    for i in range(30):
+        pressure, time = (i * 7) % 11, (i / 2 if i % 5 == 0 else None)
+        incremental.push(pressure, time)
+        once.push(pressure, time)
+        if i % 3 == 0:
+            incremental.render()
+    assert incremental.render() == once.render()
+
+
+def test_graph_time_labels_under_samples() -> None:
+    """
+    Time labels are written under the sample they were pushed with.
+    """
+    graph = PressureGraph(rows=12, cols=10)
+    graph.push(0, time=12.0)
+    for _ in range(4):
+        graph.push(0)
+    time_row = graph.render().split("\n")[-1]
+    assert time_row == "   |     12"
+
+
+# ---------------------------------------------------------------------------
+# Calibration tests
+# ---------------------------------------------------------------------------
+
+
+def test_dial_calibration_cached_by_mask(tmp_path: Path) -> None:
+    """
+    The calibration is cached on first load, and reloaded from the cache after.
+    """
+    mask = np.zeros((10, 12, 3), dtype=np.uint8)
+    mask[2:8, 3:9] = 255
+    mask_path = str(tmp_path / "mask.png")
+    cv2.imwrite(mask_path, mask)
+    geometry = dict(y_min=1, y_max=9, x_min=2, x_max=10, needle_y=5, needle_x=6)
+    cache = str(tmp_path / "cache")
+
+    built = DialCalibration.load_or_build(mask_path, cache_directory=cache, **geometry)
+    loaded = DialCalibration.load_or_build(mask_path, cache_directory=cache, **geometry)
+    assert isinstance(loaded.mask, np.memmap)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    for calibration in (built, loaded):
+        assert calibration.mask.shape == (8, 8)
+        assert list(calibration.needle_centre) == [4, 4]
+        assert (calibration.off_dial[calibration.mask == 0] == 255).all()
+        assert (calibration.off_dial[calibration.mask != 0] == 0).all()
+
+    # A different mask gets its own cache entry
+    cv2.imwrite(mask_path, 255 - mask)
+    DialCalibration.load_or_build(mask_path, cache_directory=cache, **geometry)
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+def test_pressure_mapping_matches_convert_angle() -> None:
+    """
+    Table lookups are within the table's resolution of the exact conversion, and scalar
+    and array lookups round the same way, even exactly between entries.
+    """
+    mapping = PressureMapping(zero_angle=225.0, degrees_per_bar=18.0, resolution=20)
+    alphas = np.concatenate(
+        [
+            np.random.default_rng(0).uniform(0, 359.9, 1000),
+            (np.arange(360 * 20) + 0.5) / 20,
+        ]
+    )
+    exact = np.array([FlairPressure.convert_angle(alpha) for alpha in alphas])
+
+    # Dial angles change at most twice as fast as camera angles
+    scalar = np.array([mapping.convert_angle(alpha) for alpha in alphas])
+    assert np.abs(scalar - exact).max() <= 2 * 0.5 / 20 + 1e-9
+    assert np.array_equal(mapping.convert_angles(alphas), scalar)
+    assert np.array_equal(
+        mapping.pressures(alphas), [mapping.pressure(alpha) for alpha in alphas]
+    )
+
+
+def test_pressure_mapping_rebuilds_corrupt_cache(tmp_path: Path) -> None:
+    """
+    A cached mapping that can't be loaded is rebuilt and replaced, all at once.
+    """
+    path = str(tmp_path / "mapping.npz")
+    (tmp_path / "mapping.npz").write_bytes(b"PK\x03\x04 truncated")
+    calibration = dict(zero_angle=225.0, degrees_per_bar=18.0)
+
+    mapping = PressureMapping.load_or_build(path, **calibration)
+    assert mapping.pressure(45.0) == PressureMapping(**calibration).pressure(45.0)
+    assert PressureMapping.load(path).pressure(45.0) == mapping.pressure(45.0)
+    assert [path.name for path in tmp_path.iterdir()] == ["mapping.npz"]
+
+
+# ---------------------------------------------------------------------------
+# Needle tracker tests
+# ---------------------------------------------------------------------------
+
+
+def _dial_image(direction: float) -> np.ndarray:
+    """
+    Synthetic dial crop with a dark needle pointing out from the spindle.
+
+    Args:
+        direction: Direction of needle (degrees), anticlockwise from the right.
+
+    Returns:
+        Dial crop as (92, 192) array, spindle at row 46, column 104.
+    """
+    dial = np.full((92, 192), 200, dtype=np.uint8)
+    dial[::2, ::3] = 230  # Some texture, so equalisation has something to spread
+    end = (
+        round(104 + 80 * np.cos(np.radians(direction))),
+        round(46 - 80 * np.sin(np.radians(direction))),
+    )
+    cv2.line(dial, (104, 46), end, 20, 8)
+    return dial
+
+
+def _tracker() -> NeedleTracker:
+    """
+    Tracker for synthetic dials, with all but the spindle hub on the dial.
+    """
+    off_dial = np.zeros((92, 192), dtype=np.uint8)
+    cv2.circle(off_dial, (104, 46), 15, 255, -1)
+    return NeedleTracker(off_dial=off_dial, needle_centre=np.array((46, 104)))
+
+
+def test_tracker_window_matches_full_search() -> None:
+    """
+    While the needle moves slowly, windowed searches find the angle a full search does.
+    """
+    tracker = _tracker()
+    for direction in np.arange(30, 60, 0.5):
+        dial = _dial_image(direction)
+        assert tracker.track(dial) == pytest.approx(_tracker().track(dial), abs=0.1)
+    assert tracker.num_full_searches == 1
+
+
+def test_equalisation_lut_matches_opencv() -> None:
+    """
+    The lookup table equalises images exactly as OpenCV does, including flat images.
+    """
+    rng = np.random.default_rng(5)
+    images = [_dial_image(40), np.full((5, 7), 90, np.uint8)]
+    images += [rng.integers(20, 60, (30, 40), dtype=np.uint8) for _ in range(20)]
+    for image in images:
+        lut = equalisation_lut(image)
+        assert np.array_equal(cv2.LUT(image, lut), cv2.equalizeHist(image))
+
+
+def test_tracker_falls_back_to_full_search() -> None:
+    """
+    When the needle jumps out of the window, or disappears, the whole dial is searched.
+    """
+    tracker = _tracker()
+    tracker.track(_dial_image(30))
+    jumped = _dial_image(120)
+    assert tracker.track(jumped) == pytest.approx(_tracker().track(jumped), abs=0.1)
+    assert tracker.num_full_searches == 2
+
+    blank = np.full((92, 192), 200, dtype=np.uint8)
+    assert tracker.track(blank) is None
+    assert tracker.direction is None
+    tracker.track(jumped)
+    assert tracker.num_full_searches == 4
+
+
+# ---------------------------------------------------------------------------
+# Pipeline tests
+# ---------------------------------------------------------------------------
+
+
+def test_put_latest_returns_dropped_items() -> None:
+    """
+    Items displaced from a full queue are handed back, so their buffers can be reused.
+    """
+    queue = Queue(maxsize=1)
+    assert put_latest(queue, "a") == []
+    assert put_latest(queue, "b") == ["a"]
+    assert queue.get_nowait() == "b"
+
+
+def test_camera_reader_gives_up_on_dead_camera() -> None:
+    """
+    A camera that never returns frames stops the reader, and waiting for one raises.
+    """
+    frames = Queue(maxsize=1)
+    captures = []
+    camera = CameraReader(
+        capture_frame=lambda: captures.append(None), frames=frames, max_failures=3
+    )
+    camera.start()
+    with pytest.raises(RuntimeError) as raised:
+        get_frame(frames, camera)
+    assert len(captures) == 3
+    assert "no frame 3 times" in str(raised.value.__cause__)
+
+
+def test_stage_timers_rolling_percentiles() -> None:
+    """
+    Percentiles only cover the latest window of durations, per stage.
+    """
+    timers = StageTimers(enabled=True, window=100)
+    for _ in range(100):
+        timers.record("capture", 1.0)
+    for i in range(100):
+        timers.record("capture", i / 1000)
+        timers.record("render", 0.002)
+    summary = timers.summary()
+    assert list(summary) == ["capture", "render"]
+    assert summary["capture"]["count"] == 200
+    assert round(summary["capture"]["p50_ms"], 1) == 49.5
+    assert round(summary["capture"]["p99_ms"], 2) == 98.01
+    assert summary["render"]["p95_ms"] == 2.0
+
+
+def test_stage_timers_disabled_record_nothing() -> None:
+    """
+    Disabled timers hand out no-op laps and leave functions unwrapped.
+    """
+    timers = StageTimers(enabled=False)
+    assert timers.lap() is NULL_LAP
+    assert timers.timed("render", print) is print
+    timers.lap().mark("capture")
+    assert timers.summary() == {}
+
+
+# ---------------------------------------------------------------------------
+# Detector benchmark tests
+# ---------------------------------------------------------------------------
+
+
+def _pressure_monitor() -> FlairPressure:
+    """
+    Pressure monitor using the shipped dial mask, without caching its calibration.
+    """
+    mask_path = Path(__file__).parents[2] / "etc" / "flair_pressure" / "dial_mask.png"
+    pressure_monitor = FlairPressure(mask_path=str(mask_path), cache=False)
+    pressure_monitor.debug_mode = False
+    return pressure_monitor
+
+
+def test_detector_reports_missing_needle() -> None:
+    """
+    A dial with no needle on it reads as missing, rather than as a pressure.
+    """
+    blank = np.full((DIAL_Y_MAX - DIAL_Y_MIN, DIAL_X_MAX - DIAL_X_MIN), 200, np.uint8)
+    assert _pressure_monitor().detect_dial_needle_position(blank) is None
+
+
+def test_batch_detection_matches_per_frame() -> None:
+    """
+    Detecting a stack of dials reads each as the per-frame detector does, NaN if blank.
+    """
+    pressure_monitor = _pressure_monitor()
+    blank = np.full((DIAL_Y_MAX - DIAL_Y_MIN, DIAL_X_MAX - DIAL_X_MIN), 200, np.uint8)
+    dials = [_dial_image(direction) for direction in np.arange(-180, 180, 7.5)]
+    dials[::5] = [blank] * len(dials[::5])
+    expected = [pressure_monitor.detect_dial_needle_position(dial) for dial in dials]
+    pressures = pressure_monitor.detect_dial_needle_positions(np.stack(dials))
+    assert np.isnan(pressures[::5]).all()
+    assert not np.isnan(pressures).all()
+    np.testing.assert_array_equal(
+        pressures, [np.nan if pressure is None else pressure for pressure in expected]
+    )
+
+
+def test_benchmark_runs_headless() -> None:
+    """
+    Every detector reads synthetic gauge images to within a bar or so of the truth, and
+    OpenCV's settings are left as they were.
+    """
+    mask_path = Path(__file__).parents[2] / "etc" / "flair_pressure" / "dial_mask.png"
+    settings = cv2.getNumThreads(), cv2.useOptimized()
+    results = run_benchmark(
+        num_frames=20,
+        repeats=1,
+        mask_path=str(mask_path),
+        num_threads=settings[0] + 1,
+        optimized=not settings[1],
+    )
+    assert (cv2.getNumThreads(), cv2.useOptimized()) == settings
+    assert list(results) == ["frame", "dial_crop", "tracked"]
+    for result in results.values():
+        assert result["frames_per_second"] > 0
+        assert result["missed_frames"] == 0
+        assert result["mean_error"] < 0.5
+        assert result["max_error"] < 2.0
+        assert result["peak_bytes_per_frame"] > 0
+
+
+# ---------------------------------------------------------------------------
+# Replay tests
+# ---------------------------------------------------------------------------
+
+
+def _recorded_shot(directory: Path, num_frames: int) -> np.ndarray:
+    """
+    Write synthetic gauge frames as a recorded shot, with other files alongside.
+
+    Args:
+        directory: Directory to write frames to, named by frame number.
+        num_frames: Number of frames.
+
+    Returns:
+        Frames as (N, H, W, 3) array.
+    """
+    imgs, _ = synthetic_gauge_images(num_frames=num_frames, seed=1)
+    for i, img in enumerate(imgs):
+        cv2.imwrite(str(directory / f"{i}.png"), img)
+    for name in ("labels.csv", "notes.txt", "thumbnail.png", "1.png.bak"):
+        (directory / name).write_text("not a frame")
+    return imgs
+
+
+def test_frame_paths_orders_numbered_frames_only(tmp_path: Path) -> None:
+    """
+    Frames are ordered by number, not name, and other files are ignored.
+    """
+    for name in ("10.jpg", "9.PNG", "1.jpeg", "labels.csv", "cover.png", "2.txt"):
+        (tmp_path / name).touch()
+    paths = frame_paths(tmp_path)
+    assert [path.name for path in paths] == ["1.jpeg", "9.PNG", "10.jpg"]
+
+
+def test_replay_shot_reads_frames_in_order(tmp_path: Path) -> None:
+    """
+    Each frame is read as the live detector would, in frame order, with unreadable
+    frames dropped, and the shot timed as the live loop would time it.
+    """
+    imgs = _recorded_shot(tmp_path, num_frames=30)
+    (tmp_path / "12.png").write_bytes(b"corrupt")
+    pressure_monitor = _pressure_monitor()
+    frames, summary = replay_shot(
+        pressure_monitor=pressure_monitor, source=tmp_path, frame_period=0.1, workers=2
+    )
+
+    expected = [pressure_monitor.detect_needle_position(img) for img in imgs]
+    expected[12] = None
+    np.testing.assert_array_equal(
+        frames["raw_pressure"], [np.nan if p is None else p for p in expected]
+    )
+    assert frames["frame"].tolist() == list(range(30))
+    assert frames["time"] == pytest.approx(np.arange(30) * 0.1)
+
+    shot_timer = ShotTimer(filters=FilterChain.parse(PRESSURE_FILTERS))
+    for i, raw_pressure in enumerate(expected):
+        shot_timer.update(raw_pressure=raw_pressure, capture_time=i * 0.1)
+    assert summary["num_frames"] == 30
+    assert summary["dropped_frames"] == 1
+    assert summary["duration"] == pytest.approx(2.9)
+    assert summary["shot_duration"] > 0
+    for key in ("pre_infuse_duration", "shot_duration", "impulse", "peak_pressure"):
+        assert summary[key] == pytest.approx(getattr(shot_timer, key))
+
+
+def test_detect_dataset_keeps_order_across_workers(tmp_path: Path) -> None:
+    """
+    Images spread over worker processes in chunks read as they would one by one, in
+    order, with unreadable images NaN.
+    """
+    imgs = _recorded_shot(tmp_path, num_frames=11)
+    (tmp_path / "4.png").write_bytes(b"corrupt")
+    paths = image_paths(inputs=[tmp_path, tmp_path / "missing.png"])
+    assert len(paths) == 12
+
+    mask_path = Path(__file__).parents[2] / "etc" / "flair_pressure" / "dial_mask.png"
+    results = list(
+        detect_dataset(paths=paths, workers=2, chunk_size=5, mask_path=str(mask_path))
+    )
+    pressure_monitor = _pressure_monitor()
+    expected = [pressure_monitor.detect_needle_position(img) for img in imgs]
+    expected[4] = None
+    assert [path for path, _ in results] == paths
+    np.testing.assert_array_equal(
+        [pressure for _, pressure in results],
+        [np.nan if p is None else p for p in expected] + [np.nan],
+    )
+
+
+def test_read_video_times_frames_by_frame_rate(tmp_path: Path) -> None:
+    """
+    Frames of a video are all read, timed by its frame rate unless told otherwise.
+    """
+    imgs, _ = synthetic_gauge_images(num_frames=12)
+    video_path = tmp_path / "shot.avi"
+    writer = cv2.VideoWriter(
+        str(video_path), cv2.VideoWriter_fourcc(*"MJPG"), 20, imgs.shape[2:0:-1]
+    )
+    for img in imgs:
+        writer.write(img)
+    writer.release()
+
+    times, frames = zip(*read_video(video_path=video_path, frame_period=None))
+    assert times == pytest.approx(np.arange(12) / 20)
+    assert all(frame.shape == imgs[0].shape for frame in frames)
+    times, _ = zip(*read_video(video_path=video_path, frame_period=0.5))
+    assert times == pytest.approx(np.arange(12) * 0.5)
+
+
+def test_tables_round_trip_through_csv(tmp_path: Path) -> None:
+    """
+    Columns written to CSV read back as numbers where they can be, strings otherwise.
+    """
+    columns = {"source": ["a", "b", "c"], "pressure": [1.5, np.nan, 9.0]}
+    write_table(columns=columns, output_path=tmp_path / "shots.csv")
+    table = read_table(input_path=tmp_path / "shots.csv")
+    assert table["source"].tolist() == ["a", "b", "c"]
+    np.testing.assert_array_equal(table["pressure"], [1.5, np.nan, 9.0])
+    with pytest.raises(ValueError):
+        write_table(columns=columns, output_path=tmp_path / "shots.txt")
+
+
+def test_batched_keeps_remainder() -> None:
+    """
+    Items are split into lists of the given size, the last holding what's left.
+    """
+    assert list(batched(range(7), size=3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(batched([], size=3)) == []
+
+
+# ---------------------------------------------------------------------------
+# Pressure filter tests
+# ---------------------------------------------------------------------------
+
+
+def test_median_filter_matches_sliding_median() -> None:
+    """
+    The ring buffer median matches the median of the latest samples, however many.
+    """
+    rng = np.random.default_rng(3)
+    samples = rng.integers(0, 10, 200).astype(float)
+    median = MedianFilter(size=5)
+    for i, sample in enumerate(samples):
+        expected = np.median(samples[max(i - 4, 0) : i + 1])
+        assert median.update(sample, capture_time=i) == expected
+
+
+def test_outlier_filter_matches_sliding_hampel() -> None:
+    """
+    Samples are rejected exactly when far from the median of the latest samples.
+    """
+    rng = np.random.default_rng(4)
+    samples = np.where(rng.random(300) < 0.1, 20.0, rng.normal(5, 0.3, 300))
+    outlier = OutlierFilter(size=6, threshold=3.0, min_deviation=0.5)
+    for i, sample in enumerate(samples):
+        window = samples[max(i - 5, 0) : i + 1]
+        median = np.median(window)
+        mad = np.sort(np.abs(window - median))[len(window) // 2]
+        accepted = abs(sample - median) <= max(3.0 * MAD_SCALE * mad, 0.5)
+        assert outlier.update(sample, capture_time=i) == (sample if accepted else None)
+
+
+def test_filter_chain_drops_missing_and_outliers() -> None:
+    """
+    Missing readings and spikes are dropped without upsetting later filters, while a
+    genuine step gets through once it fills half the outlier window.
+    """
+    chain = FilterChain.parse("outlier:5, ewma:0.5")
+    outputs = [
+        chain.update(value, capture_time=i)
+        for i, value in enumerate([1.0, 1.0, 1.0, None, float("nan"), 9.0, 1.0])
+    ]
+    assert outputs == [0.5, 0.75, 0.875, None, None, None, 0.9375]
+
+    # The earlier spike is still in the window, so the step counts from it
+    steps = [chain.update(9.0, capture_time=i) for i in range(3)]
+    assert steps[0] is None
+    assert 0.9375 < steps[1] < steps[2] < 9.0
+    assert FilterChain.parse("").update(2.0, capture_time=0) == 2.0
+
+
+def test_kalman_filter_predicts_across_dropped_frames() -> None:
+    """
+    A pressure ramp is tracked, and extrapolated over a gap in readings.
+    """
+    kalman = KalmanFilter()
+    for i in range(100):
+        kalman.update(i * 0.1, capture_time=i * 0.1)
+    assert abs(kalman.rate - 1.0) < 0.01
+    assert abs(kalman.update(15.0, capture_time=15.0) - 15.0) < 0.05
+
+
+def test_filter_chain_rejects_unknown_filters() -> None:
+    """
+    Specs naming filters that don't exist are refused.
+    """
+    with pytest.raises(ValueError, match="Unknown filter"):
+        FilterChain.parse("ewma,lowpass:3")
+
+
+# ---------------------------------------------------------------------------
+# Shot history tests
+# ---------------------------------------------------------------------------
+
+
+def _shot(started_at: float, recipe: str, grind: float, impulse: float) -> dict:
+    """
+    Shot summary with made up durations.
+    """
+    return {
+        "started_at": started_at,
+        "recipe": recipe,
+        "grind": grind,
+        "pre_infuse_duration": grind / 2,
+        "shot_duration": 30.0,
+        "impulse": impulse,
+        "peak_pressure": 9.0,
+    }
+
+
+def test_shot_store_queries(tmp_path: Path) -> None:
+    """
+    Shots written in the background can be queried by time, recipe and grind.
+    """
+    path = str(tmp_path / "shots.db")
+    writer = ShotWriter(path=path)
+    writer.start()
+    writer.submit(_shot(100.0, "ristretto", 10, 150.0), np.arange(3), np.ones(3))
+    writer.submit(_shot(200.0, "ristretto", 12, 120.0), np.arange(2), np.ones(2))
+    writer.submit(_shot(300.0, "lungo", 12, 200.0), np.arange(4), np.full(4, 2.5))
+    writer.close()
+    assert not writer.is_alive()
+
+    store = ShotStore(path=path)
+    assert [shot["impulse"] for shot in store.best_shots()] == [200.0, 150.0, 120.0]
+    assert [shot["id"] for shot in store.best_shots(since=150.0, limit=1)] == [3]
+    assert [shot["id"] for shot in store.best_shots(recipe="ristretto")] == [1, 2]
+    stats = store.grind_stats(since=150.0)
+    assert [(row["grind"], row["num_shots"]) for row in stats] == [(12, 2)]
+    assert stats[0]["pre_infuse_duration"] == 6.0
+    times, pressures = store.trace(3)
+    assert list(times) == [0, 1, 2, 3]
+    assert list(pressures) == [2.5] * 4
+    store.close()
+
+
+def test_shot_recorder_saves_shot_once(tmp_path: Path) -> None:
+    """
+    A shot is saved when pressure drops after extraction, and not again on exit.
+    """
+    path = str(tmp_path / "shots.db")
+    writer = ShotWriter(path=path)
+    writer.start()
+    timer = ShotTimer()
+    recorder = ShotRecorder(
+        writer=writer, shot_timer=timer, start=1000.0, recipe="espresso", grind=11
+    )
+    readings = [0.0] * 10 + [2.0] * 20 + [9.0] * 100 + [0.0] * 50
+    for i, reading in enumerate(readings):
+        capture_time = i * 0.1
+        pressure = timer.update(raw_pressure=reading, capture_time=capture_time)
+        recorder.update(pressure=pressure, capture_time=capture_time)
+    recorder.finish()
+    writer.close()
+
+    store = ShotStore(path=path)
+    (shot,) = store.best_shots()
+    assert 1001.0 < shot["started_at"] < 1001.2
+    assert (shot["recipe"], shot["grind"]) == ("espresso", 11)
+    assert shot["impulse"] < timer.impulse
+    times, pressures = store.trace(shot["id"])
+    assert times[0] == 0
+    assert pressures[-1] < 0.5 < pressures.max()
+    store.close()
+
+
+# ---------------------------------------------------------------------------
+# VT52 screen tests
+# ---------------------------------------------------------------------------
+
+
+def _emulate_vt52(screen: list[list[str]], data: bytes) -> None:
+    """
+    Apply output to a model VT52 screen, supporting only the sequences Vt52Screen uses.
+
+    Args:
+        screen: Screen contents as rows of characters, modified in place.
+        data: Bytes sent to the terminal.
+    """
+    row = col = 0
+    i = 0
+    while i < len(data):
+        if data[i] == 0x1B:
+            command = chr(data[i + 1])
+            if command == "H":
+                row = col = 0
+            elif command == "J":
+                for r in range(row, len(screen)):
+                    start = col if r == row else 0
+                    screen[r][start:] = [" "] * (len(screen[r]) - start)
+            elif command == "K":
+                screen[row][col:] = [" "] * (len(screen[row]) - col)
+            elif command == "Y":
+                row, col = data[i + 2] - 32, data[i + 3] - 32
+                i += 2
+            i += 2
+        else:
+            screen[row][col] = chr(data[i])
+            col = min(col + 1, len(screen[row]) - 1)
+            i += 1
+
+
+def _expected(lines: list[str], rows: int, cols: int) -> list[list[str]]:
+    """
+    What a screen should show after drawing the given lines.
+    """
+    padded = [line[:cols].ljust(cols) for line in lines[:rows]]
+    padded += [" " * cols] * (rows - len(padded))
+    return [list(line) for line in padded]
+
+
+def test_vt52_first_frame_clears_screen() -> None:
+    """
+    The first frame clears whatever was on the screen before drawing.
+    """
+    screen = Vt52Screen(rows=4, cols=10)
+    terminal = [list("garbage!!!") for _ in range(4)]
+    _emulate_vt52(terminal, screen.frame(["hello", "", "world"]))
+    assert terminal == _expected(["hello", "", "world"], rows=4, cols=10)
+
+
+def test_vt52_diffs_reproduce_frames() -> None:
+    """
+    Applying each frame's diff to the terminal always leaves it showing that frame.
+    """
+    rng = random.Random(7)
+    screen = Vt52Screen(rows=6, cols=20)
+    terminal = [[" "] * 20 for _ in range(6)]
+    lines = [""] * 6
+    for _ in range(200):
+        row = rng.randrange(6)
+        chars = list(lines[row].ljust(rng.randrange(25)))
+        for _ in range(rng.randrange(4)):
+            if chars:
+                chars[rng.randrange(len(chars))] = rng.choice("ab* ")
+        lines[row] = "".join(chars).rstrip() if rng.random() < 0.5 else "".join(chars)
+        _emulate_vt52(terminal, screen.frame(lines))
+        assert terminal == _expected(lines, rows=6, cols=20)
+
+
+def test_vt52_unchanged_frame_sends_nothing() -> None:
+    """
+    Redrawing the same lines sends no bytes, and small changes send few.
+    """
+    screen = Vt52Screen()
+    lines = ["Time: 1.00 seconds", "Pressure: 9.00 bar"]
+    screen.frame(lines)
+    assert screen.frame(lines) == b""
+    assert screen.frame(["Time: 1.25 seconds", lines[1]]) == b"\x1bY (25"
+
+
+# ---------------------------------------------------------------------------
+# Shot timer tests
+# ---------------------------------------------------------------------------
+
+
+def test_shot_timer_times_pre_infuse_and_shot() -> None:
+    """
+    Pre-infusion starts past the pre-infuse threshold, and the shot past the shot one.
+    """
+    timer = ShotTimer()
+    readings = [0.0] * 10 + [2.0] * 40 + [9.0] * 100
+    for i, reading in enumerate(readings):
+        timer.update(raw_pressure=reading, capture_time=i * 0.1)
+    assert 1.0 < timer.pre_infuse_start < 1.2
+    assert 5.0 < timer.shot_start < 5.5
+    assert timer.pre_infuse_duration == timer.shot_start - timer.pre_infuse_start
+    assert timer.shot_duration == 14.9 - timer.shot_start
+    assert "Impulse" in timer.status(capture_time=14.9)
+
+
+def test_shot_timer_skips_dropped_frames() -> None:
+    """
+    Readings of None are skipped without changing the shot state.
+    """
+    timer = ShotTimer()
+    assert timer.update(raw_pressure=2.0, capture_time=0.0) == 0.4
+    assert timer.update(raw_pressure=None, capture_time=0.1) is None
+    assert timer.pressure == 0.4
+    assert not timer.extracting
+    assert "Impulse" not in timer.status(capture_time=0.1)
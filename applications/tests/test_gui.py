@@ -0,0 +1,179 @@
+#!/usr/bin/env -S pytest -vvv
+
+
+"""
+Unit tests for the image viewer's tile pyramid and annotations.
+"""
+
+
+import random
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from hq.gui.annotations import Annotations
+from hq.gui.tile_pyramid import TilePyramid
+
+
+# ---------------------------------------------------------------------------
+# Tile pyramid tests
+# ---------------------------------------------------------------------------
+
+
+def _gradient_image(height: int, width: int) -> np.ndarray:
+    """
+    Smooth RGB test image, which downsamples predictably.
+    """
+    rows, cols = np.mgrid[0:height, 0:width]
+    diagonal = (rows + cols) * 127 // (height + width)
+    return np.stack(
+        [cols * 255 // width, rows * 255 // height, diagonal], axis=-1
+    ).astype(np.uint8)
+
+
+def test_tile_pyramid_renders_only_visible_tiles() -> None:
+    """
+    Full resolution views are exact crops, and coarser views build only what they show.
+    """
+    img = _gradient_image(1000, 1500)
+    pyramid = TilePyramid(img, tile_size=128)
+    assert pyramid.num_levels == 5
+
+    view = pyramid.render(zoom=1.0, image_pos=(-300, -200), size=(320, 240))
+    assert np.array_equal(view, img[200:440, 300:620])
+    assert pyramid.num_built == 0
+
+    # Part of the image off the top left of the view, the rest beyond the image
+    view = pyramid.render(zoom=0.25, image_pos=(-100, -50), size=(400, 300))
+    assert np.array_equal(view[-1, -1], [255, 255, 255])
+    expected = cv2.resize(img, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+    difference = view[:150, :250].astype(int) - expected[50:200, 100:350]
+    assert np.abs(difference).max() <= 2
+    built = pyramid.num_built
+    pyramid.render(zoom=0.25, image_pos=(-100, -50), size=(400, 300))
+    assert pyramid.num_built == built
+
+    # Corner of half resolution level, of 4x6 tiles, needs only the 2x2 in view
+    pyramid = TilePyramid(img, tile_size=128)
+    pyramid.render(zoom=0.5, image_pos=(0, 0), size=(200, 150))
+    assert pyramid.num_built == 4
+
+
+def test_tile_pyramid_keeps_detail_between_levels() -> None:
+    """
+    Views between levels match a direct resize, rather than a coarser level enlarged.
+    """
+    rng = np.random.default_rng(0)
+    for img in (_gradient_image(1000, 1500), rng.integers(0, 256, (1000, 1500, 3))):
+        img = img.astype(np.uint8)
+        for zoom in (0.9, 0.7, 0.3):
+            pyramid = TilePyramid(img, tile_size=128)
+            size = (int(1500 * zoom) - 2, int(1000 * zoom) - 2)
+            view = pyramid.render(zoom=zoom, image_pos=(0, 0), size=size)
+            expected = cv2.resize(
+                img, None, fx=zoom, fy=zoom, interpolation=cv2.INTER_AREA
+            )[: size[1], : size[0]]
+            assert view.std() > 0.9 * expected.std()
+            if zoom > 0.5:
+                assert np.abs(view.astype(int) - expected).max() <= 1
+
+
+def test_tile_pyramid_renders_background_zoomed_far_out() -> None:
+    """
+    Zoomed out until the image is under a pixel across, only the background is drawn.
+    """
+    pyramid = TilePyramid(_gradient_image(1000, 1500), tile_size=128)
+    background = (9, 9, 9)
+    view = pyramid.render(1e-4, (0, 0), (80, 60), background=background)
+    assert view.shape == (60, 80, 3) and (view == 9).all()
+
+    drawn = (pyramid.render(0.01, (0, 0), (80, 60), background=background) != 9).any(2)
+    assert drawn[:10, :15].all() and not drawn[10:].any() and not drawn[:, 15:].any()
+
+
+def test_tile_pyramid_evicts_least_recently_used() -> None:
+    """
+    Built tiles stay within the cache budget, evicting the least recently used first.
+    """
+    tile_bytes = 64 * 64 * 3
+    pyramid = TilePyramid(
+        _gradient_image(512, 512), tile_size=64, cache_bytes=4 * tile_bytes
+    )
+    first = pyramid.tile(1, 0, 0)
+    for col in range(1, 4):
+        pyramid.tile(1, 0, col)
+    assert pyramid.tile(1, 0, 0) is first
+    pyramid.tile(1, 1, 0)
+    assert pyramid.cached_bytes <= pyramid.cache_bytes
+    assert (1, 0, 1) not in pyramid.tiles and (1, 0, 0) in pyramid.tiles
+
+
+# ---------------------------------------------------------------------------
+# Annotation tests
+# ---------------------------------------------------------------------------
+
+
+def test_annotations_pick_nearest_vertex_from_grid() -> None:
+    """
+    Picking through the spatial index agrees with checking every vertex.
+    """
+    rng = random.Random(0)
+    annotations = Annotations(vertex_radius=10, cell_size=32)
+    for _ in range(2000):
+        annotations.add((rng.uniform(0, 1000), rng.uniform(0, 1000)))
+    annotations.remove(5)
+    annotations.move(6, (-50.0, 2000.0))
+
+    for _ in range(500):
+        x, y = rng.uniform(-60, 1000), rng.uniform(0, 2010)
+        distances = {
+            vertex_id: np.hypot(vx - x, vy - y)
+            for vertex_id, (vx, vy) in annotations.vertices.items()
+        }
+        nearest = min(distances, key=distances.get)
+        expected = nearest if distances[nearest] <= 10 else None
+        assert annotations.vertex_at((x, y)) == expected
+
+    visible = annotations.vertices_in((100, 200, 300, 400))
+    assert visible == sorted(
+        vertex_id
+        for vertex_id, (x, y) in annotations.vertices.items()
+        if 90 <= x <= 310 and 190 <= y <= 410
+    )
+
+
+def test_annotations_undo_redo_and_resume(tmp_path: Path) -> None:
+    """
+    A drag is undone in one step, and a saved session resumes with its history.
+    """
+    annotations = Annotations(vertex_radius=10)
+    first = annotations.add((10, 10))
+    second = annotations.add((100, 100))
+    for step in range(1, 6):
+        annotations.move(second, (100 + step, 100), merge=step > 1)
+    annotations.remove(first)
+    assert len(annotations.undo_log) == 4
+
+    annotations.undo()
+    annotations.undo()
+    assert annotations.vertices == {first: (10, 10), second: (100, 100)}
+    assert annotations.vertex_at((103, 100)) == second
+    annotations.redo()
+    assert annotations.vertex_at((103, 100)) == second
+    assert annotations.vertex_at((94, 100)) is None
+
+    path = tmp_path / "plan.regions.json"
+    annotations.save(path)
+    resumed = Annotations(vertex_radius=10)
+    resumed.load(path)
+    assert resumed.vertices == annotations.vertices
+    assert resumed.vertex_at((105, 100)) == second
+    assert resumed.redo().vertex_id == first and first not in resumed.vertices
+    resumed.undo()
+    resumed.undo()
+    assert resumed.vertices[second] == (100, 100)
+
+    # New vertices don't reuse the IDs of removed ones
+    assert resumed.add((0, 0)) == 2
+    assert resumed.redo() is None
@@ -0,0 +1,299 @@
+#!/usr/bin/env -S pytest -vvv
+
+
+"""
+Unit tests for training and labelling the flair pressure regression model.
+"""
+
+
+import pickle
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from hq.ml.flair_regression.tensor_cache import TensorCache
+
+
+# ---------------------------------------------------------------------------
+# Regression dataset tests
+# ---------------------------------------------------------------------------
+
+
+def _labelled_images(directory: Path, num_images: int) -> list[str]:
+    """
+    Write uniformly grey images a dial crop can be taken from, labelled 1.5 bar apart.
+
+    Args:
+        directory: Directory to write images to.
+        num_images: Number of images.
+
+    Returns:
+        Labels CSV lines.
+    """
+    lines = []
+    for i in range(num_images):
+        img = np.full((320, 420, 3), i * 50, dtype=np.uint8)
+        img[..., 2] = 255  # Blue, as PIL sees it, which the dial crop should drop
+        path = directory / f"{i}.png"
+        cv2.imwrite(str(path), img[..., ::-1])
+        lines.append(f"{path},{i * 1.5}\n")
+    return lines
+
+
+def test_tensor_cache_decodes_once(tmp_path: Path) -> None:
+    """
+    Labelled images are decoded into a memory-mapped cache, rebuilt when labels change.
+    """
+    csv_path = tmp_path / "labels.csv"
+    lines = _labelled_images(tmp_path, num_images=3)
+    csv_path.write_text("".join(lines))
+    cache_directory = str(tmp_path / "cache")
+
+    built = TensorCache.load_or_build(str(csv_path), True, cache_directory)
+    loaded = TensorCache.load_or_build(str(csv_path), True, cache_directory)
+    assert isinstance(loaded.images, np.memmap)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    for cache in (built, loaded):
+        assert cache.images.shape == (3, 1, 92, 192)
+        assert list(cache.images[:, 0, 0, 0]) == [0, 50, 100]
+        assert list(cache.labels) == [0.0, 1.5, 3.0]
+
+    csv_path.write_text("".join(lines[:2]))
+    assert len(TensorCache.load_or_build(str(csv_path), True, cache_directory)) == 2
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+def test_csv_dataset_loads_in_workers(tmp_path: Path) -> None:
+    """
+    Worker processes are sent only where the cache is, and load every example once.
+    """
+    pytest.importorskip("torch")
+    from hq.ml.flair_regression.train_regression import CsvDataset, data_loader
+
+    csv_path = tmp_path / "labels.csv"
+    csv_path.write_text("".join(_labelled_images(tmp_path, num_images=5)))
+    dataset = CsvDataset(str(csv_path), crop_dial=True, cache_directory=str(tmp_path))
+    assert dataset[4][0].shape == (1, 92, 192)
+    assert len(pickle.dumps(dataset)) < 1000
+
+    loader = data_loader(dataset, batch_size=2, num_workers=1, pin_memory=False)
+    for _ in range(2):
+        labels = sorted(float(label) for _, batch in loader for label in batch)
+        assert labels == pytest.approx([0.0, 0.15, 0.3, 0.45, 0.6])
+
+
+# ---------------------------------------------------------------------------
+# Labelling tests
+# ---------------------------------------------------------------------------
+
+
+def test_labelling_resumes_and_prefetches_in_order(tmp_path: Path) -> None:
+    """
+    Labelled images are skipped, and the rest prefetched in frame order with estimates.
+    """
+    from hq.ml.flair_regression.label_regression import (
+        ImagePrefetcher,
+        LabelAppender,
+        unlabelled_images,
+    )
+
+    images = tmp_path / "images"
+    images.mkdir()
+    for frame in (10, 2, 1):
+        cv2.imwrite(str(images / f"{frame}.png"), np.full((4, 4, 3), frame, np.uint8))
+    labels_path = images / "labels.csv"  # Alongside the images, as labelling leaves it
+    labels_path.write_text(f"{images / '1.png'},1.5")  # Unterminated, as if crashed
+
+    paths = unlabelled_images(input_dir=images, labels_path=labels_path)
+    assert [path.name for path in paths] == ["2.png", "10.png"]
+
+    prefetcher = ImagePrefetcher(
+        paths=paths, estimate=lambda img: float(img[0, 0, 0]), num_prefetch=1
+    )
+    prefetcher.start()
+    appender = LabelAppender(path=labels_path)
+    for img_path, _, estimate in prefetcher:
+        appender.append(img_path=img_path, pressure=estimate / 2)
+    prefetcher.stop()
+    appender.close()
+
+    assert unlabelled_images(input_dir=images, labels_path=labels_path) == []
+    assert labels_path.read_text().splitlines()[1:] == [
+        f"{images / '2.png'},1.0",
+        f"{images / '10.png'},5.0",
+    ]
+
+
+def test_labelling_prefetch_survives_failing_estimates(tmp_path: Path) -> None:
+    """
+    Images the estimator fails on are still prefetched, and the end is still marked.
+    """
+    from hq.ml.flair_regression.label_regression import ImagePrefetcher
+
+    paths = []
+    for frame in range(3):
+        paths.append(tmp_path / f"{frame}.png")
+        cv2.imwrite(str(paths[-1]), np.full((4, 4, 3), frame, np.uint8))
+
+    def estimate(img: np.ndarray) -> float:
+        if img[0, 0, 0] == 1:
+            raise ValueError("No needle")
+        return float(img[0, 0, 0])
+
+    prefetcher = ImagePrefetcher(paths=paths, estimate=estimate, num_prefetch=1)
+    prefetcher.start()
+    estimates = [estimate for _, _, estimate in prefetcher]
+    prefetcher.stop()
+    assert estimates == [0.0, None, 2.0]
+
+
+# ---------------------------------------------------------------------------
+# Training and export tests
+# ---------------------------------------------------------------------------
+
+
+def _train_linear(
+    checkpoint_directory: Path, interrupt_after: int = 0
+) -> tuple[list[float], list[dict]]:
+    """
+    Fit a linear model for 2 epochs of 5 batches, checkpointing after every batch.
+
+    Args:
+        checkpoint_directory: Directory to checkpoint to and resume from.
+        interrupt_after: Raise KeyboardInterrupt after this many batches, if non-zero.
+
+    Returns:
+        Weights of the trained model, and stats of each epoch.
+    """
+    import torch
+    from hq.ml.training import ResumableSampler, Trainer
+
+    inputs = torch.linspace(-1, 1, 20)[:, None]
+    dataset = torch.utils.data.TensorDataset(inputs, 3 * inputs + 1)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=4, sampler=ResumableSampler(len(dataset))
+    )
+    torch.manual_seed(0)
+    model = torch.nn.Linear(1, 1)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    num_batches = 0
+
+    def loss_function(output: "torch.Tensor", target: "torch.Tensor") -> "torch.Tensor":
+        nonlocal num_batches
+        num_batches += 1
+        if num_batches == interrupt_after:
+            raise KeyboardInterrupt
+        return torch.nn.functional.mse_loss(output, target)
+
+    trainer = Trainer(
+        model=model,
+        optimizer=optimizer,
+        loss_function=loss_function,
+        device=torch.device("cpu"),
+        scheduler=torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=0.5),
+        checkpoint_directory=str(checkpoint_directory),
+        checkpoint_interval=0.0,
+    )
+    history = trainer.fit(loader, num_epochs=2)
+    return [model.weight.item(), model.bias.item()], history
+
+
+def test_trainer_resumes_part_way_through_epoch(tmp_path: Path) -> None:
+    """
+    A run interrupted mid-epoch resumes from its checkpoint to the same weights.
+    """
+    pytest.importorskip("torch")
+
+    weights, history = _train_linear(tmp_path / "uninterrupted")
+    assert [stats["samples"] for stats in history] == [20, 20]
+    assert history[1]["samples_per_second"] > 0 and history[1]["peak_memory"] > 0
+
+    with pytest.raises(KeyboardInterrupt):
+        _train_linear(tmp_path / "interrupted", interrupt_after=8)
+    assert len(list((tmp_path / "interrupted").glob("checkpoint-*.pt"))) == 3
+    resumed_weights, resumed_history = _train_linear(tmp_path / "interrupted")
+    assert resumed_weights == pytest.approx(weights)
+    # Resumed at batch 2 of epoch 2, having trained on batches 1-7
+    assert [stats["samples"] for stats in resumed_history] == [20, 12]
+
+
+def test_resident_memory_falls_back_to_peak_in_bytes(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Without /proc, the peak resident memory is reported in bytes on Linux and macOS.
+    """
+    pytest.importorskip("torch")
+    import resource
+
+    from hq.ml import training
+
+    def no_proc(*args, **kwargs):
+        raise OSError("No /proc")
+
+    monkeypatch.setattr(training, "open", no_proc, raising=False)
+    monkeypatch.setattr(
+        training.resource,
+        "getrusage",
+        lambda who: resource.struct_rusage((0,) * 2 + (1000,) + (0,) * 13),
+    )
+    for platform, expected in (("linux", 1024000), ("darwin", 1000)):
+        monkeypatch.setattr(training.sys, "platform", platform)
+        assert training.resident_memory() == expected
+
+
+def test_regression_nets_train_batched_in_bfloat16_channels_last() -> None:
+    """
+    Each example gets its own prediction, trained in bfloat16 with float32 weights.
+    """
+    torch = pytest.importorskip("torch")
+    from hq.ml.flair_regression.train_regression import RegressionNet
+    from hq.ml.training import Trainer
+    from hq.ml.training_benchmark import random_batch
+
+    model = RegressionNet()
+    data, target = random_batch(model_name="regression", batch_size=3)
+    with torch.no_grad():
+        batched = model.eval()(data)
+        assert batched.shape == (3,)
+        assert float(model(data[1:2])) == pytest.approx(float(batched[1]), abs=1e-5)
+
+    trainer = Trainer(
+        model=model,
+        optimizer=torch.optim.SGD(model.parameters(), lr=1e-3),
+        loss_function=torch.nn.functional.l1_loss,
+        device=torch.device("cpu"),
+        bfloat16=True,
+        channels_last=True,
+    )
+    loss = trainer.step(data, target)
+    assert loss.dtype == torch.float32 and torch.isfinite(loss)
+    assert model.conv1.weight.dtype == torch.float32
+    assert model.conv1.weight.is_contiguous(memory_format=torch.channels_last)
+
+
+def test_export_regression_saves_quantized_reader(tmp_path: Path) -> None:
+    """
+    A quantized export reloads as TorchScript, reading a finite pressure per dial crop.
+    """
+    torch = pytest.importorskip("torch")
+    from hq.ml.flair_regression.export_regression import export_regression
+    from hq.ml.flair_regression.train_regression import DialRegressionNet
+
+    state_path = tmp_path / "state.pt"
+    torch.save(DialRegressionNet().state_dict(), state_path)
+    csv_path = tmp_path / "labels.csv"
+    csv_path.write_text("".join(_labelled_images(tmp_path, num_images=4)))
+    output_path = tmp_path / "reader.pt"
+    export_regression(
+        calibration_csv=csv_path, state_path=state_path, output_path=output_path
+    )
+
+    reader = torch.jit.load(str(output_path), map_location="cpu").eval()
+    dials = torch.randint(0, 256, (3, 92, 192), dtype=torch.uint8)
+    with torch.inference_mode():
+        pressures = reader(dials)
+    assert pressures.shape == (3,)
+    assert torch.isfinite(pressures).all()
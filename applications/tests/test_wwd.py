@@ -0,0 +1,69 @@
+#!/usr/bin/env -S pytest -vvv
+
+
+"""
+Unit tests for the WWD wall segmentation dataset and inference.
+"""
+
+
+import pickle
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+
+# ---------------------------------------------------------------------------
+# WWD tests
+# ---------------------------------------------------------------------------
+
+
+def test_wwd_dataset_tiles_memory_mapped_plan(tmp_path: Path) -> None:
+    """
+    Overlapping tiles cover the whole plan, as views of the memory-mapped arrays.
+    """
+    pytest.importorskip("torch")
+    from hq.ml.wwd.wwd import WWDDataset
+
+    rng = np.random.default_rng(0)
+    rgb = rng.integers(0, 256, (40, 50, 3), dtype=np.uint8)
+    walls = np.zeros((40, 50, 4), dtype=np.uint8)
+    walls[10:20, :, 3] = 255
+    cv2.imwrite(str(tmp_path / "plan.png"), rgb[..., ::-1])
+    cv2.imwrite(str(tmp_path / "walls.png"), walls)
+
+    dataset = WWDDataset(
+        str(tmp_path / "plan.png"),
+        str(tmp_path / "walls.png"),
+        tile_size=16,
+        overlap=4,
+        cache_directory=str(tmp_path / "cache"),
+    )
+    # Origins 0, 12, 24 down and 0, 12, 24, 34 across, the last tiles ending at the edge
+    assert len(dataset) == 12
+    assert len(pickle.dumps(dataset)) < 1000
+    rgb_tile, labels_tile = dataset[len(dataset) - 1]
+    assert rgb_tile.shape == (3, 16, 16) and labels_tile.shape == (1, 16, 16)
+    assert np.array_equal(rgb_tile.permute(1, 2, 0).numpy(), rgb[24:, 34:])
+    assert np.shares_memory(rgb_tile.numpy(), dataset.rgb)
+    assert int(labels_tile.sum()) == 0
+    assert dataset[4][1][0, :, 0].tolist() == [1] * 8 + [0] * 8
+    assert int(dataset[0][1].sum()) == 6 * 16
+
+
+def test_segment_plan_blends_tiles_seamlessly() -> None:
+    """
+    Tiles run in batches, blended and written a band at a time, reassemble the plan.
+    """
+    torch = pytest.importorskip("torch")
+    from hq.ml.wwd.segment_plan import segment_plan
+
+    class FirstChannel(torch.nn.Module):
+        def forward(self, imgs: "torch.Tensor") -> "torch.Tensor":
+            return imgs[:, :1]
+
+    rgb = np.random.default_rng(0).integers(0, 256, (150, 101, 3), dtype=np.uint8)
+    output = np.zeros(rgb.shape[:2], dtype=np.uint8)
+    segment_plan(FirstChannel(), rgb, output, tile_size=32, overlap=8, batch_size=2)
+    assert np.array_equal(output, rgb[..., 0])
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+
+"""
+Vertices annotated on an image, with a spatial index and an undoable operation log
+
+Vertices are bucketed into a uniform grid of cells, so picking the vertex under the
+mouse, or finding those in view, only looks at vertices in nearby cells, however many
+there are. Every change is recorded as a small operation, which can be undone and
+redone, and a session is saved as a snapshot of the vertices with its undo and redo logs
+"""
+
+
+import json
+import os
+from collections import defaultdict, deque
+from math import floor, hypot
+from pathlib import Path
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+
+# Width and height of spatial index cells (image pixels)
+GRID_CELL_SIZE = 128
+
+# Operations kept for undoing, beyond which the oldest are forgotten
+UNDO_LIMIT = 10000
+
+# Version of saved sessions, bumped when their format changes
+SESSION_VERSION = 1
+
+Point = Tuple[float, float]
+
+# Left, top, right and bottom of a box (pixels)
+Bounds = Tuple[float, float, float, float]
+
+
+class Operation(NamedTuple):
+    """
+    Change to a vertex. Applying it moves the vertex from `before` to `after`, and
+    undoing it moves it back, where None means the vertex doesn't exist
+    """
+
+    vertex_id: int
+    before: Optional[Point]
+    after: Optional[Point]
+
+
+class SpatialGrid:
+    """
+    Uniform grid of cells, each holding the items whose bounds overlap it
+    """
+
+    def __init__(self, cell_size: float = GRID_CELL_SIZE) -> None:
+        """
+        Construct an empty grid
+
+        Args:
+            cell_size: Width and height of cells
+        """
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set[int]] = defaultdict(set)
+        self.bounds: Dict[int, Bounds] = {}
+
+    def _cells(self, bounds: Bounds) -> Iterator[Tuple[int, int]]:
+        """
+        Yield the cells overlapping some bounds
+        """
+        left, top, right, bottom = (floor(side / self.cell_size) for side in bounds)
+        for row in range(top, bottom + 1):
+            for col in range(left, right + 1):
+                yield row, col
+
+    def insert(self, item: int, bounds: Bounds) -> None:
+        """
+        Add an item, or move it if already in the grid
+
+        Args:
+            item: Item
+            bounds: Bounds of item
+        """
+        if item in self.bounds:
+            self.remove(item)
+        self.bounds[item] = bounds
+        for cell in self._cells(bounds):
+            self.cells[cell].add(item)
+
+    def remove(self, item: int) -> None:
+        """
+        Remove an item
+
+        Args:
+            item: Item, which must be in the grid
+        """
+        for cell in self._cells(self.bounds.pop(item)):
+            self.cells[cell].discard(item)
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def overlapping(self, bounds: Bounds) -> Set[int]:
+        """
+        Find the items whose bounds overlap some bounds
+
+        Args:
+            bounds: Bounds to search
+
+        Returns:
+            Overlapping items
+        """
+        left, top, right, bottom = bounds
+        items = set()
+        for cell in self._cells(bounds):
+            for item in self.cells.get(cell, ()):
+                item_left, item_top, item_right, item_bottom = self.bounds[item]
+                if (
+                    item_left <= right
+                    and left <= item_right
+                    and item_top <= bottom
+                    and top <= item_bottom
+                ):
+                    items.add(item)
+        return items
+
+
+class Annotations:
+    """
+    Vertices annotated on an image, indexed by position, with undo and redo
+    """
+
+    def __init__(
+        self,
+        vertex_radius: float,
+        cell_size: float = GRID_CELL_SIZE,
+        undo_limit: int = UNDO_LIMIT,
+    ) -> None:
+        """
+        Construct empty annotations
+
+        Args:
+            vertex_radius: Distance from a vertex within which it's picked (pixels)
+            cell_size: Width and height of spatial index cells (pixels)
+            undo_limit: Operations kept for undoing
+        """
+        self.vertex_radius = vertex_radius
+        self.vertices: Dict[int, Point] = {}
+        self.index = SpatialGrid(cell_size=cell_size)
+        self.undo_log: Deque[Operation] = deque(maxlen=undo_limit)
+        self.redo_log: List[Operation] = []
+        self.next_id = 0
+
+    def _set(self, vertex_id: int, point: Optional[Point]) -> None:
+        """
+        Move a vertex, creating it if it doesn't exist and deleting it if point is None
+        """
+        if point is None:
+            del self.vertices[vertex_id]
+            self.index.remove(vertex_id)
+            return
+        x, y = self.vertices[vertex_id] = (float(point[0]), float(point[1]))
+        radius = self.vertex_radius
+        self.index.insert(vertex_id, (x - radius, y - radius, x + radius, y + radius))
+
+    def apply(self, operation: Operation) -> None:
+        """
+        Apply an operation as a new change, which can no longer be redone past
+
+        Args:
+            operation: Operation to apply
+        """
+        self._set(operation.vertex_id, operation.after)
+        self.undo_log.append(operation)
+        self.redo_log.clear()
+
+    def add(self, point: Point) -> int:
+        """
+        Add a vertex
+
+        Args:
+            point: Position of vertex
+
+        Returns:
+            ID of vertex
+        """
+        vertex_id = self.next_id
+        self.next_id += 1
+        self.apply(Operation(vertex_id=vertex_id, before=None, after=point))
+        return vertex_id
+
+    def move(self, vertex_id: int, point: Point, merge: bool = False) -> None:
+        """
+        Move a vertex
+
+        Args:
+            vertex_id: ID of vertex
+            point: New position of vertex
+            merge: Merge with the last operation if it moved the same vertex too, so a
+                drag is undone in one go
+        """
+        before = self.vertices[vertex_id]
+        last = self.undo_log[-1] if self.undo_log else None
+        if (
+            merge
+            and last is not None
+            and last.vertex_id == vertex_id
+            and last.before is not None
+        ):
+            before = self.undo_log.pop().before
+        self.apply(Operation(vertex_id=vertex_id, before=before, after=point))
+
+    def remove(self, vertex_id: int) -> None:
+        """
+        Remove a vertex
+
+        Args:
+            vertex_id: ID of vertex
+        """
+        self.apply(
+            Operation(vertex_id=vertex_id, before=self.vertices[vertex_id], after=None)
+        )
+
+    def undo(self) -> Optional[Operation]:
+        """
+        Undo the last operation
+
+        Returns:
+            Operation undone, None if there was nothing to undo
+        """
+        if not self.undo_log:
+            return None
+        operation = self.undo_log.pop()
+        self._set(operation.vertex_id, operation.before)
+        self.redo_log.append(operation)
+        return operation
+
+    def redo(self) -> Optional[Operation]:
+        """
+        Redo the last operation undone
+
+        Returns:
+            Operation redone, None if there was nothing to redo
+        """
+        if not self.redo_log:
+            return None
+        operation = self.redo_log.pop()
+        self._set(operation.vertex_id, operation.after)
+        self.undo_log.append(operation)
+        return operation
+
+    def vertex_at(self, point: Point) -> Optional[int]:
+        """
+        Pick the vertex nearest a point, within the vertex radius
+
+        Args:
+            point: Position to pick at, usually the mouse
+
+        Returns:
+            ID of vertex, None if none are close enough
+        """
+        x, y = point
+        distances = {
+            vertex_id: hypot(
+                self.vertices[vertex_id][0] - x, self.vertices[vertex_id][1] - y
+            )
+            for vertex_id in self.index.overlapping((x, y, x, y))
+        }
+        vertex_id = min(distances, key=distances.get, default=None)
+        if vertex_id is None or distances[vertex_id] > self.vertex_radius:
+            return None
+        return vertex_id
+
+    def vertices_in(self, bounds: Bounds) -> List[int]:
+        """
+        Find the vertices whose markers overlap a box
+
+        Args:
+            bounds: Box to search, usually the part of the image in view
+
+        Returns:
+            IDs of vertices, in the order they were added
+        """
+        return sorted(self.index.overlapping(bounds))
+
+    def snapshot(self) -> dict:
+        """
+        Capture the vertices, and the undo and redo logs, as plain data
+
+        Returns:
+            Snapshot, which can be saved as JSON
+        """
+        return {
+            "version": SESSION_VERSION,
+            "next_id": self.next_id,
+            "vertices": [
+                [vertex_id, *point] for vertex_id, point in self.vertices.items()
+            ],
+            "undo": [list(operation) for operation in self.undo_log],
+            "redo": [list(operation) for operation in self.redo_log],
+        }
+
+    def restore(self, snapshot: dict) -> None:
+        """
+        Replace the vertices, and the undo and redo logs, with those of a snapshot
+
+        Args:
+            snapshot: Snapshot, as from `snapshot`
+        """
+        if snapshot.get("version") != SESSION_VERSION:
+            raise ValueError(
+                f"Session version {snapshot.get('version')} isn't {SESSION_VERSION}"
+            )
+
+        def operation(
+            vertex_id: int, before: Optional[list], after: Optional[list]
+        ) -> Operation:
+            return Operation(
+                vertex_id=vertex_id,
+                before=tuple(before) if before is not None else None,
+                after=tuple(after) if after is not None else None,
+            )
+
+        self.vertices = {}
+        self.index = SpatialGrid(cell_size=self.index.cell_size)
+        for vertex_id, x, y in snapshot["vertices"]:
+            self._set(vertex_id, (x, y))
+        self.undo_log.clear()
+        self.undo_log.extend(operation(*item) for item in snapshot["undo"])
+        self.redo_log = [operation(*item) for item in snapshot["redo"]]
+        self.next_id = snapshot["next_id"]
+
+    def save(self, path: Path) -> None:
+        """
+        Save the session to a JSON file, replacing it atomically so a crash can't
+        leave it half written
+
+        Args:
+            path: Path to save to
+        """
+        temporary_path = path.with_name(path.name + ".tmp")
+        temporary_path.write_text(json.dumps(self.snapshot(), separators=(",", ":")))
+        os.replace(temporary_path, path)
+
+    def load(self, path: Path) -> None:
+        """
+        Load a session saved with `save`
+
+        Args:
+            path: Path to load from
+        """
+        self.restore(json.loads(path.read_text()))
@@ -5,11 +5,17 @@
 Basic GUI for segmenting images into regions
 
 Original use case: Segment deck plan/points-to-plan into paint regions
+
+Left click adds a vertex, or drags the one under the cursor, right drag pans and the
+scroll wheel zooms. Delete removes the vertex under the cursor, ctrl+z undoes, ctrl+y or
+ctrl+shift+z redoes, and ctrl+s saves the session, which is also saved on quitting
 """
 
 
 from enum import Enum
+from pathlib import Path
 from typing import Optional, Callable, Tuple, List
+import numpy as np
 import typer
 from time import time
 import contextlib
@@ -19,6 +25,9 @@ with contextlib.redirect_stdout(None):
 
 from abyss.bedrock.io.convenience import easy_load
 
+from hq.gui.annotations import Annotations, Bounds, Operation
+from hq.gui.tile_pyramid import TilePyramid, load_image
+
 
 START_RESOLUTION = (1280, 720)
 BUTTON_WIDTH, BUTTON_HEIGHT = (200, 80)
@@ -26,10 +35,26 @@ VIEWPORT_EDGE_OFFSET = 20
 VIEWPORT_BUTTON_OFFSET = BUTTON_HEIGHT + VIEWPORT_EDGE_OFFSET * 2
 DEBOUNCE_TIME = 0.1
 ZOOM_STEP = 0.1
+
+# Smallest the longest side of the image may be zoomed out to (pixels)
+MIN_ZOOMED_SIZE = 16
 VERTEX_RADIUS = 25
 VERTEX_RESOLUTION = (VERTEX_RADIUS * 2,) * 2
 VERTEX_CENTRE = (VERTEX_RADIUS,) * 2
 VERTEX_COLOUR = pygame.Color(200, 20, 20, 255)
+BACKGROUND_COLOUR = (255, 255, 255)
+
+# Longest to wait for an event before checking for ctrl-c (milliseconds)
+EVENT_TIMEOUT = 500
+
+# Dirty rectangles redrawn separately in a frame, beyond which they're merged into one
+MAX_DIRTY_RECTS = 16
+
+# Suffix added to image path to save sessions to, by default
+SESSION_SUFFIX = ".regions.json"
+
+# Events after which the whole window must be redrawn
+REDRAW_EVENTS = (pygame.VIDEORESIZE, pygame.WINDOWEXPOSED, pygame.WINDOWSIZECHANGED)
 
 
 class MouseButton(Enum):
@@ -42,15 +67,21 @@ class MouseButton(Enum):
     MIDDLE = 1
 
 
-def main(image_path: str) -> int:
+def main(image_path: str, session_path: Optional[Path] = None) -> int:
     """
     Main GUI routine
 
+    \b
+    Args:
+        image_path: Path to image to segment
+        session_path: Path to save vertices and undo history to, and resume from if
+            it exists. Next to the image if not given
+
     \b
     Returns:
         Exit status, 0 on success
     """
-    SegmentRegions(image_path=image_path).main()
+    SegmentRegions(image_path=image_path, session_path=session_path).main()
 
 
 class SegmentRegions:
@@ -58,12 +89,14 @@ class SegmentRegions:
     segment-regions application
     """
 
-    def __init__(self, image_path: str) -> None:
+    def __init__(self, image_path: str, session_path: Optional[Path] = None) -> None:
         """
         Load the requested image and construct the application object
 
         Args:
             image_path: Path to image to
+            session_path: Path to save session to, and resume from if it exists. Next
+                to the image if not given
         """
         # Initialise display (window), make resizable
         self.screen = pygame.display.set_mode(START_RESOLUTION, flags=pygame.RESIZABLE)
@@ -79,12 +112,25 @@ class SegmentRegions:
         ]
         self.button_group = pygame.sprite.Group(*self.buttons)
 
-        # Load image requested by user
-        self.source_image = pygame.image.load(image_path)
+        # Load image requested by user, as a pyramid of tiles built as they're viewed
+        self.pyramid = TilePyramid(image=load_image(image_path))
         self.image_pos = pygame.Vector2(0, 0)
         self.last_mouse_pos = self.image_pos.copy()
         self.zoom = 1.0
-        self.image = pygame.transform.smoothscale_by(self.source_image, self.zoom)
+
+        # Last view rendered, and the zoom, position and size it was rendered at
+        self.view: Optional[np.ndarray] = None
+        self.view_surface: Optional[pygame.Surface] = None
+        self.view_key: Optional[tuple] = None
+
+        # Vertex marker scaled to the zoom, and the size it was scaled to
+        self.marker = vertex_marker()
+        self.marker_size = VERTEX_RESOLUTION
+
+        # Parts of the screen changed since the last frame, to be redrawn. The whole
+        # screen is drawn first
+        self.dirty_rects: List[pygame.Rect] = [self.screen.get_rect()]
+        self.screen_size = self.screen.get_size()
 
         # Do initial update to set button positions correctly
         self.button_group.update(
@@ -94,11 +140,17 @@ class SegmentRegions:
             mouse_pos=pygame.mouse.get_pos(),
         )
 
-        # Undo logic: List of operations to produce points and polygons
-        self.operations = []
-        self.undo_operations = []
-        self.vertex_group = pygame.sprite.Group()
-        self.vertex_clicked = False
+        # Vertices, in image space, with undo history, resumed from the last session
+        self.session_path = session_path or Path(image_path + SESSION_SUFFIX)
+        self.annotations = Annotations(vertex_radius=VERTEX_RADIUS)
+        if self.session_path.exists():
+            self.annotations.load(self.session_path)
+
+        # Vertex being dragged, offset from it to the mouse (in image space), and
+        # whether it has moved in this drag yet
+        self.dragged_vertex: Optional[int] = None
+        self.drag_offset = pygame.Vector2(0, 0)
+        self.drag_moved = False
 
         # Draw initial UI
         self.draw()
@@ -112,18 +164,38 @@ class SegmentRegions:
 
         pygame.event.clear()
         while True:
-            # Wait for something to happen (keypress, mouse movement, etc), but redraw
-            # periodically. This also avoids blocking ctrl-c interrupts
-            event = pygame.event.wait(timeout=500)
+            # Wait for something to happen (keypress, mouse movement, etc), but wake
+            # periodically, to avoid blocking ctrl-c interrupts
+            events = [pygame.event.wait(timeout=EVENT_TIMEOUT)]
+
+            # Take every other event queued up meanwhile, so a burst of mouse movement
+            # is handled as one update and frame, rather than one each
+            events += pygame.event.get()
 
             # Handle being closed by the OS (e.g. user clicks X button)
-            if event.type == pygame.QUIT:
+            if any(event.type == pygame.QUIT for event in events):
+                self.annotations.save(self.session_path)
                 break
 
-            # Get mouse inputs
-            scroll = event.y if event.type == pygame.MOUSEWHEEL else 0
+            # Nothing to do if nothing happened
+            if all(event.type == pygame.NOEVENT for event in events):
+                continue
+            if any(event.type in REDRAW_EVENTS for event in events):
+                self.invalidate()
+
+            # Get mouse inputs. Clicks are taken from the events as well as the mouse's
+            # current state, so a click released within the same frame isn't missed
+            scroll = sum(event.y for event in events if event.type == pygame.MOUSEWHEEL)
             mouse_pos = pygame.mouse.get_pos()
-            mouse_buttons = pygame.mouse.get_pressed()
+            mouse_buttons = list(pygame.mouse.get_pressed())
+            for event in events:
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button <= 3:
+                    mouse_buttons[event.button - 1] = True
+
+            # Handle undo, redo, etc. Every key press counts, even in the same frame
+            for event in events:
+                if event.type == pygame.KEYDOWN:
+                    self.handle_key(event=event, mouse_pos=mouse_pos)
 
             # Handle zooming and panning
             self.update_image(
@@ -140,7 +212,8 @@ class SegmentRegions:
                 mouse_pos=mouse_pos,
             )
 
-            # Draw UI
+            # Draw what's changed
+            self.invalidate_buttons()
             self.draw()
 
         pygame.quit()
@@ -157,34 +230,26 @@ class SegmentRegions:
         Args:
             mouse_buttons: Button state (pressed/unpressed) for each mouse button
             mouse_pos: Position of mouse on screen
-            scroll: Movement of scroll wheel
+            scroll: Movement of scroll wheel, in steps. Each step zooms in (+ve) or out
+                (-ve) by `ZOOM_STEP`, until the image is `MIN_ZOOMED_SIZE` across
         """
-        # Draw annotations and points
-        self.image = self.source_image.copy()
-
-        # Reset sprites and redraw (for undo)
-        # self.vertex_group = pygame.sprite.Group()
-        # for operation in self.operations:
-        #     operation()
-
-        self.vertex_clicked = False
-        self.vertex_group.update(
-            mouse_buttons=mouse_buttons,
-            mouse_pos=mouse_pos,
-        )
-        self.vertex_group.draw(surface=self.image)
+        # Vertices live in image space, so are picked by the mouse there
+        image_mouse_pos = self.real_pixel_coords(mouse_pos)
+        self.update_vertices(mouse_buttons=mouse_buttons, mouse_pos=image_mouse_pos)
 
-        # Zoom
+        # Zoom. Only the visible part of the image is scaled, when drawn
         if scroll != 0:
-            zoom_step = 1 + ZOOM_STEP * (1 if scroll > 0 else -1)
+            zoom_step = (1 + ZOOM_STEP * (1 if scroll > 0 else -1)) ** abs(scroll)
+            min_zoom = MIN_ZOOMED_SIZE / max(self.pyramid.image.shape[:2])
+            zoom_step = max(self.zoom * zoom_step, min_zoom) / self.zoom
             self.zoom *= zoom_step
 
-            # TODO: Compute relevant crop of source_image and only upscale that (seg
-            # fault from huge image otherwise)
-            self.image = pygame.transform.smoothscale_by(self.image, self.zoom)
-
             # Update position to keep mouse cursor over the same part of the image
-            self.image_pos = mouse_pos - zoom_step * (mouse_pos - self.image_pos)
+            viewport_pos = self.get_viewport_rect().topleft
+            viewport_mouse_pos = pygame.Vector2(mouse_pos) - viewport_pos
+            self.image_pos = viewport_mouse_pos - zoom_step * (
+                viewport_mouse_pos - self.image_pos
+            )
 
         # Pan
         if mouse_buttons[MouseButton.RIGHT.value]:
@@ -192,53 +257,201 @@ class SegmentRegions:
                 self.last_mouse_pos
             )
 
-        # Add points on click
-        if self.vertex_clicked:
-            print("vertclcik")
-        elif not self.vertex_clicked and mouse_buttons[MouseButton.LEFT.value]:
-            self.operations.append(
-                lambda: self.vertex_group.add(
-                    Vertex(
-                        point=self.real_pixel_coords(mouse_pos),
-                        clicked_callback=self._set_vertex_clicked,
-                    )
-                )
-            )
-            self.operations[-1]()
-
         self.last_mouse_pos = mouse_pos
 
-    def draw(
-        self,
+    def update_vertices(
+        self, mouse_buttons: List[int], mouse_pos: pygame.Vector2
     ) -> None:
         """
-        Compute the position and size of the viewport
+        Add a vertex on click, or drag the one clicked on
+
+        Args:
+            mouse_buttons: Button state (pressed/unpressed) for each mouse button
+            mouse_pos: Position of mouse in image space
+        """
+        if not mouse_buttons[MouseButton.LEFT.value]:
+            self.dragged_vertex = None
+            return
+
+        # On click, grab the vertex under the mouse, or add one and grab that. Once
+        # grabbed, a vertex is dragged until released, even if the mouse outruns it
+        vertices = self.annotations.vertices
+        if self.dragged_vertex not in vertices:
+            self.dragged_vertex = self.annotations.vertex_at(tuple(mouse_pos))
+            if self.dragged_vertex is None:
+                self.dragged_vertex = self.annotations.add(tuple(mouse_pos))
+                self.invalidate(self.marker_rect(mouse_pos))
+            self.drag_offset = pygame.Vector2(vertices[self.dragged_vertex]) - mouse_pos
+            self.drag_moved = False
+            return
+
+        # Move by relative mouse movement (avoids snapping to mouse location), as one
+        # operation for the whole drag
+        old_point = vertices[self.dragged_vertex]
+        new_point = tuple(mouse_pos + self.drag_offset)
+        if new_point != old_point:
+            self.annotations.move(self.dragged_vertex, new_point, merge=self.drag_moved)
+            self.drag_moved = True
+            self.invalidate(self.marker_rect(old_point))
+            self.invalidate(self.marker_rect(new_point))
+
+    def handle_key(self, event: pygame.event.Event, mouse_pos: pygame.Vector2) -> None:
+        """
+        Undo, redo, save, or delete the vertex under the mouse, on the matching key
 
         Args:
+            event: Key down event
             mouse_pos: Position of mouse on screen
-            scroll: Movement of scroll wheel
+        """
+        ctrl = event.mod & pygame.KMOD_CTRL
+        shift = event.mod & pygame.KMOD_SHIFT
+        if ctrl and event.key == pygame.K_s:
+            self.annotations.save(self.session_path)
+            num_vertices = len(self.annotations.vertices)
+            print(f"Saved {num_vertices} vertices to {self.session_path}")
+            return
+
+        operation: Optional[Operation] = None
+        if ctrl and event.key == pygame.K_z and not shift:
+            operation = self.annotations.undo()
+        elif ctrl and event.key in (pygame.K_y, pygame.K_z):
+            operation = self.annotations.redo()
+        elif event.key in (pygame.K_DELETE, pygame.K_BACKSPACE):
+            vertex_id = self.annotations.vertex_at(
+                tuple(self.real_pixel_coords(mouse_pos))
+            )
+            if vertex_id is not None:
+                self.annotations.remove(vertex_id)
+                operation = self.annotations.undo_log[-1]
+
+        # Redraw where the vertex changed was and is, and let go of it if dragged
+        if operation is not None:
+            for point in (operation.before, operation.after):
+                if point is not None:
+                    self.invalidate(self.marker_rect(point))
+            self.dragged_vertex = None
+
+    def draw(self) -> None:
+        """
+        Redraw the parts of the screen that have changed, and update only those parts
+        of the window
         """
         # Compute viewport position and dimensions from screen size
         vpr = self.get_viewport_rect()
 
-        # Draw white background
-        pygame.draw.rect(self.screen, (255,) * 3, self.screen.get_rect())
+        # Everything moves when the window is resized
+        if self.screen.get_size() != self.screen_size:
+            self.screen_size = self.screen.get_size()
+            self.invalidate()
+
+        # Render visible part of image only if the view changed, dirtying all of it
+        view_key = (self.zoom, tuple(self.image_pos), vpr.size)
+        if view_key != self.view_key:
+            self.view = self.pyramid.render(
+                zoom=self.zoom, image_pos=tuple(self.image_pos), size=vpr.size
+            )
+            self.view_surface = pygame.image.frombuffer(self.view, vpr.size, "RGB")
+            self.view_key = view_key
+            self.invalidate(vpr)
+
+        # Scale vertex marker with the image
+        marker_size = tuple(round(side * self.zoom) for side in VERTEX_RESOLUTION)
+        if marker_size != self.marker_size and min(marker_size) >= 1:
+            self.marker = pygame.transform.smoothscale(vertex_marker(), marker_size)
+        self.marker_size = marker_size
+
+        # Only parts of the screen still on it need redrawing. Many small rectangles
+        # cost more to redraw one by one than once as a whole
+        screen_rect = self.screen.get_rect()
+        dirty_rects = [rect.clip(screen_rect) for rect in self.dirty_rects]
+        dirty_rects = [rect for rect in dirty_rects if rect]
+        self.dirty_rects = []
+        if not dirty_rects:
+            return
+        if screen_rect in dirty_rects:
+            dirty_rects = [screen_rect]
+        elif len(dirty_rects) > MAX_DIRTY_RECTS:
+            dirty_rects = [dirty_rects[0].unionall(dirty_rects[1:])]
+
+        # Redraw everything overlapping each dirty rectangle, clipped to it
+        for dirty_rect in dirty_rects:
+            self.screen.set_clip(dirty_rect)
+            self.draw_rect(dirty_rect, vpr)
+        self.screen.set_clip(None)
+
+        # Copy the redrawn parts of self.screen to X window
+        pygame.display.update(dirty_rects)
+
+    def draw_rect(self, dirty_rect: pygame.Rect, vpr: pygame.Rect) -> None:
+        """
+        Draw the part of the UI in a rectangle of the screen, which should be the
+        screen's clip area
 
-        # Draw image into viewport
-        viewport = pygame.Surface((vpr.width, vpr.height))
-        viewport.blit(self.image, dest=self.image_pos)
-        self.screen.blit(viewport, vpr)
+        Args:
+            dirty_rect: Rectangle of screen to draw
+            vpr: Viewport rectangle
+        """
+        # Draw white background
+        self.screen.fill(BACKGROUND_COLOUR, dirty_rect)
+
+        # Draw visible part of image into viewport
+        self.screen.blit(self.view_surface, vpr)
+
+        # Draw vertices over the image, scaled with it, looking up only those in the
+        # part of the viewport being drawn
+        if min(self.marker_size) >= 1 and dirty_rect.colliderect(vpr):
+            visible_rect = dirty_rect.clip(vpr)
+            self.screen.set_clip(visible_rect)
+            vertices = self.annotations.vertices
+            for vertex_id in self.annotations.vertices_in(
+                self.image_bounds(visible_rect)
+            ):
+                self.screen.blit(self.marker, self.marker_rect(vertices[vertex_id]))
+            self.screen.set_clip(dirty_rect)
 
         # Draw viewport border
-        pygame.draw.rect(
-            self.screen, color=(0,) * 3, rect=self.get_viewport_rect(), width=2
-        )
+        pygame.draw.rect(self.screen, color=(0,) * 3, rect=vpr, width=2)
 
         # Draw buttons
         self.button_group.draw(surface=self.screen)
 
-        # Draw self.screen to X window
-        pygame.display.flip()
+    def invalidate(self, rect: Optional[pygame.Rect] = None) -> None:
+        """
+        Mark part of the screen to be redrawn in the next frame
+
+        Args:
+            rect: Rectangle of screen to redraw, all of it if not given
+        """
+        self.dirty_rects.append(
+            pygame.Rect(rect) if rect is not None else self.screen.get_rect()
+        )
+
+    def invalidate_buttons(self) -> None:
+        """
+        Mark buttons whose appearance changed in their last update to be redrawn
+        """
+        for button in self.buttons:
+            if button.dirty:
+                self.invalidate(button.rect)
+                button.dirty = False
+
+    def marker_rect(self, point: Tuple[float, float]) -> pygame.Rect:
+        """
+        Compute where a vertex marker is drawn on screen
+
+        Args:
+            point: Position of vertex, in image space
+
+        Returns:
+            Rectangle marker is drawn in, on screen, centred on the vertex
+        """
+        position = (
+            pygame.Vector2(self.get_viewport_rect().topleft)
+            + self.image_pos
+            + pygame.Vector2(point) * self.zoom
+            - pygame.Vector2(self.marker_size) / 2
+        )
+        return pygame.Rect(int(position.x), int(position.y), *self.marker_size)
 
     def get_viewport_rect(self) -> pygame.Rect:
         """
@@ -254,14 +467,6 @@ class SegmentRegions:
             self.screen.get_height() - VIEWPORT_EDGE_OFFSET - VIEWPORT_BUTTON_OFFSET,
         )
 
-    def _set_vertex_clicked(self) -> None:
-        """
-        Set the flag to signal a vertex wsa clicked
-
-        This function is intended to be passed around as a callback
-        """
-        self.vertex_clicked = True
-
     def real_pixel_coords(self, mouse_pos: pygame.Vector2) -> pygame.Vector2:
         """
         Convert zoomed & panned mouse coords to image co-ordinates
@@ -272,7 +477,22 @@ class SegmentRegions:
         Returns:
             Position of cursor in image space
         """
-        return (mouse_pos - self.image_pos + (VIEWPORT_EDGE_OFFSET,) * 2) / self.zoom
+        viewport_pos = self.get_viewport_rect().topleft
+        return (pygame.Vector2(mouse_pos) - viewport_pos - self.image_pos) / self.zoom
+
+    def image_bounds(self, rect: pygame.Rect) -> Bounds:
+        """
+        Convert a rectangle on screen to the bounds of the image it covers
+
+        Args:
+            rect: Rectangle on screen
+
+        Returns:
+            Left, top, right and bottom of rectangle in image space
+        """
+        left, top = self.real_pixel_coords(rect.topleft)
+        right, bottom = self.real_pixel_coords(rect.bottomright)
+        return left, top, right, bottom
 
 
 class Button(pygame.sprite.Sprite):
@@ -308,6 +528,10 @@ class Button(pygame.sprite.Sprite):
         self.shortcut_key = shortcut_key
         self.rect = pygame.Rect(0, 0, BUTTON_WIDTH, BUTTON_HEIGHT)
         self.last_press = 0  # Debounce timer
+        self.hovering: Optional[bool] = None
+
+        # Whether the button's appearance or position changed, so it must be redrawn
+        self.dirty = True
 
     def update(
         self,
@@ -326,18 +550,22 @@ class Button(pygame.sprite.Sprite):
             mouse_pos: Position of mouse on screen
         """
         # Update button position on screen
+        old_rect = self.rect.copy()
         self.rect.x = screen_rect.width / 2 + self.centre_x_offset - BUTTON_WIDTH / 2
         self.rect.y = screen_rect.height - VIEWPORT_EDGE_OFFSET - BUTTON_HEIGHT
 
         # Check if hovering over button
-        hovering = self.rect.collidepoint(mouse_pos)
-
-        # Draw button onto button surface
-        pygame.draw.rect(
-            self.image,
-            self.highlight_colour if hovering else self.colour,
-            self.image.get_rect(),
-        )
+        hovering = bool(self.rect.collidepoint(mouse_pos))
+
+        # Draw button onto button surface, if its highlight changed
+        if hovering != self.hovering or self.rect != old_rect:
+            pygame.draw.rect(
+                self.image,
+                self.highlight_colour if hovering else self.colour,
+                self.image.get_rect(),
+            )
+            self.hovering = hovering
+            self.dirty = True
 
         # Check for button pressed
         if self.activated(keys=keys, mouse_buttons=mouse_buttons, hovering=hovering):
@@ -375,54 +603,16 @@ class Button(pygame.sprite.Sprite):
         return _activated
 
 
-class Vertex(pygame.sprite.Sprite):
+def vertex_marker() -> pygame.Surface:
     """
-    Vertices of polygons
-    """
-
-    def __init__(self, point: pygame.Vector2, clicked_callback: Callable) -> None:
-        """
-        Construct the vetrex
-
-        Args:
-            point: 2D vertex co-ordinates
-            clicked_callback: Callback to register that vertex was clicked
-        """
-        super().__init__()
-        self.rect = pygame.Rect(*point, *VERTEX_RESOLUTION)
-        self.image = pygame.Surface(VERTEX_RESOLUTION)
-        pygame.draw.circle(self.image, VERTEX_COLOUR, VERTEX_CENTRE, VERTEX_RADIUS)
-        self.last_mouse_pos: Optional[pygame.Vector2] = None
-        self.clicked_callback = clicked_callback
-
-    def update(
-        self,
-        mouse_buttons: List[int],
-        mouse_pos: pygame.Vector2,
-    ) -> None:
-        """
-        Update vertex location (check for click and drag)
-
-        Args:
-            mouse_buttons: Button state (pressed/unpressed) for each mouse button
-            mouse_pos: Position of mouse on screen
-        """
-        if mouse_buttons[MouseButton.LEFT.value] and self.rect.collidepoint(mouse_pos):
-            # Register to game we were clicked
-            self.clicked_callback()
-
-            # When we first click, register mouse location
-            if self.last_mouse_pos is None:
-                self.last_mouse_pos = mouse_pos
-
-            # On subsequent updates, mouve by relative mouse movement (avoids snapping to
-            # mouse location)
-            else:
-                self.rect.move_ip(mouse_pos - self.last_mouse_pos)
-        else:
-            self.last_mouse_pos = None
+    Draw the marker shown at each vertex
 
-        super().update()
+    Returns:
+        Marker, at full resolution
+    """
+    image = pygame.Surface(VERTEX_RESOLUTION, flags=pygame.SRCALPHA)
+    pygame.draw.circle(image, VERTEX_COLOUR, VERTEX_CENTRE, VERTEX_RADIUS)
+    return image
 
 
 if __name__ == "__main__":
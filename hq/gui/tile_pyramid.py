@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+
+"""
+Tile pyramid for viewing huge images at any zoom
+
+Each level of the pyramid halves the resolution of the one below it, and is cut into
+square tiles which are only built when first viewed, each from the four tiles beneath
+it. Built tiles are kept in a least recently used cache of bounded size. A view renders
+only the tiles it can see, from the level closest to (and no coarser than) the zoom, so
+the cost of a frame depends on the size of the viewport rather than the image
+"""
+
+
+from collections import OrderedDict
+from math import ceil, floor, log2
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+
+# Width and height of tiles (pixels)
+PYRAMID_TILE_SIZE = 512
+
+# Memory built tiles may take up before the least recently used are evicted (bytes)
+PYRAMID_CACHE_BYTES = 256 * 2**20
+
+BACKGROUND_COLOUR = (255, 255, 255)
+
+
+def load_image(image_path: str) -> np.ndarray:
+    """
+    Load an image as RGB
+
+    Args:
+        image_path: Path to image
+
+    Returns:
+        Image as (H, W, 3) uint8 array
+    """
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not load image at {image_path}")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+class TilePyramid:
+    """
+    Lazily built, cached mipmap of an image, split into tiles
+    """
+
+    def __init__(
+        self,
+        image: np.ndarray,
+        tile_size: int = PYRAMID_TILE_SIZE,
+        cache_bytes: int = PYRAMID_CACHE_BYTES,
+    ) -> None:
+        """
+        Construct the pyramid. No tiles are built until viewed
+
+        Args:
+            image: Full resolution image, as (H, W, C) uint8 array
+            tile_size: Width and height of tiles (pixels)
+            cache_bytes: Memory built tiles may take up (bytes)
+        """
+        self.image = image
+        self.tile_size = tile_size
+        self.cache_bytes = cache_bytes
+        self.tiles: "OrderedDict[Tuple[int, int, int], np.ndarray]" = OrderedDict()
+        self.cached_bytes = 0
+        self.num_built = 0
+
+        # Levels down to the first that fits in a single tile
+        height, width = image.shape[:2]
+        self.num_levels = max(ceil(log2(max(height, width) / tile_size)), 0) + 1
+
+    def level_shape(self, level: int) -> Tuple[int, int]:
+        """
+        Height and width of a level (pixels)
+        """
+        height, width = self.image.shape[:2]
+        return ceil(height / 2**level), ceil(width / 2**level)
+
+    def tile(self, level: int, row: int, col: int) -> np.ndarray:
+        """
+        Get a tile, building it if it isn't cached
+
+        Args:
+            level: Level of pyramid, 0 being full resolution
+            row: Row of tile in level
+            col: Column of tile in level
+
+        Returns:
+            Tile, smaller than the tile size at the bottom and right edges of the level
+        """
+        size = self.tile_size
+        if level == 0:
+            # Full resolution tiles are views of the image, so cost nothing to keep
+            return self.image[
+                row * size : (row + 1) * size, col * size : (col + 1) * size
+            ]
+
+        key = (level, row, col)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        # Halve the 2x2 tiles beneath this one, which may be fewer at the edges
+        height, width = self.level_shape(level - 1)
+        below = self.region(
+            level - 1,
+            2 * row * size,
+            2 * col * size,
+            min(2 * (row + 1) * size, height),
+            min(2 * (col + 1) * size, width),
+        )
+        tile = cv2.resize(
+            below,
+            (ceil(below.shape[1] / 2), ceil(below.shape[0] / 2)),
+            interpolation=cv2.INTER_AREA,
+        )
+        self.num_built += 1
+
+        self.tiles[key] = tile
+        self.cached_bytes += tile.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self.tiles) > 1:
+            _, evicted = self.tiles.popitem(last=False)
+            self.cached_bytes -= evicted.nbytes
+        return tile
+
+    def region(
+        self, level: int, top: int, left: int, bottom: int, right: int
+    ) -> np.ndarray:
+        """
+        Assemble part of a level from its tiles
+
+        Args:
+            level: Level of pyramid, 0 being full resolution
+            top: First row of region, within the level
+            left: First column of region, within the level
+            bottom: Row after the last of region, within the level
+            right: Column after the last of region, within the level
+
+        Returns:
+            Region of level
+        """
+        size = self.tile_size
+        first_row, first_col = top // size, left // size
+        last_row, last_col = (bottom - 1) // size, (right - 1) // size
+        if first_row == last_row and first_col == last_col:
+            tile = self.tile(level, first_row, first_col)
+            return tile[
+                top - first_row * size : bottom - first_row * size,
+                left - first_col * size : right - first_col * size,
+            ]
+
+        region = np.empty(
+            (bottom - top, right - left) + self.image.shape[2:], dtype=self.image.dtype
+        )
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                tile = self.tile(level, row, col)
+                tile_top, tile_left = row * size, col * size
+                y0, x0 = max(top, tile_top), max(left, tile_left)
+                y1 = min(bottom, tile_top + tile.shape[0])
+                x1 = min(right, tile_left + tile.shape[1])
+                region[y0 - top : y1 - top, x0 - left : x1 - left] = tile[
+                    y0 - tile_top : y1 - tile_top, x0 - tile_left : x1 - tile_left
+                ]
+        return region
+
+    def render(
+        self,
+        zoom: float,
+        image_pos: Tuple[float, float],
+        size: Tuple[int, int],
+        background: Tuple[int, ...] = BACKGROUND_COLOUR,
+    ) -> np.ndarray:
+        """
+        Render a view of the image
+
+        Args:
+            zoom: Screen pixels per image pixel
+            image_pos: Position of the image's top left corner in the view, as (X, Y)
+            size: Width and height of the view (pixels)
+            background: Colour of the view outside the image
+
+        Returns:
+            View, as (height, width, C) uint8 array
+        """
+        width, height = size
+        output = np.empty((height, width) + self.image.shape[2:], dtype=np.uint8)
+        output[:] = background
+
+        # Coarsest level no coarser than the view, so tiles are only ever shrunk, by up
+        # to 2x, unless zoomed in past full resolution
+        level = min(max(floor(log2(1 / zoom)), 0), self.num_levels - 1)
+        scale = zoom * 2**level
+        level_height, level_width = self.level_shape(level)
+
+        # Visible part of level, plus a pixel for interpolation at the edges
+        left = max(floor(-image_pos[0] / scale) - 1, 0)
+        top = max(floor(-image_pos[1] / scale) - 1, 0)
+        right = min(ceil((width - image_pos[0]) / scale) + 1, level_width)
+        bottom = min(ceil((height - image_pos[1]) / scale) + 1, level_height)
+        if left >= right or top >= bottom:
+            return output
+
+        # Nothing to draw if the visible part shrinks to under a pixel, when zoomed out
+        # further than the coarsest level goes
+        if (
+            scale < 1
+            and min(round((right - left) * scale), round((bottom - top) * scale)) < 1
+        ):
+            return output
+
+        region = self.region(level, top, left, bottom, right)
+        if scale < 1:
+            # Shrink with area averaging, which linear interpolation would alias, then
+            # place the result to the nearest pixel
+            region = cv2.resize(
+                region, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+            transform = np.array(
+                [
+                    [1, 0, round(image_pos[0] + left * scale)],
+                    [0, 1, round(image_pos[1] + top * scale)],
+                ],
+                dtype=np.float64,
+            )
+        else:
+            # Map region onto the view, lining up pixel centres of coarser levels with
+            # the centres of the full resolution pixels they cover
+            centring = (scale - zoom) / 2
+            transform = np.array(
+                [
+                    [scale, 0, image_pos[0] + left * scale + centring],
+                    [0, scale, image_pos[1] + top * scale + centring],
+                ]
+            )
+        return cv2.warpAffine(
+            region,
+            transform,
+            (width, height),
+            dst=output,
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_TRANSPARENT,
+        )
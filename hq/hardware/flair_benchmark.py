@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+
+"""
+Headless benchmark of the flair pressure needle detectors, on synthetic gauge images
+
+Gauge images are synthesised with the needle at known directions, so no camera, serial
+terminal or recorded data is needed, and nothing is written to disk. Each detector is
+timed, checked against the true pressure of each image, and run under tracemalloc to
+measure how much memory it allocates per frame
+"""
+
+
+import sys
+import tracemalloc
+from math import atan2, cos, degrees, pi, sin
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from hq.hardware.flair_pressure import (
+    CAPTURE_HEIGHT,
+    CAPTURE_WIDTH,
+    DIAL_MASK_PATH,
+    DIAL_X_MAX,
+    DIAL_X_MIN,
+    DIAL_Y_MAX,
+    DIAL_Y_MIN,
+    NEEDLE_X,
+    NEEDLE_Y,
+    FlairPressure,
+)
+
+# Needle directions (radians, clockwise from the right as the image is stored) over the
+# arc of the dial the mask covers, roughly 1 to 10 bar
+NEEDLE_DIRECTION_MIN = 1.0 * pi
+NEEDLE_DIRECTION_MAX = 1.8 * pi
+
+# Needle tip distance from the spindle, foreshortened vertically as the camera looks
+# down on the dial, and thickness (pixels)
+NEEDLE_LENGTH_X = 100
+NEEDLE_LENGTH_Y = 45
+NEEDLE_THICKNESS = 8
+
+DIAL_BRIGHTNESS = 200
+NEEDLE_BRIGHTNESS = 20
+
+# Frames each detector reads before being timed, to warm up
+BENCHMARK_WARMUP_FRAMES = 64
+
+
+def needle_tip(direction: float) -> Tuple[int, int]:
+    """
+    Position of the needle tip in a camera frame
+
+    Args:
+        direction: Needle direction (radians), clockwise from the right
+
+    Returns:
+        Tip position, as (X, Y)
+    """
+    return (
+        round(NEEDLE_X + NEEDLE_LENGTH_X * cos(direction)),
+        round(NEEDLE_Y + NEEDLE_LENGTH_Y * sin(direction)),
+    )
+
+
+def synthetic_gauge_images(
+    num_frames: int, noise: int = 40, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Synthesise camera frames of the gauge, the needle sweeping across the dial
+
+    Args:
+        num_frames: Number of frames
+        noise: Amplitude of uniform noise added to each pixel
+        seed: Random seed, for frames and needle directions
+
+    Returns:
+        Frames as (N, H, W, 3) uint8 array, and needle direction (radians) of each
+    """
+    rng = np.random.default_rng(seed)
+    directions = np.sort(
+        rng.uniform(NEEDLE_DIRECTION_MIN, NEEDLE_DIRECTION_MAX, num_frames)
+    )
+    imgs = np.full(
+        (num_frames, CAPTURE_HEIGHT, CAPTURE_WIDTH, 3), DIAL_BRIGHTNESS, dtype=np.uint8
+    )
+    imgs += rng.integers(0, noise + 1, imgs.shape, dtype=np.uint8)
+    for img, direction in zip(imgs, directions):
+        cv2.line(
+            img,
+            (NEEDLE_X, NEEDLE_Y),
+            needle_tip(direction),
+            (NEEDLE_BRIGHTNESS,) * 3,
+            NEEDLE_THICKNESS,
+        )
+    return imgs, directions
+
+
+def true_pressures(
+    pressure_monitor: FlairPressure, directions: np.ndarray
+) -> np.ndarray:
+    """
+    Pressure each synthetic frame should read, from the needle as drawn
+
+    The needle is drawn alone, the pixels of it on the dial are found exactly, and the
+    angle of their centroid is converted to pressure as the detector would
+
+    Args:
+        pressure_monitor: Detector, for its dial mask and pressure mapping
+        directions: Needle direction (radians) of each frame
+
+    Returns:
+        Pressure (bar) of each frame, NaN where no needle is on the dial
+    """
+    needle_y, needle_x = (
+        float(coordinate) for coordinate in pressure_monitor.needle_cetre
+    )
+    on_dial = pressure_monitor.dial_off_mask == 0
+    pressures = np.full(len(directions), np.nan)
+    needle = np.zeros((CAPTURE_HEIGHT, CAPTURE_WIDTH), dtype=np.uint8)
+    for i, direction in enumerate(directions):
+        needle[:] = 0
+        cv2.line(
+            needle, (NEEDLE_X, NEEDLE_Y), needle_tip(direction), 1, NEEDLE_THICKNESS
+        )
+        rows, cols = np.nonzero(
+            needle[DIAL_Y_MIN:DIAL_Y_MAX, DIAL_X_MIN:DIAL_X_MAX] & on_dial
+        )
+        if len(rows):
+            # Angle exactly as the detector measures it from its centroid
+            angle = degrees(atan2(cols.mean() - needle_y, rows.mean() - needle_x)) % 360
+            pressures[i] = pressure_monitor.pressure_mapping.pressure(alpha=angle)
+    return pressures
+
+
+def detectors(
+    pressure_monitor: FlairPressure,
+) -> Dict[str, Callable[[np.ndarray], np.ndarray]]:
+    """
+    Detectors to benchmark, each reading pressures from a stack of frames
+
+    Args:
+        pressure_monitor: Detector
+
+    Returns:
+        Function reading every frame with each detector, by name
+    """
+    dial = (
+        slice(None),
+        slice(DIAL_Y_MIN, DIAL_Y_MAX),
+        slice(DIAL_X_MIN, DIAL_X_MAX),
+        2,
+    )
+
+    def frame(imgs: np.ndarray) -> np.ndarray:
+        pressures = [pressure_monitor.detect_needle_position(img) for img in imgs]
+        return np.array([np.nan if p is None else p for p in pressures])
+
+    def dial_crop(imgs: np.ndarray) -> np.ndarray:
+        dials = np.ascontiguousarray(imgs[dial])
+        pressures = [
+            pressure_monitor.detect_dial_needle_position(cropped) for cropped in dials
+        ]
+        return np.array([np.nan if p is None else p for p in pressures])
+
+    def tracked(imgs: np.ndarray) -> np.ndarray:
+        dials = np.ascontiguousarray(imgs[dial])
+        pressures = [
+            pressure_monitor.detect_needle_position_tracked(cropped)
+            for cropped in dials
+        ]
+        return np.array([np.nan if p is None else p for p in pressures])
+
+    return {"frame": frame, "dial_crop": dial_crop, "tracked": tracked}
+
+
+def allocations(
+    detect: Callable[[np.ndarray], np.ndarray], imgs: np.ndarray
+) -> Tuple[float, int]:
+    """
+    Measure memory allocated by a detector, one frame at a time, with tracemalloc
+
+    Only allocations made through Python and numpy are seen, which includes the arrays
+    OpenCV returns but not its internal buffers
+
+    Args:
+        detect: Detector reading pressures from a stack of frames
+        imgs: Frames
+
+    Returns:
+        Mean peak memory allocated per frame (bytes), and memory still allocated after
+        every frame was read (bytes)
+    """
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        peaks = []
+        for i in range(len(imgs)):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            detect(imgs[i : i + 1])
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return float(np.mean(peaks)), end - start
+
+
+def run_benchmark(
+    num_frames: int = 500,
+    noise: int = 40,
+    seed: int = 0,
+    repeats: int = 3,
+    mask_path: str = DIAL_MASK_PATH,
+    num_threads: Optional[int] = None,
+    optimized: bool = True,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Benchmark each needle detector on synthetic gauge images
+
+    Args:
+        num_frames: Number of synthetic frames
+        noise: Amplitude of uniform noise added to each pixel
+        seed: Random seed of frames
+        repeats: Runs over the frames per detector, taking the fastest
+        mask_path: Path to segmentation mask of dial
+        num_threads: Threads OpenCV may use, its default if None
+        optimized: Whether OpenCV may use its optimised (SIMD etc) code paths
+
+    Returns:
+        For each detector: frames per second, absolute pressure error percentiles (bar),
+        number of frames with no reading, and allocations (see `allocations`)
+    """
+    # OpenCV's settings are process wide, so put them back as they were afterwards
+    previous_num_threads, previous_optimized = cv2.getNumThreads(), cv2.useOptimized()
+    if num_threads is not None:
+        cv2.setNumThreads(num_threads)
+    cv2.setUseOptimized(optimized)
+    print(
+        f"OpenCV {cv2.__version__}, {cv2.getNumThreads()} threads, "
+        f"optimised {cv2.useOptimized()}",
+        file=sys.stderr,
+    )
+
+    try:
+        pressure_monitor = FlairPressure(mask_path=mask_path, cache=False)
+        pressure_monitor.debug_mode = False
+        imgs, directions = synthetic_gauge_images(
+            num_frames=num_frames, noise=noise, seed=seed
+        )
+        truth = true_pressures(pressure_monitor=pressure_monitor, directions=directions)
+
+        results = {}
+        for name, detect in detectors(pressure_monitor=pressure_monitor).items():
+            detect(imgs[:BENCHMARK_WARMUP_FRAMES])  # Warm up
+            elapsed = []
+            for _ in range(repeats):
+                # Each pass starts from scratch, as the needle jumps back to the start
+                pressure_monitor.tracker.reset()
+                start = perf_counter()
+                pressures = detect(imgs)
+                elapsed.append(perf_counter() - start)
+            errors = np.abs(pressures.astype(float) - truth)
+            valid = ~np.isnan(errors)
+            peak_bytes, retained_bytes = allocations(detect=detect, imgs=imgs[:100])
+            results[name] = {
+                "frames_per_second": num_frames / min(elapsed),
+                "mean_error": float(errors[valid].mean()) if valid.any() else np.nan,
+                "p95_error": (
+                    float(np.percentile(errors[valid], 95)) if valid.any() else np.nan
+                ),
+                "max_error": float(errors[valid].max()) if valid.any() else np.nan,
+                "missed_frames": int((~valid).sum()),
+                "peak_bytes_per_frame": peak_bytes,
+                "retained_bytes": retained_bytes,
+            }
+    finally:
+        cv2.setNumThreads(previous_num_threads)
+        cv2.setUseOptimized(previous_optimized)
+    return results
+
+
+def print_results(results: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Print benchmark results as a table
+
+    Args:
+        results: Results, as returned by `run_benchmark`
+    """
+    print(
+        f"{'detector':<10} {'frames/s':>9} {'mean bar':>9} {'p95 bar':>8} "
+        f"{'max bar':>8} {'missed':>7} {'peak KiB':>9} {'kept KiB':>9}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<10} {result['frames_per_second']:9.0f} "
+            f"{result['mean_error']:9.3f} {result['p95_error']:8.3f} "
+            f"{result['max_error']:8.3f} {result['missed_frames']:7d} "
+            f"{result['peak_bytes_per_frame'] / 1024:9.1f} "
+            f"{result['retained_bytes'] / 1024:9.1f}"
+        )
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+
+
+"""
+Calibration of the flair pressure reader: dial geometry, and mapping needle angles to
+pressures
+"""
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+# Lookup table entries per degree of needle angle
+LUT_RESOLUTION = 20
+
+# Where precomputed dial geometry is cached, one directory per mask and crop
+DIAL_CALIBRATION_CACHE = os.path.expanduser("~/.cache/hq/flair_pressure")
+
+# Bump when what is cached for the dial changes, so old caches are ignored
+DIAL_CALIBRATION_VERSION = 1
+
+
+def camera_to_dial_angles(alphas: np.ndarray) -> np.ndarray:
+    """
+    Convert needle angles inferred from the camera to the true needle angles as viewed
+    normal to the dial plane
+
+    Vectorised equivalent of `FlairPressure.convert_angle`, see there for details
+
+    Args:
+        alphas: Angles of needle (degrees) as viewed from camera plane, in [0, 360]
+
+    Returns:
+        Angles of needle as viewed normal to the dial plane
+    """
+    c2a = np.cos(np.radians(alphas)) ** 2
+    angles = np.degrees(np.arccos(np.sqrt(c2a / (4 - 3 * c2a))))
+    quadrants = np.trunc(alphas / 90)
+    return np.select(
+        [quadrants == 0, quadrants == 1, quadrants == 2],
+        [angles, 180 - angles, 180 + angles],
+        default=360 - angles,
+    )
+
+
+class PressureMapping:
+    """
+    Mapping from needle angle, as seen by the camera, to pressure
+
+    The mapping is precomputed as lookup tables over camera-plane angles, such that
+    converting an angle costs a single table lookup
+    """
+
+    def __init__(
+        self,
+        zero_angle: float,
+        degrees_per_bar: float,
+        resolution: int = LUT_RESOLUTION,
+    ) -> None:
+        """
+        Construct the mapping and compute its lookup tables
+
+        Args:
+            zero_angle: Dial-plane needle angle (degrees) at zero pressure
+            degrees_per_bar: Dial-plane needle rotation (degrees) per bar, anticlockwise
+            resolution: Lookup table entries per degree
+        """
+        self.zero_angle = zero_angle
+        self.degrees_per_bar = degrees_per_bar
+        self.resolution = resolution
+
+        alphas = np.arange(360 * resolution + 1) / resolution
+        self.dial_angles = camera_to_dial_angles(alphas)
+        self.pressure_table = np.maximum(
+            0, (zero_angle - self.dial_angles) / degrees_per_bar
+        )
+
+    def convert_angle(self, alpha: float) -> float:
+        """
+        Convert a camera-plane needle angle to a dial-plane needle angle
+
+        Args:
+            alpha: Angle of needle (degrees) as viewed from camera plane, in [0, 360]
+
+        Returns:
+            Angle of needle as viewed normal to the dial plane
+        """
+        return float(self.dial_angles[self._index(alpha)])
+
+    def convert_angles(self, alphas: np.ndarray) -> np.ndarray:
+        """
+        Convert camera-plane needle angles to dial-plane needle angles
+
+        Args:
+            alphas: Angles of needle (degrees) as viewed from camera plane, in [0, 360].
+                NaN angles are passed through
+
+        Returns:
+            Angles of needle as viewed normal to the dial plane
+        """
+        return self._lookup(table=self.dial_angles, alphas=alphas)
+
+    def pressure(self, alpha: float) -> float:
+        """
+        Convert a camera-plane needle angle to pressure
+
+        Args:
+            alpha: Angle of needle (degrees) as viewed from camera plane, in [0, 360]
+
+        Returns:
+            Pressure (bar)
+        """
+        return float(self.pressure_table[self._index(alpha)])
+
+    def pressures(self, alphas: np.ndarray) -> np.ndarray:
+        """
+        Convert camera-plane needle angles to pressures
+
+        Args:
+            alphas: Angles of needle (degrees) as viewed from camera plane, in [0, 360].
+                NaN angles are passed through
+
+        Returns:
+            Pressures (bar)
+        """
+        return self._lookup(table=self.pressure_table, alphas=alphas)
+
+    def _index(self, alpha: float) -> int:
+        """
+        Index of the table entry nearest an angle, rounding halves up
+        """
+        return int(alpha * self.resolution + 0.5)
+
+    def _lookup(self, table: np.ndarray, alphas: np.ndarray) -> np.ndarray:
+        """
+        Look up values for an array of angles in a table, passing NaNs through, and
+        rounding exactly as `_index` does
+        """
+        valid = ~np.isnan(alphas)
+        values = np.full(np.shape(alphas), np.nan)
+        values[valid] = table[(alphas[valid] * self.resolution + 0.5).astype(int)]
+        return values
+
+    def save(self, path: str) -> None:
+        """
+        Save the mapping and its lookup tables, replacing any saved at the same path all
+        at once, so readers never see a partly written file
+
+        Args:
+            path: Path to write .npz file to
+        """
+        descriptor, staging = tempfile.mkstemp(
+            dir=os.path.dirname(path) or ".", suffix=".npz"
+        )
+        try:
+            with os.fdopen(descriptor, "wb") as staging_file:
+                np.savez(
+                    staging_file,
+                    zero_angle=self.zero_angle,
+                    degrees_per_bar=self.degrees_per_bar,
+                    resolution=self.resolution,
+                    dial_angles=self.dial_angles,
+                    pressure_table=self.pressure_table,
+                )
+            os.replace(staging, path)
+        finally:
+            if os.path.exists(staging):
+                os.remove(staging)
+
+    @classmethod
+    def load(cls, path: str) -> "PressureMapping":
+        """
+        Load a mapping saved with `save`, without recomputing its lookup tables
+
+        Args:
+            path: Path to .npz file
+
+        Returns:
+            Loaded mapping
+        """
+        mapping = cls.__new__(cls)
+        with np.load(path) as saved:
+            mapping.zero_angle = float(saved["zero_angle"])
+            mapping.degrees_per_bar = float(saved["degrees_per_bar"])
+            mapping.resolution = int(saved["resolution"])
+            mapping.dial_angles = saved["dial_angles"]
+            mapping.pressure_table = saved["pressure_table"]
+        return mapping
+
+    @classmethod
+    def load_or_build(
+        cls,
+        path: str,
+        zero_angle: float,
+        degrees_per_bar: float,
+        resolution: int = LUT_RESOLUTION,
+    ) -> "PressureMapping":
+        """
+        Load a saved mapping if it has the given calibration, otherwise build and save
+        one. A saved mapping that can't be loaded is rebuilt and replaced
+
+        Args:
+            path: Path to .npz file
+            zero_angle: Dial-plane needle angle (degrees) at zero pressure
+            degrees_per_bar: Dial-plane needle rotation (degrees) per bar, anticlockwise
+            resolution: Lookup table entries per degree
+
+        Returns:
+            Mapping with the given calibration
+        """
+        mapping: Optional[PressureMapping] = None
+        if os.path.exists(path):
+            try:
+                mapping = cls.load(path)
+            except Exception:
+                pass  # Saving is only a cache, so anything wrong with it is a miss
+        if mapping is None or (
+            mapping.zero_angle,
+            mapping.degrees_per_bar,
+            mapping.resolution,
+        ) != (zero_angle, degrees_per_bar, resolution):
+            mapping = cls(
+                zero_angle=zero_angle,
+                degrees_per_bar=degrees_per_bar,
+                resolution=resolution,
+            )
+            try:
+                mapping.save(path)
+            except OSError:
+                pass  # Saving is only a cache, we can run without it
+        return mapping
+
+
+class DialCalibration:
+    """
+    Dial geometry, precomputed from the dial mask
+
+    Computing it means decoding the mask PNG, so it is cached as .npy files keyed by a
+    hash of the PNG, and loaded memory-mapped
+    """
+
+    def __init__(
+        self, mask: np.ndarray, needle_centre: np.ndarray, off_dial: np.ndarray
+    ) -> None:
+        """
+        Construct the calibration
+
+        Args:
+            mask: Dial mask cropped to the dial, nonzero on the dial, as (H, W) array
+            needle_centre: Needle spindle position in the cropped dial, as (Y, X)
+            off_dial: 255 off the dial and 0 on it, as (H, W) array, such that OR-ing it
+                with a binary image masks out everything but the dial
+        """
+        self.mask = mask
+        self.needle_centre = needle_centre
+        self.off_dial = off_dial
+
+    @classmethod
+    def build(
+        cls,
+        mask_path: str,
+        y_min: int,
+        y_max: int,
+        x_min: int,
+        x_max: int,
+        needle_y: int,
+        needle_x: int,
+    ) -> "DialCalibration":
+        """
+        Compute the calibration from the dial mask
+
+        Args:
+            mask_path: Path to dial mask, as an image the size of a camera frame
+            y_min: Top of dial in frame
+            y_max: Bottom of dial in frame
+            x_min: Left of dial in frame
+            x_max: Right of dial in frame
+            needle_y: Row of needle spindle in frame
+            needle_x: Column of needle spindle in frame
+
+        Returns:
+            Calibration
+        """
+        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise ValueError(f"Could not load mask at {mask_path}")
+        mask = np.ascontiguousarray(mask[y_min:y_max, x_min:x_max])
+        return cls(
+            mask=mask,
+            needle_centre=np.array((needle_y - y_min, needle_x - x_min)),
+            off_dial=np.where(mask == 0, 255, 0).astype(np.uint8),
+        )
+
+    def save(self, directory: str) -> None:
+        """
+        Save the calibration, replacing any saved in the same directory all at once
+
+        Args:
+            directory: Directory to write .npy files under
+        """
+        parent = os.path.dirname(directory)
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent)
+        try:
+            for name in ("mask", "needle_centre", "off_dial"):
+                np.save(os.path.join(staging, f"{name}.npy"), getattr(self, name))
+            os.replace(staging, directory)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str) -> "DialCalibration":
+        """
+        Load a calibration saved with `save`, memory-mapped
+
+        Args:
+            directory: Directory of .npy files
+
+        Returns:
+            Loaded calibration
+        """
+        return cls(
+            **{
+                name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                for name in ("mask", "needle_centre", "off_dial")
+            }
+        )
+
+    @classmethod
+    def load_or_build(
+        cls,
+        mask_path: str,
+        y_min: int,
+        y_max: int,
+        x_min: int,
+        x_max: int,
+        needle_y: int,
+        needle_x: int,
+        cache_directory: str = DIAL_CALIBRATION_CACHE,
+    ) -> "DialCalibration":
+        """
+        Load a cached calibration for this mask if there is one, otherwise build and
+        cache one
+
+        Args:
+            mask_path: Path to dial mask, as an image the size of a camera frame
+            y_min: Top of dial in frame
+            y_max: Bottom of dial in frame
+            x_min: Left of dial in frame
+            x_max: Right of dial in frame
+            needle_y: Row of needle spindle in frame
+            needle_x: Column of needle spindle in frame
+            cache_directory: Directory to cache calibrations under
+
+        Returns:
+            Calibration for this mask
+        """
+        try:
+            with open(mask_path, "rb") as mask_file:
+                key = hashlib.sha256(mask_file.read())
+        except OSError as error:
+            raise ValueError(f"Could not load mask at {mask_path}") from error
+        geometry = (y_min, y_max, x_min, x_max, needle_y, needle_x)
+        key.update(repr((DIAL_CALIBRATION_VERSION, geometry)).encode())
+        directory = os.path.join(cache_directory, key.hexdigest())
+
+        if os.path.isdir(directory):
+            return cls.load(directory)
+        calibration = cls.build(
+            mask_path=mask_path,
+            y_min=y_min,
+            y_max=y_max,
+            x_min=x_min,
+            x_max=x_max,
+            needle_y=needle_y,
+            needle_x=needle_x,
+        )
+        try:
+            calibration.save(directory)
+        except OSError:
+            pass  # Saving is only a cache, we can run without it
+        return calibration
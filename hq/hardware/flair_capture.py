@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+
+"""
+Camera capture for the flair pressure reader, keeping only the dial
+
+OpenCV gives no way to crop at the device, so frames are captured at a fixed resolution
+and format into one reused buffer, and only the red channel of the dial is copied out,
+into a small pool of reused buffers
+"""
+
+
+from threading import Lock
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+from hq.hardware.stage_timers import StageTimers
+
+
+class DialCapture:
+    """
+    Webcam capture that yields just the red channel of the dial, without allocating per
+    frame
+
+    Dial images are taken from a pool, and must be given back with `release` once they
+    are no longer needed, otherwise the pool grows
+    """
+
+    def __init__(
+        self,
+        device: int,
+        width: int,
+        height: int,
+        fourcc: str,
+        y_min: int,
+        y_max: int,
+        x_min: int,
+        x_max: int,
+        num_buffers: int,
+        timers: Optional[StageTimers] = None,
+    ) -> None:
+        """
+        Open and configure the capture device
+
+        Args:
+            device: Index of video capture device
+            width: Frame width to request from device
+            height: Frame height to request from device
+            fourcc: Pixel format to request from device, e.g. YUYV or MJPG
+            y_min: Top of dial in frame
+            y_max: Bottom of dial in frame
+            x_min: Left of dial in frame
+            x_max: Right of dial in frame
+            num_buffers: Number of dial buffers to preallocate
+            timers: Timers to record capture and crop latency with
+        """
+        self.vid = cv2.VideoCapture(device)
+        self.vid.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        self.vid.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.vid.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Don't queue stale frames in driver
+
+        # Device may not give us what we asked for, so check the dial still fits
+        actual_width = int(self.vid.get(cv2.CAP_PROP_FRAME_WIDTH)) or width
+        actual_height = int(self.vid.get(cv2.CAP_PROP_FRAME_HEIGHT)) or height
+        if actual_width < x_max or actual_height < y_max:
+            raise ValueError(
+                f"Capture device {device} gives {actual_width}x{actual_height} frames, "
+                f"too small to contain the dial"
+            )
+
+        self.dial_rows = slice(y_min, y_max)
+        self.dial_cols = slice(x_min, x_max)
+        self.dial_shape = (y_max - y_min, x_max - x_min)
+        self.frame = np.empty((actual_height, actual_width, 3), dtype=np.uint8)
+        self.free: List[np.ndarray] = [self._new_buffer() for _ in range(num_buffers)]
+        self.lock = Lock()
+        self.timers = timers if timers is not None else StageTimers(enabled=False)
+
+    def _new_buffer(self) -> np.ndarray:
+        """
+        Allocate a buffer for one dial image
+        """
+        return np.empty(self.dial_shape, dtype=np.uint8)
+
+    def read(self) -> Optional[np.ndarray]:
+        """
+        Capture a frame and copy out the red channel of the dial
+
+        Returns:
+            Dial image as (H, W) array, or None if the capture failed
+        """
+        # OpenCV decodes into our buffer if it fits, but may hand back a new one
+        lap = self.timers.lap()
+        success, frame = self.vid.read(image=self.frame)
+        lap.mark("capture")
+        if not success:
+            return None
+        self.frame = frame
+
+        with self.lock:
+            dial = self.free.pop() if self.free else self._new_buffer()
+        np.copyto(dial, frame[self.dial_rows, self.dial_cols, 2])
+        lap.mark("crop")
+        return dial
+
+    def release(self, dial: Optional[np.ndarray]) -> None:
+        """
+        Give a dial image back to the pool, for reuse by a later read
+
+        Args:
+            dial: Dial image returned by `read`
+        """
+        if dial is not None:
+            with self.lock:
+                self.free.append(dial)
+
+    def close(self) -> None:
+        """
+        Close the capture device
+        """
+        self.vid.release()
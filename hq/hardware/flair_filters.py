@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+
+"""
+Streaming filters for pressures read from the flair gauge
+
+Each filter takes one sample at a time and does a fixed amount of work per sample,
+keeping any history in a preallocated ring buffer. Filters are chained, such that a
+sample rejected by one filter (or never read at all) is dropped without reaching the
+filters after it. Chains are configured with specs like "outlier:7,median:3,ewma:0.2"
+"""
+
+
+from math import isfinite
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+# Smoothing weight of the newest sample in exponentially weighted moving averages
+EWMA_WEIGHT = 0.2
+
+MEDIAN_SIZE = 5
+
+# Kalman filter noise: white noise acceleration of pressure (bar^2 / s^3) and variance
+# of readings (bar^2)
+KALMAN_PROCESS_NOISE = 5.0
+KALMAN_MEASUREMENT_NOISE = 0.05
+
+# Outlier rejection: samples further from the median of the window than this many
+# (scaled) median absolute deviations, and at least the minimum deviation, are rejected
+OUTLIER_SIZE = 7
+OUTLIER_THRESHOLD = 3.0
+OUTLIER_MIN_DEVIATION = 0.5
+
+# Scales median absolute deviation to standard deviation, for normally distributed noise
+MAD_SCALE = 1.4826
+
+
+def median(values: np.ndarray, scratch: np.ndarray) -> float:
+    """
+    Median of some values, partially sorted in a preallocated scratch array so nothing
+    is allocated
+
+    Args:
+        values: Values, which must not be empty
+        scratch: Array at least as long as values, overwritten
+
+    Returns:
+        Median of values, the mean of the middle two if there are an even number
+    """
+    count = len(values)
+    middle = count // 2
+    work = scratch[:count]
+    np.copyto(work, values)
+    if count % 2:
+        work.partition(middle)
+        return float(work[middle])
+    work.partition((middle - 1, middle))
+    return float(work[middle - 1] + work[middle]) / 2
+
+
+class RingBuffer:
+    """
+    Fixed size window of the latest samples, in a preallocated array
+    """
+
+    def __init__(self, size: int) -> None:
+        """
+        Preallocate the buffer
+
+        Args:
+            size: Number of samples kept
+        """
+        if size < 1:
+            raise ValueError(f"Ring buffer size must be positive, not {size}")
+        self.samples = np.zeros(size)
+        self.scratch = np.zeros(size)  # Working space for medians
+        self.count = 0
+        self.index = 0
+
+    def push(self, value: float) -> None:
+        """
+        Add a sample, replacing the oldest once the buffer is full
+        """
+        self.samples[self.index] = value
+        self.index = (self.index + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+
+    def window(self) -> np.ndarray:
+        """
+        Samples in the buffer, in no particular order, as a view of the buffer
+        """
+        return self.samples[: self.count]
+
+    def median(self) -> float:
+        """
+        Median of the samples in the buffer, which must not be empty
+        """
+        return median(self.window(), scratch=self.scratch)
+
+    def clear(self) -> None:
+        """
+        Remove all samples
+        """
+        self.count = 0
+        self.index = 0
+
+
+class EwmaFilter:
+    """
+    Single pole low pass filter: exponentially weighted moving average
+    """
+
+    def __init__(self, weight: float = EWMA_WEIGHT, initial: float = 0.0) -> None:
+        """
+        Args:
+            weight: Weight of the newest sample, in (0, 1]
+            initial: Value the average starts from
+        """
+        if not 0 < weight <= 1:
+            raise ValueError(f"EWMA weight must be in (0, 1], not {weight}")
+        self.weight = weight
+        self.initial = initial
+        self.value = initial
+
+    def update(self, value: float, capture_time: float) -> Optional[float]:
+        """
+        Filter a sample
+
+        Args:
+            value: Sample
+            capture_time: Time sample was captured (seconds)
+
+        Returns:
+            Filtered sample, or None if the sample was rejected
+        """
+        self.value = self.weight * value + (1 - self.weight) * self.value
+        return self.value
+
+    def reset(self) -> None:
+        """
+        Forget all samples
+        """
+        self.value = self.initial
+
+
+class MedianFilter:
+    """
+    Median of the latest samples, removing spikes shorter than half the window
+    """
+
+    def __init__(self, size: float = MEDIAN_SIZE) -> None:
+        """
+        Args:
+            size: Number of samples to take the median of
+        """
+        self.window = RingBuffer(size=int(size))
+
+    def update(self, value: float, capture_time: float) -> Optional[float]:
+        """
+        Filter a sample, see `EwmaFilter.update`
+        """
+        self.window.push(value)
+        return self.window.median()
+
+    def reset(self) -> None:
+        """
+        Forget all samples
+        """
+        self.window.clear()
+
+
+class KalmanFilter:
+    """
+    Kalman filter tracking pressure and its rate of change, with constant velocity
+    dynamics
+
+    Predictions are made across the actual time between samples, so dropped frames only
+    widen the uncertainty rather than skewing the estimate
+    """
+
+    def __init__(
+        self,
+        process_noise: float = KALMAN_PROCESS_NOISE,
+        measurement_noise: float = KALMAN_MEASUREMENT_NOISE,
+    ) -> None:
+        """
+        Args:
+            process_noise: Spectral density of white noise acceleration (bar^2 / s^3)
+            measurement_noise: Variance of samples (bar^2)
+        """
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.reset()
+
+    def update(self, value: float, capture_time: float) -> Optional[float]:
+        """
+        Filter a sample, see `EwmaFilter.update`
+        """
+        if self.last_capture_time is None:
+            self.last_capture_time = capture_time
+            self.pressure = value
+            self.p00 = self.measurement_noise
+            return value
+        dt = max(capture_time - self.last_capture_time, 0.0)
+        self.last_capture_time = capture_time
+
+        # Predict, with covariance of constant velocity model written out in full
+        q = self.process_noise
+        pressure = self.pressure + self.rate * dt
+        p00 = self.p00 + dt * (2 * self.p01 + dt * self.p11) + q * dt**3 / 3
+        p01 = self.p01 + dt * self.p11 + q * dt**2 / 2
+        p11 = self.p11 + q * dt
+
+        # Correct with the sample
+        s = p00 + self.measurement_noise
+        k0, k1 = p00 / s, p01 / s
+        residual = value - pressure
+        self.pressure = pressure + k0 * residual
+        self.rate += k1 * residual
+        self.p00 = (1 - k0) * p00
+        self.p01 = (1 - k0) * p01
+        self.p11 = p11 - k1 * p01
+        return self.pressure
+
+    def reset(self) -> None:
+        """
+        Forget all samples
+        """
+        self.last_capture_time: Optional[float] = None
+        self.pressure = 0.0
+        self.rate = 0.0
+        self.p00 = self.p01 = 0.0
+        self.p11 = self.process_noise
+
+
+class OutlierFilter:
+    """
+    Rejects samples far from the median of the latest samples (a Hampel filter)
+
+    The window includes rejected samples, so a genuine step is let through once it
+    fills half the window
+    """
+
+    def __init__(
+        self,
+        size: float = OUTLIER_SIZE,
+        threshold: float = OUTLIER_THRESHOLD,
+        min_deviation: float = OUTLIER_MIN_DEVIATION,
+    ) -> None:
+        """
+        Args:
+            size: Number of samples to compare against
+            threshold: Scaled median absolute deviations a sample may be from the median
+            min_deviation: Distance from the median (bar) that is never rejected
+        """
+        self.window = RingBuffer(size=int(size))
+        self.deviations = np.zeros(int(size))
+        self.threshold = threshold
+        self.min_deviation = min_deviation
+
+    def update(self, value: float, capture_time: float) -> Optional[float]:
+        """
+        Filter a sample, see `EwmaFilter.update`
+        """
+        self.window.push(value)
+        median = self.window.median()
+
+        # Median absolute deviation, the upper middle one for an even number of samples
+        deviations = self.deviations[: self.window.count]
+        np.subtract(self.window.window(), median, out=deviations)
+        np.abs(deviations, out=deviations)
+        middle = len(deviations) // 2
+        deviations.partition(middle)
+        mad = float(deviations[middle])
+        limit = max(self.threshold * MAD_SCALE * mad, self.min_deviation)
+        return value if abs(value - median) <= limit else None
+
+    def reset(self) -> None:
+        """
+        Forget all samples
+        """
+        self.window.clear()
+
+
+# Filter constructors by name, each taking its parameters positionally
+FILTERS: Dict[str, Callable[..., object]] = {
+    "ewma": EwmaFilter,
+    "median": MedianFilter,
+    "kalman": KalmanFilter,
+    "outlier": OutlierFilter,
+}
+
+
+class FilterChain:
+    """
+    Filters applied one after another to each pressure read from the gauge
+    """
+
+    def __init__(self, filters: List) -> None:
+        """
+        Args:
+            filters: Filters, applied in order
+        """
+        self.filters = filters
+
+    @classmethod
+    def parse(cls, spec: str) -> "FilterChain":
+        """
+        Build a chain from a spec
+
+        Args:
+            spec: Comma separated filters, each a name from `FILTERS` followed by any
+                parameters separated by colons, e.g. "outlier:7:3,ewma:0.2". Empty
+                for no filtering
+
+        Returns:
+            Filter chain
+        """
+        filters = []
+        for filter_spec in filter(None, spec.replace(" ", "").split(",")):
+            name, *parameters = filter_spec.split(":")
+            if name not in FILTERS:
+                raise ValueError(
+                    f"Unknown filter {name}, choose from {', '.join(FILTERS)}"
+                )
+            filters.append(FILTERS[name](*map(float, parameters)))
+        return cls(filters=filters)
+
+    def update(self, value: Optional[float], capture_time: float) -> Optional[float]:
+        """
+        Filter a pressure
+
+        Args:
+            value: Pressure read from gauge (bar), None if it couldn't be read
+            capture_time: Time the reading was captured (seconds)
+
+        Returns:
+            Filtered pressure (bar), None if the reading was missing or rejected
+        """
+        if value is None or not isfinite(value):
+            return None
+        for pressure_filter in self.filters:
+            value = pressure_filter.update(value, capture_time)
+            if value is None:
+                return None
+        return value
+
+    def reset(self) -> None:
+        """
+        Forget all samples
+        """
+        for pressure_filter in self.filters:
+            pressure_filter.reset()
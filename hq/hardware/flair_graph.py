@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+
+"""
+ASCII graph of pressure over time for the flair pressure reader
+"""
+
+
+from typing import Optional
+
+import numpy as np
+
+
+PLOT_CHAR = ord("*")
+BLANK_CHAR = ord(" ")
+
+
+class PressureGraph:
+    """
+    Scrolling ASCII plot of pressure, newest sample on the left
+
+    Samples are stored in a preallocated ring buffer, so adding one is O(1). Samples are
+    only drawn into the character grid when the graph is rendered, and only those added
+    since the last render
+    """
+
+    def __init__(self, rows: int, cols: int) -> None:
+        """
+        Construct the graph
+
+        Args:
+            rows: Number of rows in plot area, including the row above the top label
+            cols: Number of samples shown
+        """
+        self.rows = rows
+        self.cols = cols
+
+        # Ring buffers of samples
+        self.pressures = np.zeros(cols)
+        self.times = np.full(cols, np.nan)
+        self.num_samples = 0
+        self.num_rendered = 0
+
+        # Character grid, stored twice side by side, such that the visible window is
+        # always a contiguous slice. Samples are written right to left
+        self.grid = np.full((rows, 2 * cols), BLANK_CHAR, dtype=np.uint8)
+
+        # Y axis labels, counting down from the top, with X for 10 bar
+        self.y_labels = [" "] + [str(row)[-1] for row in range(rows - 2, -1, -1)]
+        self.y_labels[1] = "X"
+        self.x_axis = "  " + "-" * (cols + 2)
+
+    def push(self, pressure: float, time: Optional[float] = None) -> None:
+        """
+        Add a sample to the graph
+
+        Args:
+            pressure: Pressure (bar)
+            time: Time label to write under this sample, if any
+        """
+        slot = -(self.num_samples + 1) % self.cols
+        self.pressures[slot] = pressure
+        self.times[slot] = np.nan if time is None else time
+        self.num_samples += 1
+
+    def render(self) -> str:
+        """
+        Draw any new samples and return the graph as a string
+
+        Returns:
+            Graph, as lines separated by newlines
+        """
+        # Draw columns for samples added since last render, into both copies of the grid
+        num_new = min(self.num_samples - self.num_rendered, self.cols)
+        slots = (-self.num_samples + np.arange(num_new)) % self.cols
+        rows = self.rows - 1 - np.clip(
+            np.round(self.pressures[slots]).astype(int), 0, self.rows - 1
+        )
+        for offset in (0, self.cols):
+            self.grid[:, slots + offset] = BLANK_CHAR
+            self.grid[rows, slots + offset] = PLOT_CHAR
+        self.num_rendered = self.num_samples
+
+        # Visible window starts at the newest sample
+        newest = -self.num_samples % self.cols
+        num_visible = min(self.num_samples, self.cols)
+        window = self.grid[:, newest : newest + num_visible]
+        lines = [
+            f"  {label}|" + row.tobytes().decode()
+            for label, row in zip(self.y_labels, window)
+        ]
+
+        # Write time labels under the samples that have them, which may run past the
+        # newest sample but not past the end of the axis
+        time_row = bytearray(b" " * (self.cols + 2))
+        times = np.roll(self.times, -newest)[:num_visible]
+        row_length = num_visible
+        for age in np.flatnonzero(~np.isnan(times)):
+            time_row[age : age + 3] = f"{times[age]:3.0f}".encode()[:3]
+            row_length = max(row_length, age + 3)
+        row_length = min(row_length, self.cols - 1)
+        lines += [self.x_axis, "   |" + time_row[:row_length].decode()]
+
+        return "\n".join(lines)
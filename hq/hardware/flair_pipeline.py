@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+
+"""
+Threaded stages for the flair pressure reader
+
+Stages are joined by single-slot queues that drop stale items, such that a slow stage
+only ever sees the latest output of the stage before it, and never holds it back
+"""
+
+
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import sleep, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# How long blocked stages wait before checking whether they should stop (seconds)
+POLL_PERIOD = 0.1
+
+# Failed captures in a row, each followed by a poll period's pause, after which the
+# camera is taken to have gone (unplugged, stalled, etc)
+CAPTURE_FAILURES_MAX = 50
+
+
+def put_latest(queue: Queue, item: Any) -> List[Any]:
+    """
+    Put an item on a bounded queue, discarding the oldest item if the queue is full
+
+    Only safe with a single producer per queue
+
+    Args:
+        queue: Queue to put item on
+        item: Item to put on queue
+
+    Returns:
+        Items discarded from the queue
+    """
+    discarded = []
+    while True:
+        try:
+            queue.put_nowait(item)
+            return discarded
+        except Full:
+            try:
+                discarded.append(queue.get_nowait())
+            except Empty:
+                pass
+
+
+class CameraReader(Thread):
+    """
+    Capture frames as fast as the camera provides them
+
+    Frames are put on the output queue as (capture time, frame) tuples. Failed reads are
+    skipped, rather than passed on as None, until so many fail in a row that the reader
+    stops with an error. Frames dropped because the consumer hasn't caught up are given
+    to the release function, so their buffers can be reused
+    """
+
+    def __init__(
+        self,
+        capture_frame: Callable[[], Optional[np.ndarray]],
+        frames: Queue,
+        release_frame: Optional[Callable[[np.ndarray], None]] = None,
+        max_failures: int = CAPTURE_FAILURES_MAX,
+    ) -> None:
+        """
+        Construct the camera reader
+
+        Args:
+            capture_frame: Function returning a frame from the camera, or None on
+                failure
+            frames: Bounded queue to put timestamped frames on
+            release_frame: Function called with each frame that is dropped
+            max_failures: Failed captures in a row after which the reader stops
+        """
+        super().__init__(name="camera-reader", daemon=True)
+        self.capture_frame = capture_frame
+        self.frames = frames
+        self.release_frame = release_frame
+        self.max_failures = max_failures
+        self.stopped = Event()
+        self.error: Optional[Exception] = None
+
+    def run(self) -> None:
+        """
+        Capture frames until stopped, or until the camera fails. Why it failed is kept
+        in `error`, for `get_frame` to raise
+        """
+        failures = 0
+        try:
+            while not self.stopped.is_set():
+                frame = self.capture_frame()
+                if frame is None:
+                    failures += 1
+                    if failures >= self.max_failures:
+                        raise RuntimeError(
+                            f"Camera returned no frame {failures} times in a row"
+                        )
+                    sleep(POLL_PERIOD)
+                    continue
+                failures = 0
+                for _, dropped in put_latest(self.frames, (time(), frame)):
+                    if self.release_frame is not None:
+                        self.release_frame(dropped)
+        except Exception as error:
+            self.error = error
+
+    def stop(self) -> None:
+        """
+        Signal the reader to stop after its current capture
+        """
+        self.stopped.set()
+
+
+def get_frame(frames: Queue, camera: CameraReader) -> Tuple[float, np.ndarray]:
+    """
+    Wait for the next frame from a camera reader
+
+    Args:
+        frames: Queue the camera reader puts frames on
+        camera: Camera reader, checked periodically in case it has died
+
+    Returns:
+        Capture time and frame
+
+    Raises:
+        RuntimeError: If the camera reader has stopped, from the error that stopped it
+    """
+    while True:
+        try:
+            return frames.get(timeout=POLL_PERIOD)
+        except Empty:
+            if not camera.is_alive():
+                raise RuntimeError(
+                    "Camera reader stopped unexpectedly"
+                ) from camera.error
+
+
+class RenderWorker(Thread):
+    """
+    Long-lived worker that draws to a single sink (stdout, serial terminal, etc)
+
+    Draw requests are given as keyword arguments to the draw function. Requests that
+    arrive while the worker is busy are merged, with newer arguments replacing older
+    ones, so a slow sink only ever draws the latest state
+    """
+
+    def __init__(self, draw: Callable[..., None], name: str) -> None:
+        """
+        Construct the render worker
+
+        Args:
+            draw: Function that draws to the sink
+            name: Name of thread, for debugging
+        """
+        super().__init__(name=name, daemon=True)
+        self.draw = draw
+        self.requests: Queue = Queue(maxsize=1)
+        self.stopped = Event()
+
+    def submit(self, **kwargs) -> None:
+        """
+        Request a draw, merged with any request the worker has not started yet
+
+        Only safe to call from a single thread
+        """
+        try:
+            pending: Dict[str, Any] = self.requests.get_nowait()
+        except Empty:
+            pending = {}
+        put_latest(self.requests, {**pending, **kwargs})
+
+    def run(self) -> None:
+        """
+        Draw requests until stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                request = self.requests.get(timeout=POLL_PERIOD)
+            except Empty:
+                continue
+            self.draw(**request)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the worker, waiting for any in-progress draw to finish
+
+        Args:
+            timeout: Maximum time to wait for the worker to finish (seconds)
+        """
+        self.stopped.set()
+        if self.is_alive():
+            self.join(timeout=timeout)
@@ -7,21 +7,37 @@ Read pressure from flair and provide a timer
 """
 
 
+import json
 import os
 import signal
 import sys
 from math import acos, atan2, cos, degrees, radians, sqrt
+from functools import partial
 from pathlib import Path
-from random import shuffle
+from queue import Queue
 from serial import Serial
 from subprocess import run
+from datetime import datetime
 from time import sleep, time
-from typing import Optional
-from threading import Thread
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
+import typer
 from hq.cli.utils import getchar
+from hq.hardware.flair_calibration import DialCalibration, PressureMapping
+from hq.hardware.flair_capture import DialCapture
+from hq.hardware.flair_filters import FilterChain
+from hq.hardware.flair_graph import PressureGraph
+from hq.hardware.flair_pipeline import CameraReader, RenderWorker, get_frame
+from hq.hardware.flair_shots import (
+    SHOT_DATABASE_PATH,
+    ShotRecorder,
+    ShotStore,
+    ShotWriter,
+)
+from hq.hardware.stage_timers import Lap, NullLap, StageTimers
+from hq.hardware.vt52 import Vt52Screen
 
 CTRL_C = b"\x03"
 BACKSPACE = b"\x7f"
@@ -38,24 +54,85 @@ DIAL_Y_MAX = 300
 DIAL_X_MIN = 212
 DIAL_X_MAX = 404
 
+# Needle spindle position in camera frame
+NEEDLE_Y = 254
+NEEDLE_X = 316
+
+# Segmentation mask of relevant portion of dial, the size of a camera frame
+DIAL_MASK_PATH = os.path.expanduser("~/hq/etc/flair_pressure/dial_mask.png")
+
+# Needle segmentation: pixels darker than the threshold after equalisation and blurring
+# are needle, and blur and dilation use square kernels of this size
+NEEDLE_THRESHOLD = 80
+FILTER_KERNEL_SIZE = 5
+FILTER_KSIZE = (FILTER_KERNEL_SIZE, FILTER_KERNEL_SIZE)
+DILATION_KERNEL = np.ones(FILTER_KSIZE)
+
+# Needle tracking: only the dial within this many degrees either side of the last
+# needle angle is searched. If the needle comes within the edge margin of the window, or
+# loses too much of the area it had at the last full search, the whole dial is searched
+TRACKING_WINDOW = 20.0
+TRACKING_EDGE_MARGIN = 3.0
+TRACKING_MIN_AREA_FRACTION = 0.5
+
+# Frames the tracker reuses its histogram equalisation for, between recomputing it over
+# the whole dial
+TRACKING_EQUALISATION_PERIOD = 10
+
 ZERO_ANGLE = 213.69
 NINE_BAR_ANGLE = 40
 DEGREES_PER_BAR = 16 / 1.5
 
+# Angle to pressure lookup tables, cached alongside the dial mask
+PRESSURE_MAPPING_PATH = os.path.expanduser(
+    "~/hq/etc/flair_pressure/pressure_mapping.npz"
+)
+
+# Filters applied to pressures read from the gauge, see `FilterChain.parse`
 EXP_WEIGHT = 0.2
+PRESSURE_FILTERS = f"ewma:{EXP_WEIGHT}"
+
 GRAPH_ROWS = 12
 GRAPH_COLS = 76  # kopi (terminal)
 # GRAPH_COLS = 150  # skoopi
 GRAPH_UPDATE_PERIOD = 0.5
-GRAPH_REDRAW_PERIOD_TERMINAL = 1.0  # terminal
-GRAPH_REDRAW_PERIOD = GRAPH_REDRAW_PERIOD_TERMINAL  # skoopi
+GRAPH_REDRAW_PERIOD_TERMINAL = 0.25  # terminal, only changed characters are sent
+GRAPH_REDRAW_PERIOD = 1.0  # skoopi
 UPDATES_PER_REFRESH = 70
 
+# How long to wait for in-progress draws when exiting
+RENDER_STOP_TIMEOUT = 1.0
+
+# Learned gauge reader, as exported by hq/ml/flair_regression/export_regression.py
+LEARNED_MODEL_PATH = os.path.expanduser(
+    "~/hq/etc/flair_pressure/dial_regression_int8.pt"
+)
+
+# Quantized kernels the learned gauge reader was exported for
+LEARNED_QUANTIZED_ENGINE = "qnnpack"
+
+# Where per-stage latencies are written upon ctrl-c, when timing with FP_TIMING
+TIMING_DUMP_PATH = "/tmp/fp_timing.json"
+
 # How long we have to stay past a threshold value before we trust it
 COOLDOWN_TIME = 1.0
 
-# Webcam device we capture images from
+# Webcam device we capture images from, and the format we ask it for. Dial bounds
+# assume this resolution. Raw YUYV spares the Pi from decoding MJPG
 CAPTURE_DEVICE = 0
+CAPTURE_WIDTH = 640
+CAPTURE_HEIGHT = 480
+CAPTURE_FOURCC = "YUYV"
+
+# Dial images in flight: one being captured, one queued and one being detected
+CAPTURE_BUFFERS = 3
+
+# How long to wait for the capture in progress when exiting, before closing the device
+CAPTURE_STOP_TIMEOUT = 1.0
+
+# Serial terminal we draw the graph to
+TERMINAL_DEVICE = "/dev/ttyUSB0"
+TERMINAL_BAUDRATE = 19200
 
 # Thresholds for shot timing (Bar)
 PRE_INFUSE_PRESSURE_THRESHOLD = 0.5
@@ -66,9 +143,16 @@ SHOT_PRESSURE_THRESHOLD = 5
 global pressure_graph
 global pressure_str
 global terminal_conection
-pressure_graph = ""
+pressure_graph = PressureGraph(rows=GRAPH_ROWS, cols=GRAPH_COLS)
 pressure_str = ""
 terminal_connection = None
+stage_timers = StageTimers(enabled=False)
+
+# Render workers, stopped before the final draw
+render_workers = []
+
+# Recorder of the shot being timed, saved before exiting
+shot_recorder: Optional[ShotRecorder] = None
 
 
 def signal_handler(sig, frame):
@@ -77,28 +161,37 @@ def signal_handler(sig, frame):
 
     We print the graph nicely one last time, then exit gracefully
     """
-    # Sleep for a moment to let threads finish
-    sleep(1.0)
+    # Let render workers finish what they are drawing, so we don't interleave output
+    for worker in render_workers:
+        worker.stop(timeout=RENDER_STOP_TIMEOUT)
 
     # Draw the graph one last time to stdout
+    final_graph = pressure_graph.render()
     draw_graph(
-        pressure_graph=pressure_graph,
+        pressure_graph=final_graph,
         pressure_str=pressure_str + "\n",
     )
 
     # Also draw to terminal and close the serial connection, if we have one
     if terminal_connection is not None:
         draw_graph(
-            pressure_graph=pressure_graph,
+            pressure_graph=final_graph,
             pressure_str=pressure_str,
             connection=terminal_connection,
         )
         terminal_connection.close()
 
-    sys.exit(0)
+    # Save the shot, if one was timed, and wait for it to be written
+    if shot_recorder is not None:
+        shot_recorder.finish()
+        shot_recorder.writer.close()
 
+    # Save per-stage latencies, if we were timing them
+    if stage_timers.enabled:
+        stage_timers.dump(TIMING_DUMP_PATH)
+        print(f"Stage latencies written to {TIMING_DUMP_PATH}", file=sys.stderr)
 
-signal.signal(signal.SIGINT, signal_handler)
+    sys.exit(0)
 
 
 def clear() -> None:
@@ -113,20 +206,39 @@ class FlairPressure:
     Flair 58 pressure gauge reader and TUI
     """
 
-    def __init__(self) -> None:
+    def __init__(self, mask_path: str = DIAL_MASK_PATH, cache: bool = True) -> None:
         """
         Construct the Flair pressure reader
+
+        Args:
+            mask_path: Path to segmentation mask of dial
+            cache: Load the dial geometry and pressure mapping from their caches, saving
+                them if need be. Otherwise they are computed without touching the disk
         """
-        self.load_dial_mask()
-        self.needle_cetre = np.array((254 - DIAL_Y_MIN, 316 - DIAL_X_MIN))
+        self.load_dial_mask(mask_path=mask_path, cache=cache)
+        if cache:
+            self.pressure_mapping = PressureMapping.load_or_build(
+                path=PRESSURE_MAPPING_PATH,
+                zero_angle=ZERO_ANGLE,
+                degrees_per_bar=DEGREES_PER_BAR,
+            )
+        else:
+            self.pressure_mapping = PressureMapping(
+                zero_angle=ZERO_ANGLE, degrees_per_bar=DEGREES_PER_BAR
+            )
         self.log_to_stderr = "LOG_STDERR" in os.environ
         self.debug_mode = "FP_DEBUG" in os.environ
-        self.pressure_graph = np.full((GRAPH_ROWS + 2, GRAPH_COLS + 2), fill_value="\0")
-        self.pressure_graph[:, 0] = " "
-        self.pressure_graph[1:GRAPH_ROWS, 0] = np.arange(GRAPH_ROWS - 2, -1, -1)
-        self.pressure_graph[1, 0] = "X"
-        self.pressure_graph[:, 1] = "|"
-        self.pressure_graph[GRAPH_ROWS, :] = "-"
+        self.timing_overlay = "FP_TIMING_OVERLAY" in os.environ
+        self.timers = StageTimers(
+            enabled="FP_TIMING" in os.environ or self.timing_overlay
+        )
+        self.pressure_graph = PressureGraph(rows=GRAPH_ROWS, cols=GRAPH_COLS)
+        self.learned_model = None
+        self.tracker = NeedleTracker(
+            off_dial=self.dial_off_mask,
+            needle_centre=self.needle_cetre,
+            timers=self.timers,
+        )
 
     def capture_frame(self, vid_in: Optional[cv2.VideoCapture] = None) -> np.ndarray:
         """
@@ -185,7 +297,7 @@ class FlairPressure:
         Compute pressure from images of gauge
 
         Returns:
-            Current pressure (bar)
+            Current pressure (bar), or None if no needle could be found
         """
         if img is None:
             return None
@@ -193,29 +305,56 @@ class FlairPressure:
         # Convert image to grayscale
         gray = img[..., 2]  # red channel should minimise red writing visibility
 
+        if self.debug_mode:
+            cv2.imwrite(filename="/tmp/gray.png", img=gray)
+
         # Crop image down to just the dial
-        cropped = gray[DIAL_Y_MIN:DIAL_Y_MAX, DIAL_X_MIN:DIAL_X_MAX, ...]
+        return self.detect_dial_needle_position(
+            cropped=gray[DIAL_Y_MIN:DIAL_Y_MAX, DIAL_X_MIN:DIAL_X_MAX, ...]
+        )
+
+    def detect_dial_needle_position(self, cropped: np.ndarray) -> Optional[float]:
+        """
+        Compute pressure from an image of the dial, as captured by `DialCapture`
+
+        Args:
+            cropped: Red channel of image, cropped down to just the dial
+
+        Returns:
+            Current pressure (bar), or None if no needle could be found
+        """
+        lap = self.timers.lap()
 
         # Do histogram equalisation to make needle darkness consistent
         equ = cv2.equalizeHist(cropped)
+        lap.mark("equalize")
 
         # Blur image to optimise thresholding performance
-        blur = cv2.GaussianBlur(src=equ, ksize=(5, 5), sigmaX=0)
+        blur = cv2.GaussianBlur(src=equ, ksize=FILTER_KSIZE, sigmaX=0)
+        lap.mark("blur")
 
         # Binarise by thresholding
         _, binary = cv2.threshold(
-            src=blur, thresh=80, maxval=255, type=cv2.THRESH_BINARY
+            src=blur, thresh=NEEDLE_THRESHOLD, maxval=255, type=cv2.THRESH_BINARY
         )
 
         # Mask out everything but the dial
-        binary[self.dial_mask == 0] = 255
+        np.bitwise_or(binary, self.dial_off_mask, out=binary)
+        lap.mark("threshold")
 
         # Dilate to remove noise
-        dilated = cv2.dilate(binary, kernel=np.ones((5, 5)), iterations=1)
+        dilated = cv2.dilate(binary, kernel=DILATION_KERNEL, iterations=1)
+        lap.mark("dilate")
 
-        # Find centre of needle tail
-        centroid = np.mean(np.argwhere(255 - dilated), axis=0).astype(int)
-        centroid = tuple(reversed(centroid))  # Switch to X, Y instead of Y, X
+        # Find centre of needle tail, if any of the needle is on the dial. Image moments
+        # sum over the needle pixels without listing their coordinates
+        moments = cv2.moments(255 - dilated, binaryImage=True)
+        if not moments["m00"]:
+            return None
+        centroid = (
+            int(moments["m10"] / moments["m00"]),
+            int(moments["m01"] / moments["m00"]),
+        )
 
         # Get angle of needle relative to centre spindle in camera plane
         direction_vector = centroid - self.needle_cetre
@@ -223,15 +362,12 @@ class FlairPressure:
         if angle < 0:
             angle = 360 + angle
 
-        # Transform camera-plane angle to dial-plane
-        angle = self.convert_angle(alpha=angle)
-
-        # Apply a transformation function to produce a pressure value
-        pressure = max(0, (ZERO_ANGLE - angle) / DEGREES_PER_BAR)
+        # Transform camera-plane angle to dial-plane and then to a pressure value
+        pressure = self.pressure_mapping.pressure(alpha=angle)
+        lap.mark("centroid")
 
         if self.debug_mode:
-            cv2.imwrite(filename="/tmp/gray.png", img=gray)
-            cv2.imwrite(filename="/tmp/contrast.png", img=gray)
+            cv2.imwrite(filename="/tmp/contrast.png", img=cropped)
             cv2.imwrite(filename="/tmp/blur.png", img=blur)
             cv2.imwrite(filename="/tmp/equ.png", img=equ)
             cv2.imwrite(
@@ -248,45 +384,172 @@ class FlairPressure:
 
         return pressure
 
+    def detect_needle_position_tracked(self, cropped: np.ndarray) -> Optional[float]:
+        """
+        Compute pressure from an image of the dial, searching near the last needle
+        position, see `NeedleTracker`
+
+        Args:
+            cropped: Red channel of image, cropped down to just the dial
+
+        Returns:
+            Current pressure (bar), or None if no needle could be found
+        """
+        angle = self.tracker.track(cropped=cropped)
+        if angle is None:
+            return None
+        return self.pressure_mapping.pressure(alpha=angle)
+
+    def detect_needle_positions(self, imgs: np.ndarray) -> np.ndarray:
+        """
+        Compute pressures from a stack of images of the gauge
+
+        Args:
+            imgs: Images of gauge as (N, H, W, 3) array
+
+        Returns:
+            Current pressure (bar) of each image as (N,) array, NaN where no needle
+            could be found
+        """
+        # Crop red channel of each image down to just the dial
+        return self.detect_dial_needle_positions(
+            cropped=imgs[:, DIAL_Y_MIN:DIAL_Y_MAX, DIAL_X_MIN:DIAL_X_MAX, 2]
+        )
+
+    def detect_dial_needle_positions(self, cropped: np.ndarray) -> np.ndarray:
+        """
+        Compute pressures from a stack of images of the dial, see
+        `detect_dial_needle_position`
+
+        Args:
+            cropped: Red channel of each image, cropped down to just the dial, as
+                (N, H, W) array
+
+        Returns:
+            Current pressure (bar) of each image as (N,) array, NaN where no needle
+            could be found
+        """
+        pressures = np.full(len(cropped), np.nan)
+        for i, image in enumerate(cropped):
+            pressure = self.detect_dial_needle_position(np.ascontiguousarray(image))
+            if pressure is not None:
+                pressures[i] = pressure
+        return pressures
+
     def update_pressures(
         self, new_pressure: float, new_time: Optional[float] = None
-    ) -> str:
+    ) -> None:
         """
-        Update and return the ascii plot of pressures
+        Add a sample to the ascii plot of pressures
+
+        The plot is only drawn when rendered, see `PressureGraph.render`
         """
-        # Shift existing graph
-        self.pressure_graph[:GRAPH_ROWS, 3:] = self.pressure_graph[:GRAPH_ROWS, 2:-1]
+        self.pressure_graph.push(pressure=new_pressure, time=new_time)
 
-        # Write latest timestep
-        self.pressure_graph[:GRAPH_ROWS, 2] = " "
-        self.pressure_graph[GRAPH_ROWS - 1 - round(new_pressure), 2] = "*"
+    def load_learned_model(self, model_path: str = LEARNED_MODEL_PATH) -> None:
+        """
+        Load the learned gauge reader
 
-        # Shift old timestamps
-        self.pressure_graph[-1, 3:] = self.pressure_graph[-1, 2:-1]
-        self.pressure_graph[-1, 3] = " "
-        if new_time is not None:
-            self.pressure_graph[-1, 3:6] = list(f"{new_time:3.0f}")
+        Args:
+            model_path: Path to quantized TorchScript model
+        """
+        # Imported here as torch is only installed for ML work, see HQML in setup.py
+        import torch
 
-        # Construct string representation
-        return "\n".join(
-            "  " + "".join(line[line != "\0"]) for line in self.pressure_graph
-        )
+        if LEARNED_QUANTIZED_ENGINE in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = LEARNED_QUANTIZED_ENGINE
+        if not os.path.exists(model_path):
+            raise ValueError(f"Could not load learned model at {model_path}")
+        self.learned_model = torch.jit.load(model_path, map_location="cpu").eval()
 
-    def detect_needle_position_learned(self) -> float:
+    def detect_needle_position_learned(self, cropped: np.ndarray) -> float:
         """
-        Compute pressure from images of gauge using a neural net
+        Compute pressure from an image of the dial using a neural net
+
+        Args:
+            cropped: Red channel of image, cropped down to just the dial
 
         Returns:
             Current pressure (bar)
         """
-        raise NotImplementedError("Learned gauge reading has not been implemented yet")
-
-    def cli_main(self, terminal_connection: Serial) -> None:
+        import torch
+
+        if self.learned_model is None:
+            self.load_learned_model()
+        with torch.inference_mode():
+            return float(self.learned_model(torch.from_numpy(cropped)[None])[0])
+
+    def cli_main(
+        self,
+        terminal_connection: Serial,
+        learned: bool = False,
+        tracking: bool = False,
+        recipe: Optional[str] = None,
+        grind: Optional[float] = None,
+        shot_database: str = SHOT_DATABASE_PATH,
+        filters: str = PRESSURE_FILTERS,
+    ) -> None:
         """
         Main CLI tool routine
+
+        Runs as three stages: a camera reader thread, needle detection in this thread,
+        and a render worker thread per output. Stale frames and draws are dropped, so
+        the sample rate depends only on the camera
+
+        Args:
+            terminal_connection: Serial connection to terminal
+            learned: Read the gauge with the learned model instead of the needle
+                detector
+            tracking: Search for the needle near where it was last seen, see
+                `NeedleTracker`
+            recipe: Recipe being pulled, saved with the shot
+            grind: Grind setting, saved with the shot
+            shot_database: Path to database to save the shot to
+            filters: Filters to smooth pressures with, see `FilterChain.parse`
         """
-        # Open video capture object
-        vid = cv2.VideoCapture(CAPTURE_DEVICE)
+        # Choose how to read the gauge
+        if learned:
+            if self.learned_model is None:
+                self.load_learned_model()
+            detect = self.timers.timed("inference", self.detect_needle_position_learned)
+        elif tracking:
+            detect = self.detect_needle_position_tracked
+        else:
+            detect = self.detect_dial_needle_position
+
+        # Open video capture object, read dial images from it in the background
+        capture = DialCapture(
+            device=CAPTURE_DEVICE,
+            width=CAPTURE_WIDTH,
+            height=CAPTURE_HEIGHT,
+            fourcc=CAPTURE_FOURCC,
+            y_min=DIAL_Y_MIN,
+            y_max=DIAL_Y_MAX,
+            x_min=DIAL_X_MIN,
+            x_max=DIAL_X_MAX,
+            num_buffers=CAPTURE_BUFFERS,
+            timers=self.timers,
+        )
+        frames = Queue(maxsize=1)
+        camera = CameraReader(
+            capture_frame=capture.read, frames=frames, release_frame=capture.release
+        )
+
+        # Start a long-lived render worker for stdout and the terminal
+        stdout_renderer = RenderWorker(
+            draw=self.timers.timed("render_stdout", draw_stdout),
+            name="stdout-renderer",
+        )
+        terminal_renderer = RenderWorker(
+            draw=self.timers.timed(
+                "render_terminal",
+                partial(
+                    draw_terminal, connection=terminal_connection, screen=Vt52Screen()
+                ),
+            ),
+            name="terminal-renderer",
+        )
+        render_workers.extend([stdout_renderer, terminal_renderer])
 
         # Clear screen
         clear()
@@ -296,136 +559,140 @@ class FlairPressure:
         start = time()
         i = 0
         pressures = []
-        last_capture_time = -1.0
         last_update_time = -1.0
         last_redraw_time = -1.0
         last_terminal_redraw_time = -1.0
         num_updates = 0
-        pressure = 0
 
         # We want to update the global pressure graph and string in this function, such
         # that the signal handler routine (run upon ctrl-c) can redraw the graph
         global pressure_graph
         global pressure_str
+        global stage_timers
+        pressure_graph = self.pressure_graph
+        stage_timers = self.timers
 
         # We keep track of the times when pre-infusion and extraction begin for
         # displaying shot times and impulses
-        pre_infuse_start = None
-        shot_start = None
-        shot_duration = 0.0
-        pre_infuse_duration = 0.0
-        shot_impulse = 0.0
-        impulse = 0.0
-        shot_complete = False
-
-        # Main application loop
-        while True:
+        shot_timer = ShotTimer(filters=FilterChain.parse(filters))
+
+        # Save the shot's trace and summary to the shot history, written in the
+        # background so the loop never waits on disk
+        global shot_recorder
+        shot_writer = ShotWriter(path=shot_database)
+        shot_recorder = ShotRecorder(
+            writer=shot_writer,
+            shot_timer=shot_timer,
+            start=start,
+            recipe=recipe,
+            grind=grind,
+        )
 
-            # Capture image
-            img = self.capture_frame(vid_in=vid)
-            capture_time = time() - start
-            dt = capture_time - last_capture_time
+        shot_writer.start()
+        camera.start()
+        stdout_renderer.start()
+        terminal_renderer.start()
 
-            # Compute pressure from angle of needle, apply exponential weighted moving average
-            pressure = (
-                EXP_WEIGHT * self.detect_needle_position(img=img)
-                + (1 - EXP_WEIGHT) * pressure
-            )
-            if pressure is None:
-                continue
-
-            # If we did validly get a pressure value, add it to the list of values
-            pressures.append(pressure)
-
-            # Update our trackers for the start of the pre-infuse and shot
-            if pre_infuse_start is None and pressure > PRE_INFUSE_PRESSURE_THRESHOLD:
-                pre_infuse_start = capture_time
-            if shot_start is None and pressure > SHOT_PRESSURE_THRESHOLD:
-                shot_start = capture_time
-                pre_infuse_duration = shot_start - pre_infuse_start
-
-            # Update our running pre-infuse & shot timers
-            if shot_start:
-                if pressure > SHOT_PRESSURE_THRESHOLD:
-                    shot_duration = capture_time - shot_start
-            elif pre_infuse_start:
-                pre_infuse_duration = capture_time - pre_infuse_start
-
-            # If either of our timers are running, compute impulse and print a message
-            if extracting := (pre_infuse_start or shot_start):
-                impulse += pressure * dt
-                duration_str = f"Shot time: {shot_duration:.2f} seconds ({pre_infuse_duration:.2f} second pre-infuse)"
-                impulse_str = f"Impulse: {impulse:.2f} bar seconds"
-
-            # Construct string for printing to terminal and stdout
-            pressure_str = "\r\t" + "\t".join(
-                [
-                    f"Time: {capture_time:.2f} seconds",
-                    f"Pressure: {pressure:.2f} bar",
-                ]
-                + ([duration_str, impulse_str] if extracting else [])
-            )
+        # Main application loop, which only ends when ctrl-c exits through the signal
+        # handler. Stop the camera and release the capture device on the way out
+        try:
+            while True:
 
-            # Update graph periodically
-            if capture_time > last_update_time + GRAPH_UPDATE_PERIOD:
-                avg_pressure = np.mean(pressures) if pressures else 0
-                if num_updates >= UPDATES_PER_REFRESH:
-                    num_updates = 0
-                    graph_time = capture_time
-                else:
-                    graph_time = None
-                pressure_graph = self.update_pressures(
-                    new_pressure=avg_pressure,
-                    new_time=graph_time,
-                )
-                pressures = []
-                last_update_time = capture_time
+                # Wait for the latest image of the dial
+                frame_time, dial = get_frame(frames=frames, camera=camera)
+                capture_time = frame_time - start
 
-                # Print to stdout again if enough time has elapsed
-                if capture_time > last_redraw_time + GRAPH_REDRAW_PERIOD:
-                    Thread(
-                        target=draw_graph, kwargs={"pressure_graph": pressure_graph}
-                    ).start()
-                    last_redraw_time = capture_time
+                # Compute pressure from angle of needle, then hand the buffer back
+                raw_pressure = detect(cropped=dial)
+                capture.release(dial)
+
+                # Update shot timers
+                pressure = shot_timer.update(
+                    raw_pressure=raw_pressure, capture_time=capture_time
+                )
+                if pressure is None:
+                    continue
+
+                # If we did validly get a pressure value, add it to the list of values
+                pressures.append(pressure)
+                shot_recorder.update(pressure=pressure, capture_time=capture_time)
+
+                # Construct string for printing to terminal and stdout
+                pressure_str = shot_timer.status(capture_time=capture_time)
+
+                # Update graph periodically
+                if capture_time > last_update_time + GRAPH_UPDATE_PERIOD:
+                    avg_pressure = np.mean(pressures) if pressures else 0
+                    if num_updates >= UPDATES_PER_REFRESH:
+                        num_updates = 0
+                        graph_time = capture_time
+                    else:
+                        graph_time = None
+                    self.update_pressures(
+                        new_pressure=avg_pressure,
+                        new_time=graph_time,
+                    )
+                    pressures = []
+                    last_update_time = capture_time
+
+                    # Print to stdout again if enough time has elapsed
+                    if capture_time > last_redraw_time + GRAPH_REDRAW_PERIOD:
+                        stdout_graph = self.pressure_graph.render()
+                        if self.timing_overlay:
+                            stdout_graph += "\n\n" + self.timers.overlay()
+                        stdout_renderer.submit(
+                            pressure_graph=stdout_graph,
+                            pressure_str=pressure_str,
+                        )
+                        last_redraw_time = capture_time
 
                 # Print to the terminal again if enough time has elapsed
-                if (
-                    capture_time
-                    > last_terminal_redraw_time + GRAPH_REDRAW_PERIOD_TERMINAL
-                ):
-                    Thread(
-                        target=draw_graph,
-                        kwargs={
-                            "pressure_graph": pressure_graph,
-                            "connection": terminal_connection,
-                            "pressure_str": pressure_str,
-                        },
-                    ).start()
+                next_terminal_redraw_time = (
+                    last_terminal_redraw_time + GRAPH_REDRAW_PERIOD_TERMINAL
+                )
+                if capture_time > next_terminal_redraw_time:
+                    terminal_renderer.submit(
+                        pressure_graph=self.pressure_graph.render(),
+                        pressure_str=pressure_str,
+                    )
                     last_terminal_redraw_time = capture_time
 
-            # Print fast-refresh pressure and time status line
-            sys.stdout.write(pressure_str)
-            if self.log_to_stderr:
-                sys.stderr.write(f"{pressure}\n")
+                # Print fast-refresh pressure and time status line
+                stdout_renderer.submit(pressure_str=pressure_str)
+                if self.log_to_stderr:
+                    sys.stderr.write(f"{pressure}\n")
 
-            # Update loop variables
-            i += 1
-            num_updates += 1
-            last_capture_time = capture_time
+                # Update loop variables
+                i += 1
+                num_updates += 1
+        finally:
+            camera.stop()
+            camera.join(timeout=CAPTURE_STOP_TIMEOUT)
+            capture.close()
 
-        vid.release()
-
-    def load_dial_mask(self) -> None:
-        """
-        Load segmentation mask of relevant portion of flair dial
+    def load_dial_mask(self, mask_path: str, cache: bool = True) -> None:
         """
-        mask_path = os.path.expanduser("~/hq/etc/flair_pressure/dial_mask.png")
-        mask = cv2.imread(mask_path)[DIAL_Y_MIN:DIAL_Y_MAX, DIAL_X_MIN:DIAL_X_MAX, ...]
-        if mask is None:
-            raise ValueError(f"Could not load mask at {mask_path}")
+        Load segmentation mask of relevant portion of flair dial, and the dial geometry
+        derived from it
 
-        # Mask is saved as RGB, just take first channel
-        self.dial_mask = mask[..., 0]
+        Args:
+            mask_path: Path to segmentation mask of dial
+            cache: Load the dial geometry from its cache, saving it if need be
+        """
+        load = DialCalibration.load_or_build if cache else DialCalibration.build
+        calibration = load(
+            mask_path=mask_path,
+            y_min=DIAL_Y_MIN,
+            y_max=DIAL_Y_MAX,
+            x_min=DIAL_X_MIN,
+            x_max=DIAL_X_MAX,
+            needle_y=NEEDLE_Y,
+            needle_x=NEEDLE_X,
+        )
+        # Views as plain arrays, as slicing memory maps is slow
+        self.dial_mask = np.asarray(calibration.mask)
+        self.dial_off_mask = np.asarray(calibration.off_dial)
+        self.needle_cetre = np.asarray(calibration.needle_centre)
 
     @staticmethod
     def convert_angle(alpha: float) -> float:
@@ -456,6 +723,403 @@ class FlairPressure:
         return 360 - angle
 
 
+class ShotTimer:
+    """
+    Shot state machine, tracking pre-infusion and extraction from a stream of pressures
+
+    Pressures are smoothed by a filter chain, by default an exponentially weighted
+    moving average, before being compared against the pre-infuse and shot thresholds
+    """
+
+    def __init__(self, filters: Optional[FilterChain] = None) -> None:
+        """
+        Construct the shot timer, with no shot started
+
+        Args:
+            filters: Filters to smooth pressures with, `PRESSURE_FILTERS` if None
+        """
+        self.filters = (
+            filters if filters is not None else FilterChain.parse(PRESSURE_FILTERS)
+        )
+        self.pressure = 0.0
+        self.last_capture_time: Optional[float] = None
+        self.pre_infuse_start: Optional[float] = None
+        self.shot_start: Optional[float] = None
+        self.pre_infuse_duration = 0.0
+        self.shot_duration = 0.0
+        self.impulse = 0.0
+        self.peak_pressure = 0.0
+
+    @property
+    def extracting(self) -> bool:
+        """
+        Whether pre-infusion or extraction has started
+        """
+        return self.pre_infuse_start is not None or self.shot_start is not None
+
+    @property
+    def finished(self) -> bool:
+        """
+        Whether extraction has started and pressure has since dropped back below the
+        pre-infuse threshold
+        """
+        return (
+            self.shot_start is not None
+            and self.pressure < PRE_INFUSE_PRESSURE_THRESHOLD
+        )
+
+    def update(
+        self, raw_pressure: Optional[float], capture_time: float
+    ) -> Optional[float]:
+        """
+        Update shot state with a new pressure reading
+
+        Args:
+            raw_pressure: Pressure read from gauge (bar), None if it couldn't be read
+            capture_time: Time the reading was captured (seconds)
+
+        Returns:
+            Smoothed pressure (bar), None if the reading was missing or rejected by the
+            filters
+        """
+        pressure = self.filters.update(raw_pressure, capture_time)
+        if pressure is None:
+            return None
+        dt = (
+            0.0
+            if self.last_capture_time is None
+            else capture_time - self.last_capture_time
+        )
+        self.last_capture_time = capture_time
+        self.pressure = pressure
+        self.peak_pressure = max(self.peak_pressure, pressure)
+
+        # Update our trackers for the start of the pre-infuse and shot
+        if self.pre_infuse_start is None and pressure > PRE_INFUSE_PRESSURE_THRESHOLD:
+            self.pre_infuse_start = capture_time
+        if self.shot_start is None and pressure > SHOT_PRESSURE_THRESHOLD:
+            self.shot_start = capture_time
+            self.pre_infuse_duration = self.shot_start - self.pre_infuse_start
+
+        # Update our running pre-infuse & shot timers
+        if self.shot_start is not None:
+            if pressure > SHOT_PRESSURE_THRESHOLD:
+                self.shot_duration = capture_time - self.shot_start
+        elif self.pre_infuse_start is not None:
+            self.pre_infuse_duration = capture_time - self.pre_infuse_start
+
+        # If either of our timers are running, compute impulse
+        if self.extracting:
+            self.impulse += pressure * dt
+
+        return pressure
+
+    def status(self, capture_time: float) -> str:
+        """
+        Construct status line for printing to terminal and stdout
+
+        Args:
+            capture_time: Time of latest reading (seconds)
+
+        Returns:
+            Status line, with fields separated by tabs
+        """
+        fields = [
+            f"Time: {capture_time:.2f} seconds",
+            f"Pressure: {self.pressure:.2f} bar",
+        ]
+        if self.extracting:
+            fields += [
+                f"Shot time: {self.shot_duration:.2f} seconds "
+                f"({self.pre_infuse_duration:.2f} second pre-infuse)",
+                f"Impulse: {self.impulse:.2f} bar seconds",
+            ]
+        return "\r\t" + "\t".join(fields)
+
+
+class NeedleTracker:
+    """
+    Needle detector that searches only near where the needle was last seen
+
+    Segmentation is the same as `FlairPressure.detect_dial_needle_position`, but only
+    the box around a window of directions from the spindle, around the last needle
+    direction, is equalised and filtered. Equalisation uses the lookup table computed
+    over the whole dial at most `TRACKING_EQUALISATION_PERIOD` frames before, as the
+    histogram barely changes while the needle moves, and the masks of each window are
+    computed once. The centroid is found to sub-pixel precision, rather than truncated
+    to a whole pixel, and dark specks outside the window are ignored, so angles jitter
+    less. The whole dial is searched when there is no last direction, or when the
+    needle looks to have left the window
+
+    Needle angles are measured from the centroid exactly as the needle detector does,
+    which the pressure calibration depends on. The window is in directions from the
+    spindle itself, in which the needle is narrow
+    """
+
+    def __init__(
+        self,
+        off_dial: np.ndarray,
+        needle_centre: np.ndarray,
+        timers: Optional[StageTimers] = None,
+        window: float = TRACKING_WINDOW,
+        edge_margin: float = TRACKING_EDGE_MARGIN,
+        min_area_fraction: float = TRACKING_MIN_AREA_FRACTION,
+        equalisation_period: int = TRACKING_EQUALISATION_PERIOD,
+    ) -> None:
+        """
+        Construct the tracker, precomputing the direction of each pixel on the dial
+
+        Args:
+            off_dial: 255 off the dial and 0 on it, as (H, W) array
+            needle_centre: Needle spindle position, as (Y, X)
+            timers: Timers to record stage latency with
+            window: Degrees either side of the last needle direction to search
+            edge_margin: Degrees from the edge of the window the needle may come
+            min_area_fraction: Fraction of its area at the last full search the needle
+                may lose
+            equalisation_period: Frames to reuse the equalisation lookup table for
+        """
+        self.off_dial = off_dial
+        self.needle_centre = needle_centre
+        self.timers = timers if timers is not None else StageTimers(enabled=False)
+        self.window = window
+        self.edge_margin = edge_margin
+        self.min_area_fraction = min_area_fraction
+        self.equalisation_period = equalisation_period
+
+        # Direction of each pixel from the spindle, anticlockwise from the right
+        rows, cols = np.indices(off_dial.shape)
+        self.pixel_directions = (
+            np.degrees(np.arctan2(needle_centre[0] - rows, cols - needle_centre[1]))
+            % 360
+        ).astype(np.float32)
+
+        # Bounding box of the dial pixels at each whole degree, empty where there are
+        # none
+        on_dial = off_dial == 0
+        bins = self.pixel_directions[on_dial].astype(int)
+        row_min = np.full(360, off_dial.shape[0])
+        row_max = np.full(360, -1)
+        col_min = np.full(360, off_dial.shape[1])
+        col_max = np.full(360, -1)
+        np.minimum.at(row_min, bins, rows[on_dial])
+        np.maximum.at(row_max, bins, rows[on_dial])
+        np.minimum.at(col_min, bins, cols[on_dial])
+        np.maximum.at(col_max, bins, cols[on_dial])
+
+        # Box to search for a window centred on each whole degree, padded such that
+        # blur then dilation are exact inside the window. None where there is no dial
+        padding = 2 * (FILTER_KERNEL_SIZE // 2)
+        offsets = np.arange(-int(window) - 1, int(window) + 2)
+        windows = (np.arange(360)[:, None] + offsets) % 360
+        self.window_boxes: List[Optional[Tuple[int, int, int, int]]] = [
+            None
+            if row_max[bins].max() < 0
+            else (
+                max(int(row_min[bins].min()) - padding, 0),
+                int(row_max[bins].max()) + 1 + padding,
+                max(int(col_min[bins].min()) - padding, 0),
+                int(col_max[bins].max()) + 1 + padding,
+            )
+            for bins in windows
+        ]
+
+        # Masks of each window, within its box, of where the needle may be and of the
+        # edge margin it mustn't reach. Computed as windows are first searched
+        self.window_masks: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+        self.direction: Optional[float] = None
+        self.area = 0
+        self.lut = np.arange(256, dtype=np.uint8)
+        self.frames_since_equalisation = 0
+        self.num_searches = 0
+        self.num_full_searches = 0
+
+    def reset(self) -> None:
+        """
+        Forget the last needle direction, such that the next search is of the whole dial
+        """
+        self.direction = None
+
+    def track(self, cropped: np.ndarray) -> Optional[float]:
+        """
+        Find the needle angle in an image of the dial
+
+        Args:
+            cropped: Red channel of image, cropped down to just the dial
+
+        Returns:
+            Angle of needle (degrees) as viewed from camera plane, in [0, 360), or None
+            if no needle could be found
+        """
+        lap = self.timers.lap()
+        self.num_searches += 1
+
+        if self.direction is not None:
+            self.frames_since_equalisation += 1
+            if self.frames_since_equalisation >= self.equalisation_period:
+                self._equalise(cropped=cropped)
+            lap.mark("equalize")
+            found = self._search_window(cropped=cropped, lap=lap)
+            if found is not None and found[2] >= self.min_area_fraction * self.area:
+                angle, self.direction, _ = found
+                return angle
+
+        # Do histogram equalisation over the whole dial, as the full detector does
+        self.num_full_searches += 1
+        self._equalise(cropped=cropped)
+        lap.mark("equalize")
+        found = self._search(cropped=cropped, lap=lap, box=(0, None, 0, None))
+        if found is None:
+            self.direction = None
+            return None
+        angle, self.direction, self.area = found
+        return angle
+
+    def _equalise(self, cropped: np.ndarray) -> None:
+        """
+        Compute the histogram equalisation lookup table of an image of the whole dial
+        """
+        self.lut = equalisation_lut(cropped)
+        self.frames_since_equalisation = 0
+
+    def _search_window(
+        self, cropped: np.ndarray, lap: Lap | NullLap
+    ) -> Optional[Tuple[float, float, int]]:
+        """
+        Search the window around the last needle direction
+
+        Returns:
+            Needle angle, direction and area (pixels), or None if the needle may have
+            left the window
+        """
+        degree = int(self.direction)
+        box = self.window_boxes[degree]
+        if box is None:
+            return None
+        if degree not in self.window_masks:
+            # Window centred on the middle of the degree, which the box is padded for
+            directions = self.pixel_directions[slice(*box[:2]), slice(*box[2:])]
+            low, high = degree + 0.5 - self.window, degree + 0.5 + self.window
+            margin = self.edge_margin
+            in_window = angle_range(directions, low, high)
+            inside = angle_range(directions, low + margin, high - margin)
+            self.window_masks[degree] = (
+                in_window,
+                cv2.bitwise_and(in_window, cv2.bitwise_not(inside)),
+            )
+        return self._search(
+            cropped=cropped, lap=lap, box=box, masks=self.window_masks[degree]
+        )
+
+    def _search(
+        self,
+        cropped: np.ndarray,
+        lap: Lap | NullLap,
+        box: Tuple[int, Optional[int], int, Optional[int]],
+        masks: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    ) -> Optional[Tuple[float, float, int]]:
+        """
+        Segment the needle within a box, and find the angle of its centroid
+
+        Args:
+            cropped: Red channel of image, cropped down to just the dial
+            lap: Lap to time stages with
+            box: Rows and columns to search, as (row_min, row_max, col_min, col_max)
+            masks: Masks of the window within the box to keep needle pixels in, and of
+                its edge margin, if any. The search fails if any are in the edge margin
+
+        Returns:
+            Needle angle, direction and area (pixels), or None if no needle was found
+        """
+        rows, cols = slice(*box[:2]), slice(*box[2:])
+
+        # Segment the needle, as the full detector does
+        equ = cv2.LUT(cropped[rows, cols], self.lut)
+        blur = cv2.GaussianBlur(src=equ, ksize=FILTER_KSIZE, sigmaX=0)
+        lap.mark("blur")
+        _, binary = cv2.threshold(
+            src=blur, thresh=NEEDLE_THRESHOLD, maxval=255, type=cv2.THRESH_BINARY
+        )
+        cv2.bitwise_or(binary, self.off_dial[rows, cols], dst=binary)
+        lap.mark("threshold")
+        dilated = cv2.dilate(binary, kernel=DILATION_KERNEL, iterations=1)
+        lap.mark("dilate")
+        needle = cv2.bitwise_not(dilated)
+
+        # Keep needle pixels in the window, failing if the needle reaches its edge
+        if masks is not None:
+            in_window, edge = masks
+            if cv2.countNonZero(cv2.bitwise_and(needle, edge)):
+                lap.mark("centroid")
+                return None
+            cv2.bitwise_and(needle, in_window, dst=needle)
+
+        # Find centre of needle tail, to sub-pixel precision. Needle pixels are all 255,
+        # which is quicker to take moments of than as a binary image
+        moments = cv2.moments(needle)
+        area = round(moments["m00"] / 255)
+        if area == 0:
+            lap.mark("centroid")
+            return None
+        centroid_x = box[2] + moments["m10"] / moments["m00"]
+        centroid_y = box[0] + moments["m01"] / moments["m00"]
+
+        # Get angle of needle relative to centre spindle in camera plane, as the needle
+        # detector does, and its direction from the spindle
+        centre_y, centre_x = float(self.needle_centre[0]), float(self.needle_centre[1])
+        angle = degrees(atan2(centroid_x - centre_y, centroid_y - centre_x)) % 360
+        direction = degrees(atan2(centre_y - centroid_y, centroid_x - centre_x)) % 360
+        lap.mark("centroid")
+        return angle, direction, area
+
+
+def equalisation_lut(image: np.ndarray) -> np.ndarray:
+    """
+    Compute the lookup table cv2.equalizeHist would apply to an image
+
+    Args:
+        image: Grayscale image, as uint8 array
+
+    Returns:
+        Lookup table, as (256,) uint8 array
+    """
+    hist = cv2.calcHist([image], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+
+    # Images of a single value are left as they are
+    darkest = int(np.argmax(hist > 0))
+    remaining = image.size - hist[darkest]
+    if remaining == 0:
+        return np.full(256, darkest, dtype=np.uint8)
+
+    # The cumulative histogram excludes the darkest occupied bin, which maps to zero.
+    # OpenCV scales in single precision, so we do too for identical results
+    cumulative = np.cumsum(hist) - hist[darkest]
+    scale = np.float32(255) / np.float32(remaining)
+    return np.clip(np.rint(cumulative.astype(np.float32) * scale), 0, 255).astype(
+        np.uint8
+    )
+
+
+def angle_range(angles: np.ndarray, low: float, high: float) -> np.ndarray:
+    """
+    Find angles within a range, which may wrap around 360 degrees
+
+    Args:
+        angles: Angles (degrees) in [0, 360), as float32 array
+        low: Lowest angle in range
+        high: Highest angle in range, less than 360 degrees above the lowest
+
+    Returns:
+        255 where angles are in range and 0 elsewhere, as uint8 array
+    """
+    low, high = low % 360, low % 360 + (high - low)
+    in_range = cv2.inRange(angles, low, min(high, 360))
+    if high > 360:
+        cv2.bitwise_or(in_range, cv2.inRange(angles, 0, high - 360), dst=in_range)
+    return in_range
+
+
 def draw_graph(
     pressure_graph: str,
     connection: Serial | None = None,
@@ -486,31 +1150,309 @@ def draw_graph(
         sys.stdout.write(pressure_str)
 
 
-if __name__ == "__main__":
+def terminal_lines(pressure_graph: str, pressure_str: str) -> List[str]:
+    """
+    Lay out graph and status for the terminal, as drawn by `draw_graph`
+
+    Returns:
+        Lines to show on terminal, from the top of the screen
+    """
+    return (
+        [""] * 4
+        + pressure_graph.split("\n")
+        + [field.strip("\r") for field in pressure_str.split("\t")]
+    )
+
+
+def draw_terminal(
+    pressure_graph: str,
+    pressure_str: str,
+    connection: Serial,
+    screen: Vt52Screen,
+) -> None:
+    """
+    Draw graph and status to terminal, sending only what has changed since last draw
+
+    Args:
+        pressure_graph: Rendered pressure graph
+        pressure_str: Status line, with fields separated by tabs
+        connection: Serial connection to terminal
+        screen: Model of what is on the terminal's screen
+    """
+    connection.write(
+        screen.frame(
+            terminal_lines(pressure_graph=pressure_graph, pressure_str=pressure_str)
+        )
+    )
+
+
+def draw_stdout(pressure_str: str, pressure_graph: str | None = None) -> None:
+    """
+    Draw status line to screen, redrawing the graph above it first if given
+    """
+    if pressure_graph is not None:
+        draw_graph(pressure_graph=pressure_graph)
+    sys.stdout.write(pressure_str)
+    sys.stdout.flush()
+
+
+app = typer.Typer(add_completion=False)
+
+
+@app.callback(invoke_without_command=True)
+def main(ctx: typer.Context) -> None:
+    """
+    Read pressure from flair and provide a timer
+
+    Runs the live pressure graph and shot timer if no command is given
+    """
+    if ctx.invoked_subcommand is None:
+        live()
+
+
+@app.command()
+def live(
+    terminal_device: str = TERMINAL_DEVICE,
+    learned: bool = typer.Option(
+        False, help="Read the gauge with the learned model, not the needle detector"
+    ),
+    model_path: str = typer.Option(LEARNED_MODEL_PATH, help="Learned model to use"),
+    tracking: bool = typer.Option(
+        False, help="Search for the needle near where it was last seen"
+    ),
+    recipe: Optional[str] = typer.Option(None, help="Recipe, saved with the shot"),
+    grind: Optional[float] = typer.Option(
+        None, help="Grind setting, saved with the shot"
+    ),
+    shot_database: str = typer.Option(
+        SHOT_DATABASE_PATH, help="Shot history to save the shot to"
+    ),
+    filters: str = typer.Option(
+        PRESSURE_FILTERS,
+        help="Filters to smooth pressures with, e.g. outlier:7,median:3,ewma:0.2",
+    ),
+) -> None:
+    """
+    Show the live pressure graph and shot timer on stdout and the serial terminal
+    """
+    # Print the graph nicely one last time upon ctrl-c
+    signal.signal(signal.SIGINT, signal_handler)
+
     pressure_monitor = FlairPressure()
+    if learned:
+        pressure_monitor.load_learned_model(model_path=model_path)
 
-    # pressure_monitor.collect_data(output_directory="/tmp/flair_pressure_logs_2", interval=0.01)
+    # pressure_monitor.collect_data(
+    #     output_directory="/tmp/flair_pressure_logs_2", interval=0.01
+    # )
 
     # pressure_monitor.detect_needle_position(
     #     img=pressure_monitor.capture_frame(),
     # )
 
-    global terminal_conection
-    with Serial("/dev/ttyUSB0", baudrate=19200) as conn:
+    global terminal_connection
+    with Serial(terminal_device, baudrate=TERMINAL_BAUDRATE) as conn:
         terminal_connection = conn
 
         # Run the pressure graph main application loop
-        pressure_monitor.cli_main(terminal_connection=conn)
-
-    # paths = list(Path("/home/pi/src/hq/etc/flair_pressure/datasets/regression").iterdir())
-    # # shuffle(paths)
-    # # for path in paths:
-    # for i in range(106, 400):
-    #     # print(path)
-    #     print(i)
-    #     # img = cv2.imread(str(path))
-    #     img = cv2.imread(f"/home/pi/src/hq/etc/flair_pressure/datasets/regression/{i}.jpg")
-    #     print(pressure_monitor.detect_needle_position(img=img))
-    #     input()
+        pressure_monitor.cli_main(
+            terminal_connection=conn,
+            learned=learned,
+            tracking=tracking,
+            recipe=recipe,
+            grind=grind,
+            shot_database=shot_database,
+            filters=filters,
+        )
 
-    sys.exit(0)
+
+@app.command()
+def replay(
+    inputs: List[Path] = typer.Argument(
+        ..., help="Directories of numbered frames, or video files, one per shot"
+    ),
+    shots_output: Path = typer.Option(
+        "shots.csv", help="Shot summaries, as .csv or .parquet"
+    ),
+    frames_output: Optional[Path] = typer.Option(
+        None, help="Per-frame pressures, as .csv or .parquet"
+    ),
+    frame_period: Optional[float] = typer.Option(
+        None,
+        help="Seconds between frames. Taken from file modification times or video "
+        "frame rate if not given",
+    ),
+    workers: int = typer.Option(os.cpu_count(), help="Number of decoder threads"),
+    filters: str = typer.Option(
+        PRESSURE_FILTERS, help="Filters to smooth pressures with"
+    ),
+) -> None:
+    """
+    Replay recorded shots through the needle detector and shot timer at full speed
+    """
+    # Imported here as the replay module imports this one
+    from hq.hardware.flair_replay import replay_shots
+
+    replay_shots(
+        inputs=inputs,
+        shots_output=shots_output,
+        frames_output=frames_output,
+        frame_period=frame_period,
+        workers=workers,
+        filters=filters,
+    )
+
+
+@app.command()
+def detect(
+    inputs: List[Path] = typer.Argument(
+        ..., help="Images, or directories of numbered frames"
+    ),
+    output: Path = typer.Option(
+        "pressures.csv", help="Pressure of each image, as .csv or .parquet"
+    ),
+    workers: int = typer.Option(os.cpu_count(), help="Number of worker processes"),
+    chunk_size: int = typer.Option(64, help="Images given to a worker at a time"),
+) -> None:
+    """
+    Detect the needle in a dataset of images, spread across a pool of processes
+    """
+    # Imported here as the replay module imports this one
+    from hq.hardware.flair_replay import detect_images
+
+    detect_images(
+        inputs=inputs, output_path=output, workers=workers, chunk_size=chunk_size
+    )
+
+
+@app.command()
+def filters(
+    inputs: List[Path] = typer.Argument(
+        ..., help="Per-frame pressures written by replay, as .csv or .parquet"
+    ),
+    specs: List[str] = typer.Option(
+        [
+            PRESSURE_FILTERS,
+            "median:5",
+            "kalman",
+            "outlier:7,ewma:0.2",
+            "outlier:7,median:3,ewma:0.3",
+            "outlier:7,kalman",
+        ],
+        "--spec",
+        help="Filter chain to compare, may be given more than once",
+    ),
+    repeats: int = typer.Option(5, help="Runs over the traces, for timing"),
+) -> None:
+    """
+    Compare the latency and CPU cost of pressure filters on recorded shots
+    """
+    # Imported here as the replay module imports this one
+    from hq.hardware.flair_replay import benchmark_filters
+
+    benchmark_filters(inputs=inputs, specs=specs, repeats=repeats)
+
+
+@app.command()
+def bench(
+    frames: int = typer.Option(500, help="Number of synthetic frames"),
+    noise: int = typer.Option(40, help="Amplitude of noise added to each pixel"),
+    seed: int = typer.Option(0, help="Random seed of frames"),
+    repeats: int = typer.Option(3, help="Runs over the frames, taking the fastest"),
+    mask_path: str = typer.Option(DIAL_MASK_PATH, help="Segmentation mask of dial"),
+    threads: Optional[int] = typer.Option(None, help="Threads OpenCV may use"),
+    optimized: bool = typer.Option(True, help="Let OpenCV use SIMD code paths"),
+    output: Optional[Path] = typer.Option(None, help="Also write results as JSON"),
+) -> None:
+    """
+    Benchmark the needle detectors on synthetic gauge images, without a camera
+    """
+    # Imported here as the benchmark module imports this one
+    from hq.hardware.flair_benchmark import print_results, run_benchmark
+
+    results = run_benchmark(
+        num_frames=frames,
+        noise=noise,
+        seed=seed,
+        repeats=repeats,
+        mask_path=mask_path,
+        num_threads=threads,
+        optimized=optimized,
+    )
+    print_results(results)
+    if output is not None:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+shots_app = typer.Typer(add_completion=False, help="Query the shot history")
+app.add_typer(shots_app, name="shots")
+
+
+def shots_since(days: Optional[float]) -> Optional[float]:
+    """
+    Start of a period ending now
+
+    Args:
+        days: Length of period (days), or None for all time
+
+    Returns:
+        Start of period (seconds since the epoch), or None for all time
+    """
+    return None if days is None else time() - days * 24 * 60 * 60
+
+
+@shots_app.command()
+def best(
+    days: Optional[float] = typer.Option(7, help="Only shots from the last N days"),
+    recipe: Optional[str] = typer.Option(None, help="Only shots of this recipe"),
+    grind: Optional[float] = typer.Option(None, help="Only shots at this grind"),
+    limit: int = typer.Option(5, help="Number of shots to show"),
+    shot_database: str = typer.Option(SHOT_DATABASE_PATH, help="Shot history"),
+) -> None:
+    """
+    Show the shots with the highest impulse
+    """
+    store = ShotStore(path=shot_database)
+    shots = store.best_shots(
+        since=shots_since(days), recipe=recipe, grind=grind, limit=limit
+    )
+    store.close()
+    for shot in shots:
+        started_at = datetime.fromtimestamp(shot["started_at"])
+        print(
+            f"{shot['id']:>6}  {started_at:%Y-%m-%d %H:%M}  "
+            f"{shot['recipe'] or '-':<12}  "
+            f"grind {shot['grind'] if shot['grind'] is not None else '-':<6}  "
+            f"impulse {shot['impulse']:6.2f} bar seconds  "
+            f"shot {shot['shot_duration']:5.2f} s  "
+            f"pre-infuse {shot['pre_infuse_duration']:5.2f} s  "
+            f"peak {shot['peak_pressure']:5.2f} bar"
+        )
+
+
+@shots_app.command()
+def grinds(
+    days: Optional[float] = typer.Option(None, help="Only shots from the last N days"),
+    recipe: Optional[str] = typer.Option(None, help="Only shots of this recipe"),
+    grind: Optional[float] = typer.Option(None, help="Only shots at this grind"),
+    shot_database: str = typer.Option(SHOT_DATABASE_PATH, help="Shot history"),
+) -> None:
+    """
+    Show mean pre-infuse duration, shot duration and impulse at each grind setting
+    """
+    store = ShotStore(path=shot_database)
+    stats = store.grind_stats(since=shots_since(days), recipe=recipe, grind=grind)
+    store.close()
+    for row in stats:
+        print(
+            f"grind {row['grind'] if row['grind'] is not None else '-':<6}  "
+            f"{row['num_shots']:>5} shots  "
+            f"pre-infuse {row['pre_infuse_duration']:5.2f} s  "
+            f"shot {row['shot_duration']:5.2f} s  "
+            f"impulse {row['impulse']:6.2f} bar seconds"
+        )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+
+
+"""
+Replay recorded shots and datasets through the flair pressure reader, as fast as the
+CPU allows
+
+Shots are directories of numbered frames, as written by `FlairPressure.collect_data`,
+or video files. Per-frame pressures of replayed shots can in turn be replayed through
+pressure filters, to compare them
+"""
+
+
+import csv
+import sys
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter, perf_counter_ns, process_time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from hq.hardware.flair_filters import FilterChain
+from hq.hardware.flair_pressure import (
+    DIAL_MASK_PATH,
+    PRESSURE_FILTERS,
+    FlairPressure,
+    ShotTimer,
+)
+
+
+# Decoded frames kept ready ahead of the detector, per decoder thread
+PREFETCH_PER_WORKER = 4
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+
+# Width of centred median taken as the true gauge pressure when benchmarking filters
+FILTER_LAG_MEDIAN_SIZE = 5
+
+# Needle detector for each worker process of a dataset detection pool
+_worker_pressure_monitor: Optional[FlairPressure] = None
+
+
+def prefetched(
+    pool: Executor, tasks: Iterable[Callable[[], Any]], depth: int
+) -> Iterator[Any]:
+    """
+    Run tasks on a pool ahead of when their results are needed, yielding results in
+    order
+
+    Args:
+        pool: Pool to run tasks on
+        tasks: Functions to call
+        depth: Maximum number of tasks submitted but not yet yielded
+
+    Yields:
+        Result of each task
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.submit(task))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def frame_paths(directory: Path) -> List[Path]:
+    """
+    Find numbered frames in a directory, ignoring any other files alongside them
+
+    Args:
+        directory: Directory of frames named by number, e.g. 1.jpg, 2.jpg, ...
+
+    Returns:
+        Paths to frames, in order
+    """
+    return sorted(
+        (
+            path
+            for path in directory.iterdir()
+            if path.stem.isdigit() and path.suffix.lower() in IMAGE_SUFFIXES
+        ),
+        key=lambda path: int(path.stem),
+    )
+
+
+def read_directory(
+    directory: Path, frame_period: Optional[float], workers: int
+) -> Iterator[Tuple[float, Optional[np.ndarray]]]:
+    """
+    Decode numbered frames from a directory on a pool of threads
+
+    Args:
+        directory: Directory of frames named by number
+        frame_period: Seconds between frames. Taken from file modification times if None
+        workers: Number of decoder threads
+
+    Yields:
+        Capture time (seconds since first frame) and frame, None if it couldn't be read
+    """
+    paths = frame_paths(directory)
+    if frame_period is None:
+        mtimes = [path.stat().st_mtime for path in paths]
+        times = [mtime - mtimes[0] for mtime in mtimes]
+    else:
+        times = [i * frame_period for i in range(len(paths))]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = prefetched(
+            pool=pool,
+            tasks=(lambda path=path: cv2.imread(str(path)) for path in paths),
+            depth=workers * PREFETCH_PER_WORKER,
+        )
+        yield from zip(times, frames)
+
+
+def read_video(
+    video_path: Path, frame_period: Optional[float]
+) -> Iterator[Tuple[float, Optional[np.ndarray]]]:
+    """
+    Decode frames from a video file on a background thread
+
+    Args:
+        video_path: Path to video file
+        frame_period: Seconds between frames. Taken from video frame rate if None
+
+    Yields:
+        Capture time (seconds since first frame) and frame
+    """
+    vid = cv2.VideoCapture(str(video_path))
+    if not vid.isOpened():
+        raise ValueError(f"Could not open video at {video_path}")
+    if frame_period is None:
+        fps = vid.get(cv2.CAP_PROP_FPS)
+        if not fps:
+            raise ValueError(
+                f"Unknown frame rate for {video_path}, give a frame period"
+            )
+        frame_period = 1 / fps
+
+    def read() -> Optional[np.ndarray]:
+        success, frame = vid.read()
+        return frame if success else None
+
+    def reads() -> Iterator[Callable[[], Optional[np.ndarray]]]:
+        while True:
+            yield read
+
+    # Reads must happen in order, so use a single decoder thread
+    try:
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            for i, frame in enumerate(
+                prefetched(pool=pool, tasks=reads(), depth=PREFETCH_PER_WORKER)
+            ):
+                if frame is None:
+                    break
+                yield i * frame_period, frame
+    finally:
+        vid.release()
+
+
+def read_frames(
+    source: Path, frame_period: Optional[float], workers: int
+) -> Iterator[Tuple[float, Optional[np.ndarray]]]:
+    """
+    Decode frames from a directory of numbered frames or a video file
+
+    Args:
+        source: Directory or video file
+        frame_period: Seconds between frames, inferred from the source if None
+        workers: Number of decoder threads for directories
+
+    Yields:
+        Capture time (seconds since first frame) and frame, None if it couldn't be read
+    """
+    if source.is_dir():
+        return read_directory(
+            directory=source, frame_period=frame_period, workers=workers
+        )
+    return read_video(video_path=source, frame_period=frame_period)
+
+
+def batched(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """
+    Split an iterable into lists of at most the given size
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def replay_shot(
+    pressure_monitor: FlairPressure,
+    source: Path,
+    frame_period: Optional[float],
+    workers: int,
+    filters: str = PRESSURE_FILTERS,
+) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """
+    Replay one recorded shot through the needle detector and shot timer
+
+    Args:
+        pressure_monitor: Needle detector
+        source: Directory of numbered frames or video file
+        frame_period: Seconds between frames, inferred from the source if None
+        workers: Number of decoder threads for directories
+        filters: Filters to smooth pressures with, see `FilterChain.parse`
+
+    Returns:
+        Per-frame results as columns, and shot summary
+    """
+    shot_timer = ShotTimer(filters=FilterChain.parse(filters))
+    times, raw_pressures, pressures = [], [], []
+    start = perf_counter()
+
+    for capture_time, img in read_frames(
+        source=source, frame_period=frame_period, workers=workers
+    ):
+        # Detect needle in each readable frame, and feed the shot timer in order
+        raw_pressure = (
+            None if img is None else pressure_monitor.detect_needle_position(img=img)
+        )
+        pressure = shot_timer.update(
+            raw_pressure=raw_pressure, capture_time=capture_time
+        )
+        times.append(capture_time)
+        raw_pressures.append(np.nan if raw_pressure is None else raw_pressure)
+        pressures.append(np.nan if pressure is None else pressure)
+
+    num_frames = len(times)
+    elapsed = perf_counter() - start
+    print(
+        f"{source}: {num_frames} frames in {elapsed:.2f} seconds "
+        f"({num_frames / max(elapsed, 1e-9):.0f} frames/second)",
+        file=sys.stderr,
+    )
+
+    frames = {
+        "source": np.full(num_frames, str(source)),
+        "frame": np.arange(num_frames),
+        "time": np.array(times),
+        "raw_pressure": np.array(raw_pressures),
+        "pressure": np.array(pressures),
+    }
+    summary = {
+        "source": str(source),
+        "num_frames": num_frames,
+        "dropped_frames": int(np.isnan(frames["raw_pressure"]).sum()),
+        "duration": times[-1] if times else 0.0,
+        "pre_infuse_duration": shot_timer.pre_infuse_duration,
+        "shot_duration": shot_timer.shot_duration,
+        "impulse": shot_timer.impulse,
+        "peak_pressure": shot_timer.peak_pressure,
+    }
+    return frames, summary
+
+
+def write_table(columns: Dict[str, Any], output_path: Path) -> None:
+    """
+    Write columns of equal length to a table file
+
+    Args:
+        columns: Column names and values
+        output_path: Path to .csv or .parquet file
+    """
+    match output_path.suffix.lower():
+
+        case ".csv":
+            with open(output_path, mode="w", encoding="utf-8", newline="") as csv_fp:
+                writer = csv.writer(csv_fp)
+                writer.writerow(columns.keys())
+                writer.writerows(zip(*columns.values()))
+
+        case ".parquet":
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError as error:
+                raise ValueError("Writing parquet files requires pyarrow") from error
+            pyarrow.parquet.write_table(
+                pyarrow.table({name: list(values) for name, values in columns.items()}),
+                output_path,
+            )
+
+        case _:
+            raise ValueError(f"Unsupported file type: {output_path}")
+
+
+def read_table(input_path: Path) -> Dict[str, np.ndarray]:
+    """
+    Read the columns of a table file, as written by `write_table`
+
+    Args:
+        input_path: Path to .csv or .parquet file
+
+    Returns:
+        Column names and values
+    """
+    match input_path.suffix.lower():
+
+        case ".csv":
+            with open(input_path, mode="r", encoding="utf-8", newline="") as csv_fp:
+                reader = csv.reader(csv_fp)
+                names = next(reader)
+                rows = list(reader)
+            columns = {}
+            for name, values in zip(names, zip(*rows) if rows else [()] * len(names)):
+                try:
+                    columns[name] = np.array(values, dtype=float)
+                except ValueError:
+                    columns[name] = np.array(values)
+            return columns
+
+        case ".parquet":
+            try:
+                import pyarrow.parquet
+            except ImportError as error:
+                raise ValueError("Reading parquet files requires pyarrow") from error
+            table = pyarrow.parquet.read_table(input_path)
+            return {name: table[name].to_numpy() for name in table.column_names}
+
+        case _:
+            raise ValueError(f"Unsupported file type: {input_path}")
+
+
+def replay_shots(
+    inputs: List[Path],
+    shots_output: Path,
+    frames_output: Optional[Path] = None,
+    frame_period: Optional[float] = None,
+    workers: int = 1,
+    filters: str = PRESSURE_FILTERS,
+) -> None:
+    """
+    Replay recorded shots and write per-frame pressures and shot summaries
+
+    Args:
+        inputs: Directories of numbered frames or video files, one per shot
+        shots_output: Path to write shot summaries to, as .csv or .parquet
+        frames_output: Path to write per-frame pressures to, as .csv or .parquet
+        frame_period: Seconds between frames, inferred from each input if None
+        workers: Number of decoder threads
+        filters: Filters to smooth pressures with, see `FilterChain.parse`
+    """
+    pressure_monitor = FlairPressure()
+    frames, summaries = [], []
+    for source in inputs:
+        shot_frames, summary = replay_shot(
+            pressure_monitor=pressure_monitor,
+            source=source,
+            frame_period=frame_period,
+            workers=workers,
+            filters=filters,
+        )
+        frames.append(shot_frames)
+        summaries.append(summary)
+
+    write_table(
+        columns={key: [summary[key] for summary in summaries] for key in summaries[0]},
+        output_path=shots_output,
+    )
+    if frames_output is not None:
+        write_table(
+            columns={
+                key: np.concatenate([shot[key] for shot in frames]) for key in frames[0]
+            },
+            output_path=frames_output,
+        )
+
+
+def _init_detection_worker(mask_path: str) -> None:
+    """
+    Construct the needle detector once per worker process
+    """
+    global _worker_pressure_monitor
+
+    # Parallelism comes from the pool, so stop OpenCV oversubscribing cores
+    cv2.setNumThreads(1)
+    _worker_pressure_monitor = FlairPressure(mask_path=mask_path)
+
+
+def _detect_chunk(paths: List[Path]) -> np.ndarray:
+    """
+    Decode a chunk of images and detect the needle in them, in a worker process
+
+    Args:
+        paths: Paths to images
+
+    Returns:
+        Pressure (bar) of each image, NaN where it couldn't be read or detected
+    """
+    pressures = np.full(len(paths), np.nan)
+    for i, path in enumerate(paths):
+        img = cv2.imread(str(path))
+        if img is None:
+            continue
+        pressure = _worker_pressure_monitor.detect_needle_position(img=img)
+        if pressure is not None:
+            pressures[i] = pressure
+    return pressures
+
+
+def image_paths(inputs: List[Path]) -> List[Path]:
+    """
+    Expand directories of numbered frames into their frames, in order
+
+    Args:
+        inputs: Image files and directories of numbered frames
+
+    Returns:
+        Paths to images
+    """
+    paths = []
+    for path in inputs:
+        paths.extend(frame_paths(path) if path.is_dir() else [path])
+    return paths
+
+
+def detect_dataset(
+    paths: List[Path], workers: int, chunk_size: int, mask_path: str = DIAL_MASK_PATH
+) -> Iterator[Tuple[Path, float]]:
+    """
+    Detect the needle in many images, spread across a pool of processes
+
+    Images are handed to workers in chunks, to amortise inter-process overhead, and
+    results are merged back in order
+
+    Args:
+        paths: Paths to images
+        workers: Number of worker processes
+        chunk_size: Number of images given to a worker at a time
+        mask_path: Path to segmentation mask of dial
+
+    Yields:
+        Path and pressure (bar) of each image, NaN where it couldn't be read or detected
+    """
+    chunks = list(batched(paths, size=chunk_size))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_detection_worker,
+        initargs=(mask_path,),
+    ) as pool:
+        for chunk, pressures in zip(chunks, pool.map(_detect_chunk, chunks)):
+            yield from zip(chunk, pressures)
+
+
+def detect_images(
+    inputs: List[Path], output_path: Path, workers: int, chunk_size: int
+) -> None:
+    """
+    Detect the needle in many images and write the pressures to a table
+
+    Args:
+        inputs: Image files and directories of numbered frames
+        output_path: Path to write pressures to, as .csv or .parquet
+        workers: Number of worker processes
+        chunk_size: Number of images given to a worker at a time
+    """
+    paths = image_paths(inputs=inputs)
+    start = perf_counter()
+    results = list(detect_dataset(paths=paths, workers=workers, chunk_size=chunk_size))
+    elapsed = perf_counter() - start
+    print(
+        f"{len(paths)} images in {elapsed:.2f} seconds "
+        f"({len(paths) / max(elapsed, 1e-9):.0f} images/second)",
+        file=sys.stderr,
+    )
+    write_table(
+        columns={
+            "path": [str(path) for path, _ in results],
+            "pressure": [pressure for _, pressure in results],
+        },
+        output_path=output_path,
+    )
+
+
+def read_traces(inputs: List[Path]) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read the raw pressure trace of each shot in per-frame tables written by replay
+
+    Args:
+        inputs: Per-frame tables, as .csv or .parquet
+
+    Returns:
+        Capture times and raw pressures (NaN where unread) of each shot
+    """
+    traces = []
+    for input_path in inputs:
+        frames = read_table(input_path=input_path)
+        sources = frames["source"]
+        for source in dict.fromkeys(sources):
+            shot = sources == source
+            traces.append((frames["time"][shot], frames["raw_pressure"][shot]))
+    return traces
+
+
+def filter_lag(
+    times: np.ndarray, raw: np.ndarray, filtered: np.ndarray
+) -> Optional[float]:
+    """
+    Estimate how far filtered pressures lag behind the gauge as a shot ramps up
+
+    The rising edge is where pressure first crosses half its peak. The gauge is taken to
+    be the raw pressures with a centred (so undelayed) median, to ignore spikes
+
+    Args:
+        times: Capture time of each frame (seconds)
+        raw: Raw pressures, NaN where missing
+        filtered: Filtered pressures, NaN where missing or rejected
+
+    Returns:
+        Lag (seconds), or None if either never crosses half the peak
+    """
+    valid = ~np.isnan(raw)
+    if valid.sum() < FILTER_LAG_MEDIAN_SIZE:
+        return None
+    reference = np.median(
+        np.lib.stride_tricks.sliding_window_view(raw[valid], FILTER_LAG_MEDIAN_SIZE),
+        axis=1,
+    )
+    reference_times = times[valid][FILTER_LAG_MEDIAN_SIZE // 2 :][: len(reference)]
+    half_peak = reference.max() / 2
+    crossed = np.flatnonzero(reference > half_peak)
+    filtered_crossed = np.flatnonzero(np.nan_to_num(filtered) > half_peak)
+    if not len(crossed) or not len(filtered_crossed):
+        return None
+    return float(times[filtered_crossed[0]] - reference_times[crossed[0]])
+
+
+def benchmark_filters(inputs: List[Path], specs: List[str], repeats: int = 5) -> None:
+    """
+    Compare the cost and effect of filter chains over recorded pressure traces
+
+    Each chain is run over the raw pressures of every shot, as the live loop would run
+    it, timing each sample. Reports per-sample wall time percentiles and CPU time,
+    how far behind the gauge the output lags as the shot ramps up (see `filter_lag`),
+    its noise (RMS change between samples, bar), and how many samples are missing or
+    rejected
+
+    Args:
+        inputs: Per-frame tables written by replay, as .csv or .parquet
+        specs: Filter chains to compare, see `FilterChain.parse`
+        repeats: Number of times to run each chain over the traces, for timing
+    """
+    traces = read_traces(inputs=inputs)
+    num_samples = sum(len(times) for times, _ in traces)
+    frame_period = float(
+        np.median(np.concatenate([np.diff(times) for times, _ in traces]))
+    )
+    print(
+        f"{len(traces)} shots, {num_samples} samples, "
+        f"{frame_period * 1000:.1f} ms between frames"
+    )
+    print(
+        f"{'filters':<32} {'p50 us':>8} {'p99 us':>8} {'CPU us':>8} "
+        f"{'lag ms':>8} {'noise':>8} {'dropped':>8}"
+    )
+
+    for spec in specs:
+        durations = np.empty(num_samples * repeats, dtype=np.int64)
+        lags, noise, num_dropped = [], [], 0
+        cpu_start = process_time()
+        i = 0
+        for repeat in range(repeats):
+            for times, raw_pressures in traces:
+                chain = FilterChain.parse(spec)
+                filtered = np.full(len(times), np.nan)
+                for j, (capture_time, raw_pressure) in enumerate(
+                    zip(times.tolist(), raw_pressures.tolist())
+                ):
+                    value = None if raw_pressure != raw_pressure else raw_pressure
+                    start = perf_counter_ns()
+                    pressure = chain.update(value, capture_time)
+                    durations[i] = perf_counter_ns() - start
+                    i += 1
+                    if pressure is not None:
+                        filtered[j] = pressure
+                if repeat == 0:
+                    valid = filtered[~np.isnan(filtered)]
+                    lag = filter_lag(times, raw_pressures, filtered)
+                    if lag is not None:
+                        lags.append(lag)
+                    noise.append(np.diff(valid))
+                    num_dropped += len(filtered) - len(valid)
+        cpu_time = process_time() - cpu_start
+
+        p50, p99 = np.percentile(durations, (50, 99)) / 1000
+        print(
+            f"{spec or '(none)':<32} {p50:8.2f} {p99:8.2f} "
+            f"{cpu_time / (num_samples * repeats) * 1e6:8.2f} "
+            f"{np.mean(lags) * 1000 if lags else np.nan:8.1f} "
+            f"{np.sqrt(np.mean(np.concatenate(noise) ** 2)):8.3f} "
+            f"{num_dropped / num_samples:8.1%}"
+        )
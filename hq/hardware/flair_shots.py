@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+
+"""
+Shot history for the flair pressure reader, kept in an append-only SQLite database
+
+Shot summaries are indexed by start time, recipe and grind, and pressure traces are kept
+in their own table, such that queries over summaries stay fast however many shots there
+are. Shots are written from a background thread, so the live loop never waits on disk
+"""
+
+
+import os
+import sqlite3
+from queue import Queue
+from threading import Thread
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+SHOT_DATABASE_PATH = os.path.expanduser("~/.local/share/hq/flair_shots.db")
+
+# How long to wait for queued shots to be written when closing (seconds)
+SHOT_WRITER_TIMEOUT = 5.0
+
+# Summary columns, as in replayed shot summaries
+SHOT_COLUMNS = (
+    "started_at",
+    "recipe",
+    "grind",
+    "pre_infuse_duration",
+    "shot_duration",
+    "impulse",
+    "peak_pressure",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shots (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    recipe TEXT,
+    grind REAL,
+    pre_infuse_duration REAL NOT NULL,
+    shot_duration REAL NOT NULL,
+    impulse REAL NOT NULL,
+    peak_pressure REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS shots_started_at ON shots (started_at);
+CREATE INDEX IF NOT EXISTS shots_recipe ON shots (recipe, started_at);
+CREATE INDEX IF NOT EXISTS shots_grind ON shots (grind, started_at);
+CREATE TABLE IF NOT EXISTS traces (
+    shot_id INTEGER PRIMARY KEY REFERENCES shots (id),
+    times BLOB NOT NULL,
+    pressures BLOB NOT NULL
+);
+"""
+
+
+class ShotStore:
+    """
+    Append-only store of shot summaries and pressure traces
+
+    A store may only be used from the thread that opened it
+    """
+
+    def __init__(self, path: str = SHOT_DATABASE_PATH) -> None:
+        """
+        Open the database, creating it if need be
+
+        Args:
+            path: Path to SQLite database
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+
+        # Write ahead logging lets queries run while the live loop is adding shots
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def add(
+        self, summary: Dict[str, Any], times: np.ndarray, pressures: np.ndarray
+    ) -> int:
+        """
+        Add a shot
+
+        Args:
+            summary: Value of each of `SHOT_COLUMNS`. Start time is seconds since the
+                epoch, recipe and grind may be None
+            times: Time of each pressure in trace, seconds since start of shot
+            pressures: Smoothed pressure (bar) of trace
+
+        Returns:
+            ID of shot
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                f"INSERT INTO shots ({', '.join(SHOT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(SHOT_COLUMNS))})",
+                [summary[column] for column in SHOT_COLUMNS],
+            )
+            self.connection.execute(
+                "INSERT INTO traces (shot_id, times, pressures) VALUES (?, ?, ?)",
+                (
+                    cursor.lastrowid,
+                    np.asarray(times, dtype=np.float32).tobytes(),
+                    np.asarray(pressures, dtype=np.float32).tobytes(),
+                ),
+            )
+        return cursor.lastrowid
+
+    @staticmethod
+    def _filters(
+        since: Optional[float], recipe: Optional[str], grind: Optional[float]
+    ) -> Tuple[str, List[Any]]:
+        """
+        Build a WHERE clause selecting shots
+
+        Returns:
+            Clause, empty if there are no filters, and its parameters
+        """
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append("started_at >= ?")
+            parameters.append(since)
+        if recipe is not None:
+            conditions.append("recipe = ?")
+            parameters.append(recipe)
+        if grind is not None:
+            conditions.append("grind = ?")
+            parameters.append(grind)
+        clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return clause, parameters
+
+    def best_shots(
+        self,
+        since: Optional[float] = None,
+        recipe: Optional[str] = None,
+        grind: Optional[float] = None,
+        limit: int = 10,
+    ) -> List[Dict[str, Any]]:
+        """
+        Find the shots with the highest impulse
+
+        Args:
+            since: Only shots started at or after this time (seconds since the epoch)
+            recipe: Only shots of this recipe
+            grind: Only shots at this grind setting
+            limit: Maximum number of shots to return
+
+        Returns:
+            Summary of each shot, with its ID, highest impulse first
+        """
+        clause, parameters = self._filters(since=since, recipe=recipe, grind=grind)
+        rows = self.connection.execute(
+            f"SELECT id, {', '.join(SHOT_COLUMNS)} FROM shots {clause} "
+            f"ORDER BY impulse DESC LIMIT ?",
+            parameters + [limit],
+        )
+        return [dict(row) for row in rows]
+
+    def grind_stats(
+        self,
+        since: Optional[float] = None,
+        recipe: Optional[str] = None,
+        grind: Optional[float] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Average shot summaries over each grind setting
+
+        Args:
+            since: Only shots started at or after this time (seconds since the epoch)
+            recipe: Only shots of this recipe
+            grind: Only shots at this grind setting
+
+        Returns:
+            Number of shots, and mean pre-infuse duration, shot duration and impulse, at
+            each grind setting, in order of grind
+        """
+        clause, parameters = self._filters(since=since, recipe=recipe, grind=grind)
+        rows = self.connection.execute(
+            f"SELECT grind, COUNT(*) AS num_shots, "
+            f"AVG(pre_infuse_duration) AS pre_infuse_duration, "
+            f"AVG(shot_duration) AS shot_duration, AVG(impulse) AS impulse "
+            f"FROM shots {clause} GROUP BY grind ORDER BY grind",
+            parameters,
+        )
+        return [dict(row) for row in rows]
+
+    def trace(self, shot_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Load the pressure trace of a shot
+
+        Args:
+            shot_id: ID of shot
+
+        Returns:
+            Times (seconds since start of shot) and pressures (bar)
+        """
+        row = self.connection.execute(
+            "SELECT times, pressures FROM traces WHERE shot_id = ?", (shot_id,)
+        ).fetchone()
+        if row is None:
+            raise ValueError(f"No shot with ID {shot_id}")
+        return (
+            np.frombuffer(row["times"], dtype=np.float32),
+            np.frombuffer(row["pressures"], dtype=np.float32),
+        )
+
+    def close(self) -> None:
+        """
+        Close the database
+        """
+        self.connection.close()
+
+
+class ShotWriter(Thread):
+    """
+    Background thread that adds shots to a store, in the order they were submitted
+    """
+
+    def __init__(self, path: str = SHOT_DATABASE_PATH) -> None:
+        """
+        Construct the writer. The database is opened by the writer thread once started
+
+        Args:
+            path: Path to SQLite database
+        """
+        super().__init__(name="shot-writer", daemon=True)
+        self.path = path
+        self.shots: Queue = Queue()
+
+    def submit(
+        self, summary: Dict[str, Any], times: np.ndarray, pressures: np.ndarray
+    ) -> None:
+        """
+        Queue a shot to be added, see `ShotStore.add`
+        """
+        self.shots.put((summary, times, pressures))
+
+    def run(self) -> None:
+        """
+        Add shots until closed
+        """
+        store = ShotStore(path=self.path)
+        try:
+            while (shot := self.shots.get()) is not None:
+                store.add(*shot)
+        finally:
+            store.close()
+
+    def close(self, timeout: float = SHOT_WRITER_TIMEOUT) -> None:
+        """
+        Stop the writer once it has added every shot submitted so far
+
+        Args:
+            timeout: Longest to wait for queued shots to be written (seconds)
+        """
+        self.shots.put(None)
+        self.join(timeout=timeout)
+
+
+class ShotRecorder:
+    """
+    Collects the pressure trace of the shot being timed, and submits the shot to a
+    writer once, when the shot timer sees it finish or when recording stops
+
+    The shot timer is a `flair_pressure.ShotTimer`
+    """
+
+    def __init__(
+        self,
+        writer: ShotWriter,
+        shot_timer: Any,
+        start: float,
+        recipe: Optional[str] = None,
+        grind: Optional[float] = None,
+    ) -> None:
+        """
+        Construct the recorder
+
+        Args:
+            writer: Writer to submit the shot to
+            shot_timer: Shot timer pressures are smoothed by
+            start: Time capture times are measured from (seconds since the epoch)
+            recipe: Recipe being pulled, if known
+            grind: Grind setting, if known
+        """
+        self.writer = writer
+        self.shot_timer = shot_timer
+        self.start = start
+        self.recipe = recipe
+        self.grind = grind
+        self.times: List[float] = []
+        self.pressures: List[float] = []
+        self.saved = False
+
+    def update(self, pressure: float, capture_time: float) -> None:
+        """
+        Add a smoothed pressure to the trace, if a shot is being timed
+
+        Args:
+            pressure: Smoothed pressure (bar), as returned by the shot timer
+            capture_time: Time the reading was captured (seconds since start)
+        """
+        if self.saved or not self.shot_timer.extracting:
+            return
+        self.times.append(capture_time - self.shot_timer.pre_infuse_start)
+        self.pressures.append(pressure)
+
+        if self.shot_timer.finished:
+            self.finish()
+
+    def finish(self) -> None:
+        """
+        Submit the shot, if one was timed and it hasn't been submitted yet
+        """
+        shot_timer = self.shot_timer
+        if self.saved or not shot_timer.extracting:
+            return
+        self.saved = True
+        self.writer.submit(
+            summary={
+                "started_at": self.start + shot_timer.pre_infuse_start,
+                "recipe": self.recipe,
+                "grind": self.grind,
+                "pre_infuse_duration": shot_timer.pre_infuse_duration,
+                "shot_duration": shot_timer.shot_duration,
+                "impulse": shot_timer.impulse,
+                "peak_pressure": shot_timer.peak_pressure,
+            },
+            times=np.array(self.times),
+            pressures=np.array(self.pressures),
+        )
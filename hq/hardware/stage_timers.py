@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+
+"""
+Lightweight per-stage latency timers for frame loops
+
+Each stage keeps a rolling window of its latest durations, from which percentiles are
+computed on demand. Disabled timers do nothing, so they can be left in hot loops
+"""
+
+
+import json
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Dict
+
+import numpy as np
+
+
+# Number of latest durations kept per stage
+STAGE_TIMER_WINDOW = 1000
+
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimer:
+    """
+    Rolling window of durations for a single stage, in a preallocated ring buffer
+
+    Only safe to record from a single thread
+    """
+
+    def __init__(self, window: int = STAGE_TIMER_WINDOW) -> None:
+        """
+        Construct the timer
+
+        Args:
+            window: Number of latest durations kept
+        """
+        self.durations = np.zeros(window)
+        self.num_samples = 0
+
+    def record(self, seconds: float) -> None:
+        """
+        Add a duration to the window
+
+        Args:
+            seconds: Duration of stage (seconds)
+        """
+        self.durations[self.num_samples % len(self.durations)] = seconds
+        self.num_samples += 1
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Summarise the durations in the window
+
+        Returns:
+            Number of samples recorded in total, and percentiles of the window (ms)
+        """
+        window = self.durations[: min(self.num_samples, len(self.durations))]
+        summary: Dict[str, float] = {"count": self.num_samples}
+        if len(window):
+            for percentile, value in zip(
+                PERCENTILES, np.percentile(window, PERCENTILES) * 1000
+            ):
+                summary[f"p{percentile}_ms"] = float(value)
+        return summary
+
+
+class Lap:
+    """
+    Times consecutive stages, each from the end of the one before it
+    """
+
+    def __init__(self, timers: "StageTimers") -> None:
+        """
+        Start timing the first stage
+        """
+        self.timers = timers
+        self.last = perf_counter()
+
+    def mark(self, stage: str) -> None:
+        """
+        End a stage, and start timing the next one
+
+        Args:
+            stage: Name of stage that just ended
+        """
+        now = perf_counter()
+        self.timers.record(stage, now - self.last)
+        self.last = now
+
+
+class NullLap:
+    """
+    Lap that records nothing, handed out by disabled timers
+    """
+
+    def mark(self, stage: str) -> None:
+        """
+        Do nothing
+        """
+
+
+NULL_LAP = NullLap()
+
+
+class StageTimers:
+    """
+    Latency timers for the named stages of a loop
+
+    Stages may be recorded from different threads, as long as each stage is only ever
+    recorded from one
+    """
+
+    def __init__(self, enabled: bool, window: int = STAGE_TIMER_WINDOW) -> None:
+        """
+        Construct the timers
+
+        Args:
+            enabled: Whether to record anything
+            window: Number of latest durations kept per stage
+        """
+        self.enabled = enabled
+        self.window = window
+        self.stages: Dict[str, StageTimer] = {}
+        self.lock = Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        """
+        Record a duration for a stage
+
+        Args:
+            stage: Name of stage
+            seconds: Duration of stage (seconds)
+        """
+        timer = self.stages.get(stage)
+        if timer is None:
+            with self.lock:
+                timer = self.stages.setdefault(stage, StageTimer(window=self.window))
+        timer.record(seconds)
+
+    def lap(self) -> Lap | NullLap:
+        """
+        Start timing a sequence of stages
+
+        Returns:
+            Lap to mark the end of each stage with
+        """
+        return Lap(timers=self) if self.enabled else NULL_LAP
+
+    def timed(self, stage: str, function: Callable[..., Any]) -> Callable[..., Any]:
+        """
+        Wrap a function such that each call is recorded as a stage
+
+        Args:
+            stage: Name of stage
+            function: Function to time
+
+        Returns:
+            Wrapped function, or the function itself if timers are disabled
+        """
+        if not self.enabled:
+            return function
+
+        @wraps(function)
+        def timed_function(*args, **kwargs) -> Any:
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, perf_counter() - start)
+
+        return timed_function
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Summarise each stage, in the order they were first recorded
+
+        Returns:
+            Summary of each stage, see `StageTimer.summary`
+        """
+        with self.lock:
+            stages = list(self.stages.items())
+        return {stage: timer.summary() for stage, timer in stages}
+
+    def overlay(self) -> str:
+        """
+        Summarise each stage as a table, for drawing alongside other output
+
+        Returns:
+            One line per stage
+        """
+        lines = []
+        for stage, summary in self.summary().items():
+            percentiles = "  ".join(
+                f"p{percentile} {summary.get(f'p{percentile}_ms', np.nan):7.2f} ms"
+                for percentile in PERCENTILES
+            )
+            lines.append(f"{stage:>16}  {percentiles}")
+        return "\n".join(lines)
+
+    def dump(self, path: str) -> None:
+        """
+        Write the summary of each stage to a JSON file
+
+        Args:
+            path: Path to write to
+        """
+        with open(path, "w") as output_file:
+            json.dump(self.summary(), output_file, indent=2)
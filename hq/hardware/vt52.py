@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+
+"""
+Incremental drawing to VT52 terminals over slow serial links
+"""
+
+
+from typing import List, Optional
+
+import numpy as np
+
+
+ESCAPE = b"\x1b"
+CURSOR_HOME = ESCAPE + b"H"
+ERASE_TO_END_OF_SCREEN = ESCAPE + b"J"
+ERASE_TO_END_OF_LINE = ESCAPE + b"K"
+DIRECT_CURSOR_ADDRESS = ESCAPE + b"Y"
+CLEAR = CURSOR_HOME + ERASE_TO_END_OF_SCREEN
+
+# Row and column are sent as characters offset from space
+ADDRESS_OFFSET = 32
+ADDRESS_LENGTH = len(DIRECT_CURSOR_ADDRESS) + 2
+
+SCREEN_ROWS = 24
+SCREEN_COLS = 80
+BLANK = ord(" ")
+
+
+def cursor_address(row: int, col: int) -> bytes:
+    """
+    Escape sequence to move the cursor
+
+    Args:
+        row: Row to move to, from 0 at the top
+        col: Column to move to, from 0 at the left
+
+    Returns:
+        Escape sequence
+    """
+    return DIRECT_CURSOR_ADDRESS + bytes((row + ADDRESS_OFFSET, col + ADDRESS_OFFSET))
+
+
+class Vt52Screen:
+    """
+    Model of what is on a VT52 terminal's screen
+
+    Each frame is diffed against the model, and only changed cells are sent, each run of
+    them preceded by a cursor move. Unchanged gaps shorter than a cursor move are resent
+    rather than skipped, and rows that now end early are erased rather than overwritten
+    with spaces
+    """
+
+    def __init__(self, rows: int = SCREEN_ROWS, cols: int = SCREEN_COLS) -> None:
+        """
+        Construct the screen model
+
+        Args:
+            rows: Number of rows on terminal
+            cols: Number of columns on terminal
+        """
+        self.rows = rows
+        self.cols = cols
+        self.cells: Optional[np.ndarray] = None
+
+    def invalidate(self) -> None:
+        """
+        Forget what is on the screen, such that the next frame is drawn in full
+        """
+        self.cells = None
+
+    def frame(self, lines: List[str]) -> bytes:
+        """
+        Compute the bytes that update the screen to show the given lines
+
+        Args:
+            lines: Lines of text to show from the top of the screen. Lines and
+                characters that don't fit on the screen are dropped
+
+        Returns:
+            Bytes to send to the terminal
+        """
+        target = np.full((self.rows, self.cols), BLANK, dtype=np.uint8)
+        for row, line in zip(target, lines):
+            text = line.encode("ascii", errors="replace")[: self.cols]
+            row[: len(text)] = np.frombuffer(text, dtype=np.uint8)
+
+        # Draw from a cleared screen if we don't know what's on it
+        if self.cells is None:
+            output = bytearray(CLEAR)
+            current = np.full_like(target, BLANK)
+        else:
+            output = bytearray()
+            current = self.cells
+
+        for row in np.flatnonzero((target != current).any(axis=1)):
+            output += self._row_update(row=row, old=current[row], new=target[row])
+
+        self.cells = target
+        return bytes(output)
+
+    def _row_update(self, row: int, old: np.ndarray, new: np.ndarray) -> bytes:
+        """
+        Compute the bytes that update a single row
+
+        Args:
+            row: Index of row
+            old: Characters currently on row
+            new: Characters to show on row
+
+        Returns:
+            Bytes to send to the terminal
+        """
+        output = bytearray()
+
+        # Anything past the last character of the new row can be erased in one go
+        occupied = np.flatnonzero(new != BLANK)
+        end = occupied[-1] + 1 if len(occupied) else 0
+        erase = (old[end:] != BLANK).any()
+
+        # Group changed cells into runs, merging runs separated by gaps cheaper to
+        # resend than to skip with a cursor move
+        changed = np.flatnonzero(old[:end] != new[:end])
+        if len(changed):
+            breaks = np.flatnonzero(np.diff(changed) > ADDRESS_LENGTH + 1) + 1
+            starts = np.concatenate([changed[:1], changed[breaks]])
+            stops = np.concatenate([changed[breaks - 1], changed[-1:]]) + 1
+            for start, stop in zip(starts, stops):
+                output += cursor_address(row=row, col=start) + new[start:stop].tobytes()
+
+        if erase:
+            if not len(changed) or stops[-1] != end:
+                output += cursor_address(row=row, col=end)
+            output += ERASE_TO_END_OF_LINE
+
+        return bytes(output)
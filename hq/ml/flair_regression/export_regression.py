@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+
+"""
+Export the dial regression model for CPU inference on the Pi, quantized to int8
+"""
+
+
+import tempfile
+from itertools import islice
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import convert, get_default_qconfig, prepare
+
+from hq.cli import run_typer_app
+from hq.hardware.flair_pressure import DIAL_X_MAX, DIAL_X_MIN, DIAL_Y_MAX, DIAL_Y_MIN
+from hq.ml.flair_regression.train_regression import (
+    DIAL_REGRESSION_STATE_PATH,
+    PRESSURE_SCALE,
+    CsvDataset,
+    DialRegressionNet,
+    data_loader,
+)
+
+
+# Quantized kernels for ARM, as on the Pi. Also available on x86 for testing
+QUANTIZED_ENGINE = "qnnpack"
+
+CALIBRATION_BATCH_SIZE = 10
+
+
+class DialReader(nn.Module):
+    """
+    Dial regression model with its pre and post processing, such that it can be run
+    straight on dial crops as captured by fp
+    """
+
+    def __init__(self, model: nn.Module) -> None:
+        """
+        Wrap the model
+
+        Args:
+            model: Dial regression model, float or quantized
+        """
+        super().__init__()
+        self.model = model
+
+    def forward(self, dials: torch.Tensor) -> torch.Tensor:
+        """
+        Read pressures from dial crops
+
+        Args:
+            dials: Red channel of dial crops, as (N, H, W) uint8 tensor
+
+        Returns:
+            Pressure (bar) of each crop, as (N,) tensor
+        """
+        return self.model(dials.unsqueeze(1).float() / 255.0) * PRESSURE_SCALE
+
+
+def calibration_batches(calibration_csv: Path, num_images: int) -> list:
+    """
+    Load dial crops to calibrate quantization with
+
+    Args:
+        calibration_csv: Labels CSV of images to calibrate with
+        num_images: Maximum number of images to use
+
+    Returns:
+        Batches of (dial crops, labels), crops as float (N, 1, H, W) tensors
+    """
+    loader = data_loader(
+        CsvDataset(csv_path=str(calibration_csv), crop_dial=True),
+        batch_size=CALIBRATION_BATCH_SIZE,
+        num_workers=0,
+    )
+    return list(islice(loader, -(-num_images // CALIBRATION_BATCH_SIZE)))
+
+
+def mean_error(reader: nn.Module, batches: list) -> float:
+    """
+    Mean absolute error (bar) of a dial reader over labelled batches
+    """
+    errors = []
+    with torch.inference_mode():
+        for imgs, labels in batches:
+            dials = (imgs[:, 0] * 255).round().to(torch.uint8)
+            errors.append((reader(dials) - labels * PRESSURE_SCALE).abs())
+    return float(torch.cat(errors).mean())
+
+
+def frame_time(reader: nn.Module, num_frames: int = 100) -> float:
+    """
+    Mean time (seconds) for a dial reader to read a single frame
+    """
+    dial = torch.zeros(
+        (1, DIAL_Y_MAX - DIAL_Y_MIN, DIAL_X_MAX - DIAL_X_MIN), dtype=torch.uint8
+    )
+    with torch.inference_mode():
+        reader(dial)
+        start = perf_counter()
+        for _ in range(num_frames):
+            reader(dial)
+    return (perf_counter() - start) / num_frames
+
+
+def export_regression(
+    calibration_csv: Path,
+    state_path: Path = Path(DIAL_REGRESSION_STATE_PATH),
+    output_path: Path = Path("dial_regression_int8.pt"),
+    onnx_output_path: Optional[Path] = None,
+    num_calibration_images: int = 100,
+) -> None:
+    """
+    Quantize a trained dial regression model to int8 and save it as TorchScript
+
+    Weights and activations are quantized statically, with activation ranges calibrated
+    on labelled images. The result is what `fp live --learned` runs
+
+    Args:
+        calibration_csv: Labels CSV of images to calibrate quantization with
+        state_path: Trained model state dict, as saved by train_regression.py
+        output_path: Path to save quantized TorchScript model to
+        onnx_output_path: Path to also save an int8 ONNX model to, if given
+        num_calibration_images: Maximum number of images to calibrate with
+    """
+    torch.backends.quantized.engine = QUANTIZED_ENGINE
+
+    model = DialRegressionNet()
+    model.load_state_dict(torch.load(state_path, map_location="cpu"))
+    model.eval()
+    batches = calibration_batches(
+        calibration_csv=calibration_csv, num_images=num_calibration_images
+    )
+    example = torch.zeros(
+        (1, DIAL_Y_MAX - DIAL_Y_MIN, DIAL_X_MAX - DIAL_X_MIN), dtype=torch.uint8
+    )
+
+    if onnx_output_path is not None:
+        export_onnx(model=model, example=example, output_path=onnx_output_path)
+
+    # Fuse layers, then observe activation ranges over calibration images
+    float_reader = DialReader(model=model).eval()
+    quantized = DialRegressionNet()
+    quantized.load_state_dict(model.state_dict())
+    quantized.eval()
+    quantized.fuse()
+    quantized.qconfig = get_default_qconfig(QUANTIZED_ENGINE)
+    prepare(quantized, inplace=True)
+    with torch.inference_mode():
+        for imgs, _ in batches:
+            quantized(imgs)
+    convert(quantized, inplace=True)
+
+    # Bake pre and post processing in, and save as TorchScript
+    reader = DialReader(model=quantized).eval()
+    with torch.inference_mode():
+        traced = torch.jit.trace(reader, example)
+    torch.jit.save(traced, str(output_path))
+
+    for name, dial_reader in (("float", float_reader), ("int8", traced)):
+        print(
+            f"{name}: mean error {mean_error(dial_reader, batches):.3f} bar, "
+            f"{frame_time(dial_reader) * 1000:.2f} ms/frame"
+        )
+    print(f"Saved quantized model to {output_path}")
+
+
+def export_onnx(model: nn.Module, example: torch.Tensor, output_path: Path) -> None:
+    """
+    Save a dial regression model as ONNX, with weights dynamically quantized to int8
+
+    Args:
+        model: Trained float model
+        example: Example input to the dial reader
+        output_path: Path to save ONNX model to
+    """
+    # Only needed for ONNX export, so not a dependency of training
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        float_path = Path(temp_dir) / "float.onnx"
+        preprocessed_path = Path(temp_dir) / "preprocessed.onnx"
+        torch.onnx.export(
+            DialReader(model=model).eval(),
+            (example,),
+            str(float_path),
+            input_names=["dials"],
+            output_names=["pressures"],
+            dynamic_axes={"dials": {0: "batch"}, "pressures": {0: "batch"}},
+        )
+        quant_pre_process(float_path, preprocessed_path)
+        quantize_dynamic(
+            model_input=preprocessed_path,
+            model_output=output_path,
+            weight_type=QuantType.QInt8,
+        )
+    print(f"Saved quantized ONNX model to {output_path}")
+
+
+if __name__ == "__main__":
+    run_typer_app(export_regression)
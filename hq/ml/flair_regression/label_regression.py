@@ -3,55 +3,365 @@
 
 """
 Label training data for a regression model
+
+Images are shown one after another in a single window, each label starting from the
+pressure the needle detector reads. The next few images are decoded and read on a
+background thread while the current one is labelled, and labels are appended to the
+labels CSV as they are accepted, so labelling can stop and carry on at any point
 """
 
 
+import contextlib
+import os
 import sys
 from pathlib import Path
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import monotonic
+from typing import Callable, Iterator, List, Optional, Tuple
 
 import cv2
-import datetime
+import numpy as np
+
+from hq.cli import run_typer_app
+from hq.hardware.flair_pressure import DIAL_MASK_PATH, FlairPressure
+from hq.hardware.flair_replay import frame_paths
+from hq.ml.flair_regression.tensor_cache import read_labels
+
+
+# Images decoded and read ahead of the one being labelled
+PREFETCH_IMAGES = 16
+
+# Pressure step of each key press (bar), and the range of labels
+LABEL_STEP = 0.5
+FINE_LABEL_STEP = 0.1
+MIN_LABEL = 0.0
+MAX_LABEL = 10.0
+
+# Longest labels may sit in the OS's buffers before being synced to disk (seconds)
+LABEL_SYNC_INTERVAL = 5.0
+
+# How long blocked threads wait before checking whether they've been stopped (seconds)
+POLL_INTERVAL = 0.1
 
-from subprocess import run
+WINDOW_TEXT_COLOUR = (255, 255, 0)
+WINDOW_FONT_SIZE = 36
 
-from hq.io_tools import getchar
-from hq.hardware.kopi import CTRL_C
+# Image, and the pressure the detector read from it (bar) if it read one
+Prefetched = Tuple[Path, np.ndarray, Optional[float]]
 
 
-def main() -> int:
+class LabelAppender:
     """
-    Label images with a numeric value
+    Appends labels to a labels CSV, such that a crash loses at most the label being
+    written
 
-    Used to label regression model training data
+    Each label is written as one complete line and flushed to the OS straight away, so
+    it survives the process dying. Syncing to disk, which is slow, is done at most every
+    few seconds, and on close
     """
-    if len(sys.argv) < 2:
-        raise ValueError("Please give input dir as 1st positional arg")
 
-    pressure = 0
-    dp = 0.5
+    def __init__(self, path: Path, sync_interval: float = LABEL_SYNC_INTERVAL) -> None:
+        """
+        Open the labels CSV for appending, creating it if need be
 
-    output_path = Path("labels.csv")
+        Args:
+            path: Path to labels CSV
+            sync_interval: Longest to go without syncing labels to disk (seconds)
+        """
+        self.labels_file = open(path, mode="a", encoding="utf-8")
+        self.sync_interval = sync_interval
+        self.last_sync = monotonic()
 
-    with open(output_path, mode="a", encoding="utf-8") as labels_fp:
-        labels_fp.write(f"{datetime.datetime.utcnow()}\n")
-        input_dir = Path(sys.argv[1])
-        for img_path in sorted(input_dir.iterdir(), key=lambda path: int(path.stem)):
-            print(img_path)
-            run(f"feh -d. {img_path}", shell=True)
+        # Finish a line left unterminated by a crash, so it isn't joined to the next
+        if self.labels_file.tell() > 0:
+            with open(path, mode="rb") as labels_file:
+                labels_file.seek(-1, os.SEEK_END)
+                if labels_file.read(1) != b"\n":
+                    self.labels_file.write("\n")
 
+    def append(self, img_path: Path, pressure: float) -> None:
+        """
+        Append a label
+
+        Args:
+            img_path: Path to labelled image
+            pressure: Pressure read from image (bar)
+        """
+        self.labels_file.write(f"{img_path},{pressure}\n")
+        self.labels_file.flush()
+        if monotonic() - self.last_sync > self.sync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        """
+        Write every label appended so far to disk
+        """
+        self.labels_file.flush()
+        os.fsync(self.labels_file.fileno())
+        self.last_sync = monotonic()
+
+    def close(self) -> None:
+        """
+        Sync and close the labels CSV
+        """
+        self.sync()
+        self.labels_file.close()
+
+
+class ImagePrefetcher(Thread):
+    """
+    Background thread that decodes images, in order, and reads pressures from them with
+    the needle detector, keeping a few images ahead of the one being labelled
+    """
+
+    def __init__(
+        self,
+        paths: List[Path],
+        estimate: Callable[[np.ndarray], Optional[float]],
+        num_prefetch: int = PREFETCH_IMAGES,
+    ) -> None:
+        """
+        Construct the prefetcher. Images are prefetched once started
+
+        Args:
+            paths: Paths to images, in the order they're labelled
+            estimate: Reads pressure (bar) from a BGR image, None if it can't
+            num_prefetch: Number of images to keep decoded ahead of the one being used
+        """
+        super().__init__(name="label-prefetch", daemon=True)
+        self.paths = paths
+        self.estimate = estimate
+        self.images: Queue = Queue(maxsize=num_prefetch)
+        self.stopped = Event()
+
+    def _put(self, item: Optional[Prefetched]) -> bool:
+        """
+        Queue an item once there is room, unless stopped first
+
+        Returns:
+            Whether the item was queued
+        """
+        while not self.stopped.is_set():
+            try:
+                self.images.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def run(self) -> None:
+        """
+        Decode and read each image, then mark the end with None, even if something
+        goes wrong, so the labelling loop never waits forever
+        """
+        try:
+            for path in self.paths:
+                try:
+                    img = cv2.imread(str(path))
+                except cv2.error as error:
+                    print(f"Could not read {path}, skipping: {error}", file=sys.stderr)
+                    continue
+                if img is None:
+                    print(f"Could not read {path}, skipping", file=sys.stderr)
+                    continue
+
+                # An image the detector fails on is still labelled, just without help
+                try:
+                    estimate = self.estimate(img)
+                except Exception as error:
+                    print(f"Could not estimate {path}: {error!r}", file=sys.stderr)
+                    estimate = None
+                if not self._put((path, img, estimate)):
+                    return
+        finally:
+            self._put(None)
+
+    def __iter__(self) -> Iterator[Prefetched]:
+        """
+        Yield each image as it's ready, with the pressure read from it
+        """
+        while (item := self.images.get()) is not None:
+            yield item
+
+    def stop(self) -> None:
+        """
+        Stop prefetching, and wait for the thread to finish
+        """
+        self.stopped.set()
+        with contextlib.suppress(Empty):
             while True:
-                print(f"pressure: {pressure}")
-                char = getchar()
-                if char == b"j":
-                    pressure = max(0, pressure - dp)
-                elif char == b"k":
-                    pressure = min(10, pressure + dp)
-                elif char == CTRL_C:
-                    return 1
-                elif char in (b"\n", b"\r"):
-                    labels_fp.write(f"{img_path},{pressure}\n")
-                    break
+                self.images.get_nowait()
+        self.join()
+
+
+def unlabelled_images(input_dir: Path, labels_path: Path) -> List[Path]:
+    """
+    Find the images in a directory that aren't in the labels CSV yet
+
+    Args:
+        input_dir: Directory of images, named by frame number, which may also hold
+            the labels CSV
+        labels_path: Path to labels CSV, which needn't exist yet
+
+    Returns:
+        Paths to unlabelled images, in order of frame number
+    """
+    labelled = (
+        {path for path, _ in read_labels(str(labels_path))}
+        if labels_path.exists()
+        else set()
+    )
+    return [
+        path
+        for path in frame_paths(input_dir)
+        if str(path) not in labelled
+    ]
+
+
+class LabelWindow:
+    """
+    Window showing each image with its label, adjusted from the keyboard
+
+    Keys: j/k decrease/increase the label, J/K in finer steps, enter accepts it, s skips
+    the image, and q or escape quits
+    """
+
+    def __init__(self) -> None:
+        """
+        Open the window
+        """
+        # Imported here so the rest of the module can be used without a display
+        with contextlib.redirect_stdout(None):
+            import pygame  # Avoid pygame's self advertisement on import
+
+        self.pygame = pygame
+        pygame.init()
+        self.screen: Optional["pygame.Surface"] = None
+        self.font = pygame.font.Font(None, WINDOW_FONT_SIZE)
+
+    def draw(self, img: np.ndarray, text: str) -> None:
+        """
+        Show an image, with text over it
+
+        Args:
+            img: BGR image
+            text: Text to show in the top left corner
+        """
+        pygame = self.pygame
+        height, width = img.shape[:2]
+        if self.screen is None:
+            self.screen = pygame.display.set_mode((width, height), pygame.RESIZABLE)
+        surface = pygame.image.frombuffer(
+            np.ascontiguousarray(img[..., ::-1]).tobytes(), (width, height), "RGB"
+        )
+        if self.screen.get_size() != (width, height):
+            surface = pygame.transform.scale(surface, self.screen.get_size())
+        self.screen.blit(surface, (0, 0))
+        self.screen.blit(self.font.render(text, True, WINDOW_TEXT_COLOUR), (10, 10))
+        pygame.display.flip()
+
+    def ask(
+        self, img_path: Path, img: np.ndarray, pressure: float, progress: str
+    ) -> Optional[float]:
+        """
+        Show an image until its label is accepted or it's skipped
+
+        Args:
+            img_path: Path to image, shown in the window title
+            img: BGR image
+            pressure: Label to start from (bar)
+            progress: Text describing how far through labelling we are
+
+        Returns:
+            Accepted label (bar), None if skipped
+
+        Raises:
+            KeyboardInterrupt: If asked to quit
+        """
+        pygame = self.pygame
+        pygame.display.set_caption(str(img_path))
+        directions = {pygame.K_j: -1, pygame.K_k: 1}
+        while True:
+            self.draw(img=img, text=f"{pressure:.1f} bar  {progress}")
+            event = pygame.event.wait()
+            if event.type == pygame.QUIT:
+                raise KeyboardInterrupt
+            if event.type != pygame.KEYDOWN:
+                continue
+            if event.key in directions:
+                fine = event.mod & pygame.KMOD_SHIFT
+                step = FINE_LABEL_STEP if fine else LABEL_STEP
+                pressure = min(
+                    max(pressure + directions[event.key] * step, MIN_LABEL), MAX_LABEL
+                )
+                pressure = round(pressure, ndigits=2)
+            elif event.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+                return pressure
+            elif event.key == pygame.K_s:
+                return None
+            elif event.key in (pygame.K_q, pygame.K_ESCAPE):
+                raise KeyboardInterrupt
+
+    def close(self) -> None:
+        """
+        Close the window
+        """
+        self.pygame.quit()
+
+
+def label_regression(
+    input_dir: Path,
+    labels_path: Path = Path("labels.csv"),
+    mask_path: str = DIAL_MASK_PATH,
+    num_prefetch: int = PREFETCH_IMAGES,
+) -> None:
+    """
+    Label images of the gauge with pressure, for training regression models
+
+    Images already in the labels CSV are skipped, so labelling can be stopped and
+    carried on later
+
+    Args:
+        input_dir: Directory of images, named by frame number, as saved by fp
+        labels_path: Labels CSV to append to
+        mask_path: Path to segmentation mask of dial, for the detector
+        num_prefetch: Images decoded ahead of the one being labelled
+    """
+    paths = unlabelled_images(input_dir=input_dir, labels_path=labels_path)
+    print(f"{len(paths)} images to label, appending labels to {labels_path}")
+
+    detector = FlairPressure(mask_path=mask_path)
+    detector.debug_mode = False
+    prefetcher = ImagePrefetcher(
+        paths=paths,
+        estimate=detector.detect_needle_position,
+        num_prefetch=num_prefetch,
+    )
+    prefetcher.start()
+    appender = LabelAppender(path=labels_path)
+    window = LabelWindow()
+    pressure = MIN_LABEL
+    try:
+        for i, (img_path, img, estimate) in enumerate(prefetcher):
+            if estimate is not None:
+                pressure = round(min(max(estimate, MIN_LABEL), MAX_LABEL), ndigits=1)
+            label = window.ask(
+                img_path=img_path,
+                img=img,
+                pressure=pressure,
+                progress=f"{i + 1}/{len(paths)}",
+            )
+            if label is not None:
+                appender.append(img_path=img_path, pressure=label)
+                pressure = label
+    except KeyboardInterrupt:
+        pass
+    finally:
+        window.close()
+        prefetcher.stop()
+        appender.close()
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    run_typer_app(label_regression)
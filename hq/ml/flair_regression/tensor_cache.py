@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+
+"""
+Decoded image cache for training on labelled images, as memory-mapped uint8 arrays
+
+Decoding JPEGs dominates training on small crops, so each labels CSV is decoded once
+into a .npy array of images with an array of labels alongside. Training then reads
+examples straight from the page cache, without decoding or holding the dataset in RAM
+"""
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import List, Tuple
+
+import numpy as np
+import PIL.Image
+
+from hq.cli import run_typer_app
+from hq.hardware.flair_pressure import DIAL_X_MAX, DIAL_X_MIN, DIAL_Y_MAX, DIAL_Y_MIN
+
+
+# Where decoded datasets are cached, one directory per labels CSV and preprocessing
+TENSOR_CACHE_DIRECTORY = os.path.expanduser("~/.cache/hq/flair_regression")
+
+# Bump when preprocessing changes, so old caches are ignored
+TENSOR_CACHE_VERSION = 1
+
+
+def read_labels(csv_path: str) -> List[Tuple[str, float]]:
+    """
+    Read a labels CSV, of one path,pressure line per image
+
+    Args:
+        csv_path: Path to labels CSV
+
+    Returns:
+        Path and pressure (bar) of each image
+    """
+    labels = []
+    with open(csv_path, mode="r", encoding="utf-8") as csv_fp:
+        for line in csv_fp:
+            if line.strip():
+                path, label = line.strip().split(",")
+                labels.append((path, float(label)))
+    return labels
+
+
+def preprocess(path: str, crop_dial: bool) -> np.ndarray:
+    """
+    Decode an image into the layout models are trained on
+
+    Args:
+        path: Path to image
+        crop_dial: Keep only the red channel of the dial, as read by fp, as (1, H, W).
+            Otherwise keep the whole image, as (3, W, H)
+
+    Returns:
+        Image as uint8 array
+    """
+    img = np.array(PIL.Image.open(path))
+    if crop_dial:
+        # Red channel of dial, as read by fp (PIL images are RGB)
+        return img[DIAL_Y_MIN:DIAL_Y_MAX, DIAL_X_MIN:DIAL_X_MAX, 0][None]
+    return img.transpose(2, 1, 0)
+
+
+class TensorCache:
+    """
+    Decoded images and their labels, memory-mapped
+    """
+
+    def __init__(self, images: np.ndarray, labels: np.ndarray, directory: str) -> None:
+        """
+        Args:
+            images: Images as (N, C, H, W) uint8 array
+            labels: Pressure (bar) of each image, as (N,) float32 array
+            directory: Directory the cache was loaded from
+        """
+        self.images = images
+        self.labels = labels
+        self.directory = directory
+
+    def __len__(self) -> int:
+        """
+        Number of images
+        """
+        return len(self.labels)
+
+    @classmethod
+    def build(cls, csv_path: str, directory: str, crop_dial: bool) -> "TensorCache":
+        """
+        Decode every image in a labels CSV into a cache directory
+
+        Images are written straight to the memory-mapped array as they are decoded, so
+        memory use doesn't grow with the dataset. The directory appears all at once,
+        when every image has been written
+
+        Args:
+            csv_path: Path to labels CSV
+            directory: Directory to write .npy files under
+            crop_dial: See `preprocess`
+
+        Returns:
+            Cache, loaded from the directory
+        """
+        labels = read_labels(csv_path)
+        if not labels:
+            raise ValueError(f"No labelled images in {csv_path}")
+
+        parent = os.path.dirname(directory)
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent)
+        try:
+            first = preprocess(labels[0][0], crop_dial=crop_dial)
+            images = np.lib.format.open_memmap(
+                os.path.join(staging, "images.npy"),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(labels),) + first.shape,
+            )
+            images[0] = first
+            for i, (path, _) in enumerate(labels[1:], start=1):
+                img = preprocess(path, crop_dial=crop_dial)
+                if img.shape != first.shape:
+                    raise ValueError(
+                        f"{path} is {img.shape}, unlike {labels[0][0]} {first.shape}"
+                    )
+                images[i] = img
+            images.flush()
+            del images
+            np.save(
+                os.path.join(staging, "labels.npy"),
+                np.array([label for _, label in labels], dtype=np.float32),
+            )
+            try:
+                os.replace(staging, directory)
+            except OSError:
+                # Built by someone else in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory: str) -> "TensorCache":
+        """
+        Load a cache written by `build`, memory-mapped copy-on-write, such that examples
+        can be wrapped as tensors without copying
+
+        Args:
+            directory: Directory of .npy files
+
+        Returns:
+            Loaded cache
+        """
+        return cls(
+            images=np.load(os.path.join(directory, "images.npy"), mmap_mode="c"),
+            labels=np.load(os.path.join(directory, "labels.npy"), mmap_mode="c"),
+            directory=directory,
+        )
+
+    @classmethod
+    def load_or_build(
+        cls,
+        csv_path: str,
+        crop_dial: bool,
+        cache_directory: str = TENSOR_CACHE_DIRECTORY,
+    ) -> "TensorCache":
+        """
+        Load the cache of a labels CSV if there is one, otherwise build one
+
+        Caches are keyed by the contents of the CSV and the size and modification time
+        of each image, so editing labels or images builds a new cache
+
+        Args:
+            csv_path: Path to labels CSV
+            crop_dial: See `preprocess`
+            cache_directory: Directory to cache datasets under
+
+        Returns:
+            Cache of the labelled images
+        """
+        try:
+            with open(csv_path, "rb") as csv_file:
+                key = hashlib.sha256(csv_file.read())
+        except OSError as error:
+            raise ValueError(f"Could not load labels at {csv_path}") from error
+        for path, _ in read_labels(csv_path):
+            stat = os.stat(path)
+            key.update(repr((path, stat.st_size, stat.st_mtime_ns)).encode())
+        key.update(repr((TENSOR_CACHE_VERSION, crop_dial)).encode())
+        directory = os.path.join(cache_directory, key.hexdigest())
+
+        if os.path.isdir(directory):
+            return cls.load(directory)
+        return cls.build(csv_path=csv_path, directory=directory, crop_dial=crop_dial)
+
+
+def build_tensor_cache(
+    csv_path: str,
+    crop_dial: bool = True,
+    cache_directory: str = TENSOR_CACHE_DIRECTORY,
+) -> None:
+    """
+    Decode the images of a labels CSV into the tensor cache ahead of training
+
+    Args:
+        csv_path: Path to labels CSV
+        crop_dial: Keep only the red channel of the dial
+        cache_directory: Directory to cache datasets under
+    """
+    cache = TensorCache.load_or_build(
+        csv_path=csv_path, crop_dial=crop_dial, cache_directory=cache_directory
+    )
+    print(
+        f"{len(cache)} images of shape {cache.images.shape[1:]}, "
+        f"{cache.images.nbytes / 2**20:.1f} MiB, cached at {cache.directory}"
+    )
+
+
+if __name__ == "__main__":
+    run_typer_app(build_tensor_cache)
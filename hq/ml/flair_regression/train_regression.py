@@ -6,21 +6,22 @@ Train regression model
 """
 
 
-import sys
 import os
-from typing import Tuple
+from typing import Optional, Tuple
 
-from random import shuffle
-import numpy as np
-import PIL.Image
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import optim
+from torch.ao.quantization import DeQuantStub, QuantStub, fuse_modules
 from torch.optim.lr_scheduler import StepLR
 from torch.utils.data import DataLoader
 from torchvision import datasets, transforms
 
+from hq.cli import run_typer_app
+from hq.ml.flair_regression.tensor_cache import TENSOR_CACHE_DIRECTORY, TensorCache
+from hq.ml.training import ResumableSampler, Trainer
+
 
 DEVICE = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
@@ -28,7 +29,19 @@ NORMALISATION_MEAN = 0.1307
 NORMALISATION_STD = 0.3081
 
 NUM_EPOCHS = 5
-LOG_INTERVAL = 10
+
+BATCH_SIZE = 32
+
+# Batches each data loader worker keeps ready ahead of training
+PREFETCH_BATCHES_PER_WORKER = 4
+
+# Labels are pressures (bar), scaled down to around unit range for training
+PRESSURE_SCALE = 10.0
+
+DIAL_REGRESSION_STATE_PATH = "dial_regression.pt"
+
+# Where training checkpoints are kept, to resume from
+DIAL_REGRESSION_CHECKPOINT_DIRECTORY = "dial_regression_checkpoints"
 
 
 class FullyConnectedNet(nn.Module):
@@ -60,25 +73,25 @@ class RegressionNet(nn.Module):
 
         self.conv_depth = 16
 
-        # Input shape: (480, 640, 3)
+        # Input shape: (3, 640, 480), as CsvDataset loads whole images
 
-        # -> (240, 320, 32)
+        # -> (16, 319, 239)
         self.conv1 = nn.Conv2d(3, self.conv_depth, 3, 2)
         self.dropout1 = nn.Dropout(0.2)
 
-        # -> (120, 160, 32)
+        # -> (16, 159, 119)
         self.conv2 = nn.Conv2d(self.conv_depth, self.conv_depth, 3, 2)
         self.dropout2 = nn.Dropout(0.2)
 
-        # -> (60, 80, 32)
+        # -> (16, 79, 59)
         self.conv3 = nn.Conv2d(self.conv_depth, self.conv_depth, 3, 2)
         self.dropout3 = nn.Dropout(0.2)
 
-        # -> (30, 40, 32)
+        # -> (16, 39, 29)
         self.conv4 = nn.Conv2d(self.conv_depth, self.conv_depth, 3, 2)
         self.dropout4 = nn.Dropout(0.2)
 
-        self.fc1 = nn.Linear(90480, 10)
+        self.fc1 = nn.Linear(self.conv_depth * 39 * 29, 10)
         self.dropout5 = nn.Dropout(0.2)
 
         self.fc2 = nn.Linear(10, 1)
@@ -100,13 +113,81 @@ class RegressionNet(nn.Module):
         x = self.dropout4(x)
         x = F.relu(x)
 
-        x = torch.flatten(x)
+        # Flatten each example, not the whole batch
+        x = torch.flatten(x, 1)
 
         x = self.fc1(x)
         x = self.dropout5(x)
         x = F.relu(x)
 
-        return self.fc2(x)
+        return self.fc2(x)[:, 0]
+
+
+class DialRegressionNet(nn.Module):
+    """
+    Regression network reading pressure from the red channel of the dial crop
+
+    Small enough to run at camera frame rate on a Raspberry Pi CPU, and built only from
+    layers that can be fused and quantized to int8, see export_regression.py
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.conv_depth = 16
+
+        self.quant = QuantStub()
+
+        # Input shape: (1, 92, 192)
+
+        # -> (16, 45, 95)
+        self.conv1 = nn.Conv2d(1, self.conv_depth, 3, 2)
+        self.relu1 = nn.ReLU()
+
+        # -> (16, 22, 47)
+        self.conv2 = nn.Conv2d(self.conv_depth, self.conv_depth, 3, 2)
+        self.relu2 = nn.ReLU()
+
+        # -> (16, 10, 23)
+        self.conv3 = nn.Conv2d(self.conv_depth, self.conv_depth, 3, 2)
+        self.relu3 = nn.ReLU()
+
+        # -> (16, 4, 11)
+        self.conv4 = nn.Conv2d(self.conv_depth, self.conv_depth, 3, 2)
+        self.relu4 = nn.ReLU()
+
+        self.dropout = nn.Dropout(0.2)
+        self.fc1 = nn.Linear(self.conv_depth * 4 * 11, 32)
+        self.relu5 = nn.ReLU()
+
+        self.fc2 = nn.Linear(32, 1)
+
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        x = self.quant(x)
+
+        x = self.relu1(self.conv1(x))
+        x = self.relu2(self.conv2(x))
+        x = self.relu3(self.conv3(x))
+        x = self.relu4(self.conv4(x))
+
+        x = torch.flatten(x, 1)
+        x = self.dropout(x)
+        x = self.relu5(self.fc1(x))
+        x = self.fc2(x)
+
+        return self.dequant(x)[:, 0]
+
+    def fuse(self) -> None:
+        """
+        Fuse each layer with its activation, in place, ready for quantization
+        """
+        fuse_modules(
+            self,
+            [[f"conv{i}", f"relu{i}"] for i in range(1, 5)] + [["fc1", "relu5"]],
+            inplace=True,
+        )
 
 
 def load_mnist(use_cuda: bool) -> Tuple[DataLoader, DataLoader]:
@@ -132,137 +213,124 @@ def load_mnist(use_cuda: bool) -> Tuple[DataLoader, DataLoader]:
     return train_loader, test_loader
 
 
-class WalkingDataset(torch.utils.data.IterableDataset):
+class WalkingDataset(torch.utils.data.Dataset):
+    """
+    Paths of every file under a directory, in a fixed order
+    """
+
     def __init__(self, root_dir: str):
         super().__init__()
         self.root_dir = root_dir
-        self.paths = []
-        self.have_seen_entire_datset = False
-
-    def __iter__(self):
-        if not self.have_seen_entire_datset:
-            for dirname, _, files in os.walk(self.root_dir):
-                for basename in files:
-                    path = os.path.join(dirname, basename)
-                    self.paths.append(path)
-                    yield path
-            self.have_seen_entire_datset = True
-        else:
-            yield from self.paths
-
-
-class CsvDataset(torch.utils.data.IterableDataset):
-    def __init__(self, csv_path: str):
-        super().__init__()
-        self.csv_path = csv_path
-        self.examples = []
-        self.have_seen_entire_datset = False
-
-    def __iter__(self):
-        if not self.have_seen_entire_datset:
-            with open(self.csv_path, mode="r", encoding="utf-8") as csv_fp:
-                for line in csv_fp.readlines():
-                    path, label = line.strip().split(",")
-                    img = (
-                        torch.tensor(
-                            np.array(PIL.Image.open(path)).transpose(2, 1, 0),
-                            dtype=torch.float,
-                        )
-                        / 255.0
-                    )
-                    label = torch.tensor(float(label)) / 10
-                    example = (img, label)
-                    self.examples.append(example)
-            self.have_seen_entire_dataset = True
-        shuffle(self.examples)
-        yield from self.examples
-
-    def __len__(self):
-        return len(self.examples)
-
-
-def train(
-    model: FullyConnectedNet,
-    device: torch.device,
-    train_loader: DataLoader,
-    optimizer: optim.Optimizer,
-    epoch: int,
-) -> None:
+        self.paths = sorted(
+            os.path.join(dirname, basename)
+            for dirname, _, files in os.walk(root_dir)
+            for basename in files
+        )
+
+    def __getitem__(self, index: int) -> str:
+        return self.paths[index]
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+class CsvDataset(torch.utils.data.Dataset):
     """
-    Train the model
+    Labelled images listed in a CSV of path,pressure lines
 
-    Args:
-        model: Model to train
-        device: Device to run training on
-        train_loader: Data loader to train from
-        optimizer: Model optimizer
-        epoch: Epoch number
+    Images are decoded once into a memory-mapped cache, see tensor_cache.py, and read
+    from it one example at a time, so memory use stays flat however big the dataset.
+    Only the location of the cache is pickled, so data loader workers each map it
+    themselves, sharing the page cache, rather than being sent a copy
     """
-    model.train()
-    for batch_idx, (data, target) in enumerate(train_loader):
-        data, target = data.to(device), target.to(device)
-        optimizer.zero_grad()
-
-        # Predict on input data
-        output = model(data)
-
-        # Compute loss
-        loss = F.l1_loss(output, target)
-
-        # Backpropagate loss through network and update weights
-        loss.backward()
-        optimizer.step()
-
-        if batch_idx % LOG_INTERVAL == 0:
-            print(
-                "Train Epoch: {epoch} [{progress}/{num_images} ({progress_percent:.0f}%)]\tLoss: {loss:.6f}".format(
-                    epoch=epoch,
-                    progress=batch_idx * len(data),
-                    num_images=len(train_loader.dataset),
-                    progress_percent=100.0 * batch_idx / len(train_loader),
-                    loss=loss.item(),
-                )
-            )
-
-
-def test(
-    model: FullyConnectedNet,
-    device: torch.device,
-    test_loader: DataLoader,
-) -> None:
+
+    def __init__(
+        self,
+        csv_path: str,
+        crop_dial: bool = False,
+        cache_directory: str = TENSOR_CACHE_DIRECTORY,
+    ):
+        super().__init__()
+        self.csv_path = csv_path
+        self.crop_dial = crop_dial
+        cache = TensorCache.load_or_build(
+            csv_path=csv_path, crop_dial=crop_dial, cache_directory=cache_directory
+        )
+        self.cache_path = cache.directory
+        self.num_examples = len(cache)
+        self._cache: Optional[TensorCache] = None
+
+    @property
+    def cache(self) -> TensorCache:
+        """
+        Decoded images and labels, mapped on first use in each process
+        """
+        if self._cache is None:
+            self._cache = TensorCache.load(self.cache_path)
+        return self._cache
+
+    def __getstate__(self) -> dict:
+        return {**self.__dict__, "_cache": None}
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        img = torch.from_numpy(self.cache.images[index]).float() / 255.0
+        label = torch.tensor(float(self.cache.labels[index])) / PRESSURE_SCALE
+        return img, label
+
+    def __len__(self) -> int:
+        return self.num_examples
+
+
+def data_loader(
+    dataset: torch.utils.data.Dataset,
+    batch_size: int = BATCH_SIZE,
+    shuffle: bool = True,
+    num_workers: Optional[int] = None,
+    pin_memory: bool = torch.cuda.is_available(),
+) -> DataLoader:
     """
-    Test the model on some unseen data
+    Batch a map-style dataset, loading batches in worker processes ahead of training
 
     Args:
-        model: Model to train
-        device: Device to run training on
-        test_loader: Data loader to test from
+        dataset: Dataset to batch
+        batch_size: Examples per batch
+        shuffle: Sample examples in a new random order each epoch, reproducibly, such
+            that training can resume part way through an epoch
+        num_workers: Loader processes, one per CPU core if None, none if zero
+        pin_memory: Put batches in page-locked memory, for fast non-blocking copies to
+            the GPU
+
+    Returns:
+        Data loader
     """
-    model.eval()
-    test_loss = 0
-    correct = 0
-    with torch.no_grad():
-        for data, target in test_loader:
-            data, target = data.to(device), target.to(device)
-            output = model(data)
-            test_loss += F.l1_loss(output, target).item()  # sum up batch loss
-
-    test_loss /= len(test_loader.dataset)
-
-    print(
-        "\nTest set: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n".format(
-            test_loss,
-            correct,
-            len(test_loader.dataset),
-            100.0 * correct / len(test_loader.dataset),
-        )
+    if num_workers is None:
+        num_workers = os.cpu_count() or 0
+    workers_kwargs = (
+        {"persistent_workers": True, "prefetch_factor": PREFETCH_BATCHES_PER_WORKER}
+        if num_workers > 0
+        else {}
+    )
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=ResumableSampler(len(dataset), shuffle=shuffle),
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **workers_kwargs,
     )
 
 
-def main() -> int:
+def main(
+    bfloat16: bool = False, channels_last: bool = False, compile_model: bool = False
+) -> int:
     """
     Train and evaluate model
 
+    Args:
+        bfloat16: Train under bfloat16 autocast
+        channels_last: Train with channels last (NHWC) memory format
+        compile_model: Compile the model with torch.compile
+
     Returns:
         Exit status
     """
@@ -275,14 +343,17 @@ def main() -> int:
 
     # Load dataset
     # train_loader, test_loader = load_datasets(use_cuda=use_cuda)
-    train_loader = DataLoader(
+    train_loader = data_loader(
         # CsvDataset(csv_path="/home/hamish/src/hq/python/hq/ml/labels.train.csv"),
-        CsvDataset(csv_path="/home/hamish/src/hq/python/hq/ml/labels.csv"),
-        batch_size=5,
+        CsvDataset(
+            csv_path="/home/hamish/src/hq/python/hq/ml/labels.csv", crop_dial=True
+        ),
     )
-    test_loader = DataLoader(
-        CsvDataset(csv_path="/home/hamish/src/hq/python/hq/ml/labels.val.csv"),
-        batch_size=5,
+    test_loader = data_loader(
+        CsvDataset(
+            csv_path="/home/hamish/src/hq/python/hq/ml/labels.val.csv", crop_dial=True
+        ),
+        shuffle=False,
     )
 
     torch.manual_seed(7777)
@@ -290,21 +361,29 @@ def main() -> int:
     # Construct the model
     # model = FullyConnectedNet().to(device)
     # model = ConvotionalNet().to(device)
-    model = RegressionNet().to(device)
+    # model = RegressionNet().to(device)
+    model = DialRegressionNet().to(device)
 
     # optimizer = optim.Adadelta(model.parameters(), lr=args.lr)
     optimizer = optim.Adam(model.parameters(), lr=1e-6)
     scheduler = StepLR(optimizer, step_size=1, gamma=0.7)
 
-    for epoch in range(1, NUM_EPOCHS + 1):
-        train(model, device, train_loader, optimizer, epoch)
-        # test(model, device, test_loader)
-        scheduler.step()
-
-        torch.save(model.state_dict(), "mnist_cnn.pt")
+    trainer = Trainer(
+        model=model,
+        optimizer=optimizer,
+        loss_function=F.l1_loss,
+        device=device,
+        scheduler=scheduler,
+        checkpoint_directory=DIAL_REGRESSION_CHECKPOINT_DIRECTORY,
+        bfloat16=bfloat16,
+        channels_last=channels_last,
+        compile_model=compile_model,
+        state_path=DIAL_REGRESSION_STATE_PATH,
+    )
+    trainer.fit(train_loader, num_epochs=NUM_EPOCHS, test_loader=test_loader)
 
     return 0
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    run_typer_app(main)
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+
+
+"""
+Training runner shared by hq.ml models, with throughput stats and resumable checkpoints
+
+Each epoch reports samples per second, how long was spent waiting on the data loader
+versus computing, and the peak resident memory of the training process. Checkpoints of
+the model, optimizer, scheduler and position in the epoch are written atomically every
+few minutes and at the end of each epoch, keeping only the latest few, so an interrupted
+run picks up from the batch it had reached
+"""
+
+
+import glob
+import json
+import os
+import resource
+import sys
+import tempfile
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import torch
+from torch.utils.data import DataLoader
+
+
+# Seconds between checkpoints within an epoch
+CHECKPOINT_INTERVAL = 600.0
+
+# Checkpoints kept, older ones are deleted
+KEEP_CHECKPOINTS = 3
+
+CHECKPOINT_PATTERN = "checkpoint-*.pt"
+
+# Epoch stats, one JSON object per line, alongside the checkpoints
+STATS_FILENAME = "stats.jsonl"
+
+Batch = Tuple[torch.Tensor, torch.Tensor]
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Samples a dataset in a new random order each epoch, reproducible from the epoch
+    number, such that an epoch can be restarted part way through without loading the
+    examples already trained on
+    """
+
+    def __init__(self, num_examples: int, shuffle: bool = True, seed: int = 0) -> None:
+        """
+        Args:
+            num_examples: Size of dataset
+            shuffle: Sample in a random order, otherwise in order
+            seed: Seed the order of each epoch is derived from
+        """
+        super().__init__()
+        self.num_examples = num_examples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch: int, start: int = 0) -> None:
+        """
+        Choose the epoch sampled next
+
+        Args:
+            epoch: Epoch number
+            start: Number of examples of the epoch to skip
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self) -> Iterator[int]:
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.num_examples, generator=generator)
+        else:
+            order = torch.arange(self.num_examples)
+        return iter(order[self.start :].tolist())
+
+    def __len__(self) -> int:
+        return self.num_examples - self.start
+
+
+def resident_memory() -> int:
+    """
+    Resident memory of this process (bytes), or its peak so far where the current value
+    isn't available
+    """
+    try:
+        with open("/proc/self/statm", mode="r", encoding="utf-8") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def to_device(batch: Batch, device: torch.device) -> Batch:
+    """
+    Move a batch of inputs and targets to a device, without waiting on the copy
+    """
+    data, target = batch
+    return data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+
+
+class Trainer:
+    """
+    Trains a model epoch by epoch, checkpointing as it goes
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        optimizer: torch.optim.Optimizer,
+        loss_function: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        device: torch.device,
+        scheduler: Optional[Any] = None,
+        checkpoint_directory: Optional[str] = None,
+        state_path: Optional[str] = None,
+        prepare_batch: Callable[[Batch, torch.device], Batch] = to_device,
+        checkpoint_interval: float = CHECKPOINT_INTERVAL,
+        keep_checkpoints: int = KEEP_CHECKPOINTS,
+        bfloat16: bool = False,
+        channels_last: bool = False,
+        compile_model: bool = False,
+    ) -> None:
+        """
+        Args:
+            model: Model to train, already on the device
+            optimizer: Optimizer of the model's parameters
+            loss_function: Loss of a batch of outputs, given targets
+            device: Device to train on
+            scheduler: Learning rate scheduler, stepped at the end of each epoch
+            checkpoint_directory: Directory to write checkpoints and stats to, and to
+                resume from. No checkpoints if None
+            state_path: Path to save the model state dict to after each epoch, for
+                exporting or inference
+            prepare_batch: Moves a batch from the data loader to the device, converting
+                it as the model needs
+            checkpoint_interval: Seconds between checkpoints within an epoch
+            keep_checkpoints: Number of checkpoints kept
+            bfloat16: Run the forward pass under bfloat16 autocast, keeping weights and
+                gradients in float32. Fastest on CPUs with AVX512-BF16 or AMX
+            channels_last: Keep convolution weights and inputs channels last (NHWC),
+                the layout oneDNN's CPU convolutions run fastest in
+            compile_model: Compile the model with torch.compile. The first batches are
+                slow while it compiles
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_function = loss_function
+        self.device = device
+        self.scheduler = scheduler
+        self.checkpoint_directory = checkpoint_directory
+        self.state_path = state_path
+        self.prepare_batch = prepare_batch
+        self.checkpoint_interval = checkpoint_interval
+        self.keep_checkpoints = keep_checkpoints
+        self.bfloat16 = bfloat16
+        self.channels_last = channels_last
+
+        if channels_last:
+            model.to(memory_format=torch.channels_last)
+
+        # Checkpoints hold the state of the model itself, not the compiled wrapper
+        self.forward: Callable[[torch.Tensor], torch.Tensor] = (
+            torch.compile(model) if compile_model else model
+        )
+
+        # Position reached: epochs finished, and batches of the current epoch trained on
+        self.epoch = 0
+        self.batch = 0
+        self.history: List[Dict[str, Any]] = []
+
+    def _synchronize(self) -> None:
+        """
+        Wait for queued device work, so it's timed as compute rather than data wait
+        """
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def loss(self, data: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        """
+        Run the model on a batch, in the configured precision and memory format
+
+        Args:
+            data: Batch of inputs, on the device
+            target: Batch of targets, on the device
+
+        Returns:
+            Loss of batch, in float32
+        """
+        if self.channels_last and data.dim() == 4:
+            data = data.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(
+            device_type=self.device.type, dtype=torch.bfloat16, enabled=self.bfloat16
+        ):
+            output = self.forward(data)
+
+        # Outside autocast, as some losses (binary cross entropy) refuse reduced
+        # precision
+        return self.loss_function(output.float(), target)
+
+    def step(self, data: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        """
+        Train on one batch
+
+        Args:
+            data: Batch of inputs, on the device
+            target: Batch of targets, on the device
+
+        Returns:
+            Loss of batch, before the update
+        """
+        self.optimizer.zero_grad()
+        loss = self.loss(data, target)
+        loss.backward()
+        self.optimizer.step()
+        return loss.detach()
+
+    def train_epoch(self, loader: DataLoader) -> Dict[str, Any]:
+        """
+        Train for one epoch, or the rest of one if resumed part way through
+
+        Args:
+            loader: Data loader to train from
+
+        Returns:
+            Epoch stats: mean loss, samples per second, seconds waiting on data and
+            computing, and peak resident memory (bytes)
+        """
+        sampler = loader.sampler
+        skip = self.batch
+        if isinstance(sampler, ResumableSampler):
+            sampler.set_epoch(self.epoch, start=self.batch * (loader.batch_size or 1))
+            skip = 0
+
+        self.model.train()
+        total_loss = 0.0
+        num_batches = num_samples = 0
+        data_wait = compute = 0.0
+        peak_memory = resident_memory()
+        last_checkpoint = perf_counter()
+
+        batches = iter(loader)
+        while True:
+            start = perf_counter()
+            batch = next(batches, None)
+            if batch is not None and skip:
+                # Data loader can't start part way through, so load and drop batches
+                skip -= 1
+                continue
+            data_wait += perf_counter() - start
+            if batch is None:
+                break
+
+            start = perf_counter()
+            data, target = self.prepare_batch(batch, self.device)
+            total_loss += self.step(data, target).item()
+            self._synchronize()
+            compute += perf_counter() - start
+
+            num_batches += 1
+            num_samples += len(data)
+            self.batch += 1
+            peak_memory = max(peak_memory, resident_memory())
+            if perf_counter() - last_checkpoint > self.checkpoint_interval:
+                self.save_checkpoint()
+                last_checkpoint = perf_counter()
+
+        return {
+            "epoch": self.epoch + 1,
+            "loss": total_loss / max(num_batches, 1),
+            "samples": num_samples,
+            "samples_per_second": num_samples / max(data_wait + compute, 1e-9),
+            "data_wait": data_wait,
+            "compute": compute,
+            "peak_memory": peak_memory,
+        }
+
+    def evaluate(self, loader: DataLoader) -> float:
+        """
+        Mean loss over a dataset
+
+        Args:
+            loader: Data loader to evaluate on
+
+        Returns:
+            Mean loss per batch
+        """
+        self.model.eval()
+        total_loss = 0.0
+        num_batches = 0
+        with torch.inference_mode():
+            for batch in loader:
+                data, target = self.prepare_batch(batch, self.device)
+                total_loss += self.loss(data, target).item()
+                num_batches += 1
+        return total_loss / max(num_batches, 1)
+
+    def fit(
+        self,
+        train_loader: DataLoader,
+        num_epochs: int,
+        test_loader: Optional[DataLoader] = None,
+        resume: bool = True,
+    ) -> List[Dict[str, Any]]:
+        """
+        Train until the given number of epochs have been run, printing stats of each
+
+        Args:
+            train_loader: Data loader to train from
+            num_epochs: Total number of epochs, including any run before resuming
+            test_loader: Data loader to evaluate on after each epoch, if any
+            resume: Carry on from the latest checkpoint, if there is one
+
+        Returns:
+            Stats of every epoch, see `train_epoch`, with test loss if evaluated
+        """
+        if resume and self.checkpoint_directory is not None:
+            checkpoint_path = self.latest_checkpoint()
+            if checkpoint_path is not None:
+                self.load_checkpoint(checkpoint_path)
+                print(
+                    f"Resumed from {checkpoint_path}, epoch {self.epoch + 1} "
+                    f"batch {self.batch}"
+                )
+
+        while self.epoch < num_epochs:
+            stats = self.train_epoch(train_loader)
+            if test_loader is not None:
+                stats["test_loss"] = self.evaluate(test_loader)
+            if self.scheduler is not None:
+                self.scheduler.step()
+            self.epoch += 1
+            self.batch = 0
+            self.history.append(stats)
+            print(format_stats(stats))
+
+            self.save_checkpoint()
+            if self.state_path is not None:
+                atomic_save(self.model.state_dict(), self.state_path)
+            if self.checkpoint_directory is not None:
+                with open(
+                    os.path.join(self.checkpoint_directory, STATS_FILENAME),
+                    mode="a",
+                    encoding="utf-8",
+                ) as stats_file:
+                    stats_file.write(json.dumps(stats) + "\n")
+        return self.history
+
+    def save_checkpoint(self) -> None:
+        """
+        Save everything needed to resume, then delete all but the latest checkpoints
+        """
+        if self.checkpoint_directory is None:
+            return
+        os.makedirs(self.checkpoint_directory, exist_ok=True)
+        atomic_save(
+            {
+                "epoch": self.epoch,
+                "batch": self.batch,
+                "model": self.model.state_dict(),
+                "optimizer": self.optimizer.state_dict(),
+                "scheduler": (
+                    None if self.scheduler is None else self.scheduler.state_dict()
+                ),
+                "history": self.history,
+                "rng": torch.get_rng_state(),
+            },
+            os.path.join(
+                self.checkpoint_directory,
+                f"checkpoint-{self.epoch:04d}-{self.batch:08d}.pt",
+            ),
+        )
+        for old_path in self.checkpoints()[: -self.keep_checkpoints]:
+            os.remove(old_path)
+
+    def checkpoints(self) -> List[str]:
+        """
+        Paths of checkpoints, oldest first
+        """
+        if self.checkpoint_directory is None:
+            return []
+        return sorted(
+            glob.glob(os.path.join(self.checkpoint_directory, CHECKPOINT_PATTERN))
+        )
+
+    def latest_checkpoint(self) -> Optional[str]:
+        """
+        Path of latest checkpoint, None if there are none
+        """
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def load_checkpoint(self, path: str) -> None:
+        """
+        Restore the model, optimizer, scheduler and position from a checkpoint
+
+        Args:
+            path: Path to checkpoint
+        """
+        checkpoint = torch.load(path, map_location=self.device, weights_only=False)
+        self.model.load_state_dict(checkpoint["model"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        if self.scheduler is not None and checkpoint["scheduler"] is not None:
+            self.scheduler.load_state_dict(checkpoint["scheduler"])
+        self.epoch = checkpoint["epoch"]
+        self.batch = checkpoint["batch"]
+        self.history = checkpoint["history"]
+        torch.set_rng_state(checkpoint["rng"].cpu())
+
+
+def atomic_save(obj: Any, path: str) -> None:
+    """
+    Save with torch.save, such that the file at the path is always either the previous
+    one or the complete new one
+
+    Args:
+        obj: Object to save
+        path: Path to save to
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, staging = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as staging_file:
+            torch.save(obj, staging_file)
+            staging_file.flush()
+            os.fsync(staging_file.fileno())
+        os.replace(staging, path)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+
+
+def format_stats(stats: Dict[str, Any]) -> str:
+    """
+    One line summary of an epoch's stats
+
+    Args:
+        stats: Epoch stats, see `Trainer.train_epoch`
+
+    Returns:
+        Summary
+    """
+    elapsed = stats["data_wait"] + stats["compute"]
+    summary = (
+        f"Epoch {stats['epoch']}: loss {stats['loss']:.6f}, "
+        f"{stats['samples_per_second']:.1f} samples/s, "
+        f"data wait {stats['data_wait']:.2f} s "
+        f"({100 * stats['data_wait'] / max(elapsed, 1e-9):.0f}%), "
+        f"compute {stats['compute']:.2f} s, "
+        f"peak RSS {stats['peak_memory'] / 2**20:.0f} MiB"
+    )
+    if "test_loss" in stats:
+        summary += f", test loss {stats['test_loss']:.6f}"
+    return summary
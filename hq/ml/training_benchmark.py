@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+
+"""
+Benchmark training throughput of the hq.ml models in each precision and memory format
+
+Models are trained on random batches through `Trainer.step`, exactly as in training, so
+nothing is read from disk. Reports images per second of each configuration, relative to
+plain float32
+"""
+
+
+import sys
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from hq.cli import run_typer_app
+from hq.ml.flair_regression.train_regression import DialRegressionNet, RegressionNet
+from hq.ml.training import Trainer
+from hq.ml.wwd.wwd import TILE_SIZE, SegmentationNet
+
+
+# Model constructor, input shape, and loss, by name
+MODELS: Dict[str, Tuple[Callable[[], torch.nn.Module], Tuple[int, ...], Callable]] = {
+    "dial_regression": (DialRegressionNet, (1, 92, 192), F.l1_loss),
+    "regression": (RegressionNet, (3, 640, 480), F.l1_loss),
+    "segmentation": (
+        SegmentationNet,
+        (3, TILE_SIZE, TILE_SIZE),
+        F.binary_cross_entropy,
+    ),
+}
+
+# Configurations benchmarked, as Trainer keyword arguments by name
+CONFIGURATIONS: Dict[str, Dict[str, bool]] = {
+    "float32": {},
+    "channels_last": {"channels_last": True},
+    "bfloat16": {"bfloat16": True},
+    "bfloat16_channels_last": {"bfloat16": True, "channels_last": True},
+}
+
+# Steps run before timing, longer when compiling
+WARMUP_STEPS = 3
+COMPILE_WARMUP_STEPS = 10
+
+
+def random_batch(
+    model_name: str, batch_size: int, seed: int = 0
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Random inputs and targets of the shapes a model trains on
+
+    Args:
+        model_name: Name of model, from `MODELS`
+        batch_size: Examples in batch
+        seed: Random seed
+
+    Returns:
+        Inputs, and targets in [0, 1]
+    """
+    _, input_shape, _ = MODELS[model_name]
+    generator = torch.Generator().manual_seed(seed)
+    data = torch.rand((batch_size,) + input_shape, generator=generator)
+    target_shape = (
+        (batch_size, 1) + input_shape[1:]
+        if model_name == "segmentation"
+        else (batch_size,)
+    )
+    return data, torch.rand(target_shape, generator=generator)
+
+
+def images_per_second(
+    model_name: str,
+    batch_size: int,
+    num_steps: int,
+    compile_model: bool = False,
+    **configuration: bool,
+) -> float:
+    """
+    Time training steps of a freshly initialised model
+
+    Args:
+        model_name: Name of model, from `MODELS`
+        batch_size: Examples per batch
+        num_steps: Steps timed, after warming up
+        compile_model: Compile the model with torch.compile
+        configuration: Further `Trainer` precision and memory format arguments
+
+    Returns:
+        Images trained on per second
+    """
+    model_class, _, loss_function = MODELS[model_name]
+    torch.manual_seed(0)
+    model = model_class()
+    trainer = Trainer(
+        model=model,
+        optimizer=torch.optim.Adam(model.parameters(), lr=1e-6),
+        loss_function=loss_function,
+        device=torch.device("cpu"),
+        compile_model=compile_model,
+        **configuration,
+    )
+    model.train()
+    data, target = random_batch(model_name=model_name, batch_size=batch_size)
+    for _ in range(COMPILE_WARMUP_STEPS if compile_model else WARMUP_STEPS):
+        trainer.step(data, target)
+    start = perf_counter()
+    for _ in range(num_steps):
+        trainer.step(data, target)
+    return batch_size * num_steps / (perf_counter() - start)
+
+
+def run_benchmark(
+    model_names: Optional[List[str]] = None,
+    batch_size: int = 32,
+    num_steps: int = 10,
+    compile_model: bool = False,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Benchmark training throughput of each model in each configuration
+
+    Args:
+        model_names: Names of models, from `MODELS`, all if None
+        batch_size: Examples per batch
+        num_steps: Steps timed per configuration
+        compile_model: Also benchmark each configuration compiled with torch.compile
+
+    Returns:
+        Images per second of each configuration, by model
+    """
+    results: Dict[str, Dict[str, float]] = {}
+    for model_name in model_names or MODELS:
+        if model_name not in MODELS:
+            raise ValueError(
+                f"Unknown model {model_name}, choose from {', '.join(MODELS)}"
+            )
+        results[model_name] = {}
+        for compiled in (False, True) if compile_model else (False,):
+            for name, configuration in CONFIGURATIONS.items():
+                results[model_name][name + ("_compiled" if compiled else "")] = (
+                    images_per_second(
+                        model_name=model_name,
+                        batch_size=batch_size,
+                        num_steps=num_steps,
+                        compile_model=compiled,
+                        **configuration,
+                    )
+                )
+    return results
+
+
+def benchmark_training(
+    model_names: Optional[List[str]] = None,
+    batch_size: int = 32,
+    num_steps: int = 10,
+    compile_model: bool = False,
+    num_threads: Optional[int] = None,
+) -> None:
+    """
+    Benchmark training throughput of the hq.ml models on CPU, in float32 and bfloat16,
+    with default and channels last memory formats
+
+    Args:
+        model_names: Names of models to benchmark, all if not given
+        batch_size: Examples per batch
+        num_steps: Steps timed per configuration
+        compile_model: Also benchmark each configuration compiled with torch.compile
+        num_threads: Threads torch may use, its default if not given
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    results = run_benchmark(
+        model_names=model_names,
+        batch_size=batch_size,
+        num_steps=num_steps,
+        compile_model=compile_model,
+    )
+    print(f"{'model':<16} {'configuration':<32} {'images/s':>9} {'speedup':>8}")
+    for model_name, model_results in results.items():
+        baseline = model_results["float32"]
+        for name, rate in model_results.items():
+            print(f"{model_name:<16} {name:<32} {rate:9.1f} {rate / baseline:7.2f}x")
+    print(
+        f"torch {torch.__version__}, {torch.get_num_threads()} threads, "
+        f"CPU capability {torch.backends.cpu.get_cpu_capability()}",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    run_typer_app(benchmark_training)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+
+"""
+Segment walls in whole plan images with a trained wwd network
+
+Plans are read through the memory-mapped image cache and cut into overlapping tiles,
+which are batched through the network. Overlapping predictions are blended with weights
+falling towards the edge of each tile, where the network sees least context. Rows are
+written to the output mask as soon as no later tile touches them, so memory use depends
+on the width of the plan and not its height
+"""
+
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+from typing import Deque, List, Optional
+
+import numpy as np
+import PIL.Image
+import torch
+
+from hq.cli import run_typer_app
+from hq.ml.wwd.wwd import (
+    PLAN_CACHE_DIRECTORY,
+    TILE_SIZE,
+    WWD_STATE_PATH,
+    SegmentationNet,
+    image_cache,
+    tile_origins,
+)
+
+# Pixels neighbouring tiles share, blended between them
+SEGMENT_OVERLAP = TILE_SIZE // 4
+
+SEGMENT_BATCH_SIZE = 256
+
+# Batches cut from the plan ahead of the one the network is running on
+SEGMENT_PREFETCH_BATCHES = 4
+
+
+def tile_weights(tile_size: int) -> np.ndarray:
+    """
+    Blending weight of each pixel of a tile, highest in the centre and falling linearly
+    towards, but never reaching, zero at the edges
+
+    Args:
+        tile_size: Width and height of tiles (pixels)
+
+    Returns:
+        Weights as (T, T) float32 array
+    """
+    ramp = np.minimum(np.arange(tile_size), np.arange(tile_size)[::-1]) + 1
+    return np.outer(ramp, ramp).astype(np.float32)
+
+
+def cut_tiles(
+    rgb: np.ndarray, row: int, cols: List[int], tile_size: int
+) -> torch.Tensor:
+    """
+    Cut a batch of tiles from a plan, along one row
+
+    Args:
+        rgb: Plan as (H, W, 3) uint8 array
+        row: Top of tiles (pixels)
+        cols: Left of each tile (pixels)
+        tile_size: Width and height of tiles (pixels)
+
+    Returns:
+        Tiles as (N, 3, T, T) float32 tensor, scaled to [0, 1]
+    """
+    band = rgb[row : row + tile_size]
+    tiles = np.stack([band[:, col : col + tile_size] for col in cols])
+    return torch.from_numpy(tiles).permute(0, 3, 1, 2).float().div_(255)
+
+
+def segment_plan(
+    model: torch.nn.Module,
+    rgb: np.ndarray,
+    output: np.ndarray,
+    tile_size: int = TILE_SIZE,
+    overlap: int = SEGMENT_OVERLAP,
+    batch_size: int = SEGMENT_BATCH_SIZE,
+    device: Optional[torch.device] = None,
+) -> None:
+    """
+    Segment a plan, tile by tile, writing wall probabilities a band of rows at a time
+
+    Tiles are cut from the plan on a worker thread, a few batches ahead of the one the
+    network is running on
+
+    Args:
+        model: Segmentation network, in eval mode
+        rgb: Plan as (H, W, 3) uint8 array, usually memory-mapped
+        output: (H, W) uint8 array to write probability of wall (out of 255) to,
+            usually memory-mapped
+        tile_size: Width and height of tiles the network was trained on (pixels)
+        overlap: Pixels neighbouring tiles share
+        batch_size: Maximum tiles run through the network at once
+        device: Device to run the network on, CPU if None
+    """
+    height, width = rgb.shape[:2]
+    if output.shape != (height, width):
+        raise ValueError(f"Output is {output.shape}, unlike plan {(height, width)}")
+    rows = tile_origins(height, tile_size, tile_size - overlap)
+    cols = tile_origins(width, tile_size, tile_size - overlap)
+    if not rows or not cols:
+        raise ValueError(f"Plan {(height, width)} is smaller than a {tile_size} tile")
+    device = device or torch.device("cpu")
+    weights = torch.from_numpy(tile_weights(tile_size)).to(device)
+
+    # Weighted sum of predictions, and sum of weights, of the rows tiles still touch,
+    # starting at the top of the latest row of tiles
+    predictions = torch.zeros((tile_size, width), device=device)
+    total_weights = torch.zeros((tile_size, width), device=device)
+
+    def run_batch(row: int, batch_cols: List[int], tiles: Future) -> None:
+        probabilities = model(tiles.result().to(device, non_blocking=True))[:, 0]
+        for col, probability in zip(batch_cols, probabilities):
+            predictions[:, col : col + tile_size] += probability * weights
+            total_weights[:, col : col + tile_size] += weights
+        if batch_cols[-1] != cols[-1]:
+            return
+
+        # Rows above the next row of tiles are final
+        row_index = rows.index(row)
+        next_row = rows[row_index + 1] if row_index + 1 < len(rows) else height
+        done = next_row - row
+        output[row:next_row] = (
+            (predictions[:done] / total_weights[:done] * 255)
+            .round_()
+            .to(torch.uint8)
+            .cpu()
+            .numpy()
+        )
+        predictions[:-done] = predictions[done:].clone()
+        total_weights[:-done] = total_weights[done:].clone()
+        predictions[-done:] = 0
+        total_weights[-done:] = 0
+
+    batches = [
+        (row, cols[start : start + batch_size])
+        for row in rows
+        for start in range(0, len(cols), batch_size)
+    ]
+    pending: Deque = deque()
+    with ThreadPoolExecutor(max_workers=1) as executor, torch.inference_mode():
+        for row, batch_cols in batches:
+            pending.append(
+                (
+                    row,
+                    batch_cols,
+                    executor.submit(cut_tiles, rgb, row, batch_cols, tile_size),
+                )
+            )
+            if len(pending) <= SEGMENT_PREFETCH_BATCHES:
+                continue
+            run_batch(*pending.popleft())
+        while pending:
+            run_batch(*pending.popleft())
+
+
+def segment(
+    plan_path: Path,
+    output_path: Path,
+    model_path: Path = Path(WWD_STATE_PATH),
+    overlap: int = SEGMENT_OVERLAP,
+    batch_size: int = SEGMENT_BATCH_SIZE,
+    num_threads: Optional[int] = None,
+    cache_directory: Path = Path(PLAN_CACHE_DIRECTORY),
+) -> None:
+    """
+    Segment walls in a plan image
+
+    Args:
+        plan_path: Path to plan image
+        output_path: Path to save probability of wall (out of 255) to. A .npy path is
+            written as the plan is segmented, any other is saved as an image at the end,
+            which holds the whole mask in memory
+        model_path: Trained model state dict, as saved by wwd.py
+        overlap: Pixels neighbouring tiles share, blended between them
+        batch_size: Maximum tiles run through the network at once
+        num_threads: Threads torch may use, its default if None
+        cache_directory: Directory to cache decoded plans under
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    model = SegmentationNet()
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.to(device).eval()
+
+    rgb = np.load(
+        image_cache(path=str(plan_path), cache_directory=str(cache_directory)),
+        mmap_mode="r",
+    )
+    to_image = output_path.suffix != ".npy"
+    mask_path = output_path.with_suffix(".npy.tmp") if to_image else output_path
+    mask = np.lib.format.open_memmap(
+        mask_path, mode="w+", dtype=np.uint8, shape=rgb.shape[:2]
+    )
+    start = perf_counter()
+    try:
+        segment_plan(
+            model=model,
+            rgb=rgb,
+            output=mask,
+            overlap=overlap,
+            batch_size=batch_size,
+            device=device,
+        )
+        mask.flush()
+        if to_image:
+            PIL.Image.fromarray(np.asarray(mask)).save(output_path)
+    finally:
+        del mask
+        if to_image and os.path.exists(mask_path):
+            os.remove(mask_path)
+    print(
+        f"Segmented {rgb.shape[1]}x{rgb.shape[0]} plan in "
+        f"{perf_counter() - start:.1f} s, saved to {output_path}"
+    )
+
+
+if __name__ == "__main__":
+    run_typer_app(segment)
@@ -5,7 +5,10 @@
 Segmentation network for auto-generating waals for wwd
 """
 
-import sys
+import hashlib
+import os
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import PIL.Image
@@ -15,7 +18,27 @@ import torch.nn.functional as F
 from torch import optim
 from torch.optim.lr_scheduler import StepLR
 from torch.utils.data import DataLoader
-from torchvision import datasets, transforms
+
+from hq.cli import run_typer_app
+from hq.ml.training import Batch, ResumableSampler, Trainer
+
+
+# Width and height of the tiles the network sees (pixels)
+TILE_SIZE = 64
+
+# Where decoded plans and labels are cached, one .npy file per image
+PLAN_CACHE_DIRECTORY = os.path.expanduser("~/.cache/hq/wwd")
+
+# Bump when decoding changes, so old caches are ignored
+PLAN_CACHE_VERSION = 1
+
+# Rows of an image copied into its cache at a time
+PLAN_CACHE_STRIP_HEIGHT = 1024
+
+WWD_STATE_PATH = "wwd.pt"
+
+# Where training checkpoints are kept, to resume from
+WWD_CHECKPOINT_DIRECTORY = "wwd_checkpoints"
 
 
 class SegmentationNet(torch.nn.Module):
@@ -36,7 +59,7 @@ class SegmentationNet(torch.nn.Module):
             out_channels=self.conv_depth,
             kernel_size=5,
             stride=2,
-            padding="same",
+            padding=2,
         )
         self.dropout1 = nn.Dropout(0.2)
 
@@ -46,7 +69,7 @@ class SegmentationNet(torch.nn.Module):
             out_channels=self.conv_depth,
             kernel_size=5,
             stride=2,
-            padding="same",
+            padding=2,
         )
         self.dropout2 = nn.Dropout(0.2)
 
@@ -56,7 +79,7 @@ class SegmentationNet(torch.nn.Module):
             out_channels=self.conv_depth,
             kernel_size=5,
             stride=2,
-            padding="same",
+            padding=2,
         )
         self.dropout3 = nn.Dropout(0.2)
 
@@ -66,7 +89,7 @@ class SegmentationNet(torch.nn.Module):
             out_channels=self.conv_depth,
             kernel_size=5,
             stride=2,
-            padding="same",
+            padding=2,
         )
         self.dropout4 = nn.Dropout(0.2)
 
@@ -76,7 +99,8 @@ class SegmentationNet(torch.nn.Module):
             out_channels=self.conv_depth,
             kernel_size=5,
             stride=2,
-            padding="same",
+            padding=2,
+            output_padding=1,
         )
         self.dropout5 = nn.Dropout(0.2)
 
@@ -86,7 +110,8 @@ class SegmentationNet(torch.nn.Module):
             out_channels=self.conv_depth,
             kernel_size=5,
             stride=2,
-            padding="same",
+            padding=2,
+            output_padding=1,
         )
         self.dropout6 = nn.Dropout(0.2)
 
@@ -96,7 +121,8 @@ class SegmentationNet(torch.nn.Module):
             out_channels=self.conv_depth,
             kernel_size=5,
             stride=2,
-            padding="same",
+            padding=2,
+            output_padding=1,
         )
         self.dropout7 = nn.Dropout(0.2)
 
@@ -106,7 +132,8 @@ class SegmentationNet(torch.nn.Module):
             out_channels=1,
             kernel_size=5,
             stride=2,
-            padding="same",
+            padding=2,
+            output_padding=1,
         )
         self.dropout8 = nn.Dropout(0.2)
 
@@ -146,149 +173,232 @@ class SegmentationNet(torch.nn.Module):
 
         x = self.deconv4(x)
         x = self.dropout8(x)
-        x = F.relu(x)
+        x = torch.sigmoid(x)
 
         return x
 
 
-class WWDDataset(torch.utils.data.IterableDataset):
+def image_cache(
+    path: str, labels: bool = False, cache_directory: str = PLAN_CACHE_DIRECTORY
+) -> str:
+    """
+    Decode an image into a uint8 .npy array that can be memory-mapped, once
+
+    Arrays are keyed by the path, size and modification time of the image, so editing it
+    decodes it again. The image is decoded whole once, then converted and copied to its
+    array a strip of rows at a time
+
+    Args:
+        path: Path to image
+        labels: Whether the image is a labels mask, walls opaque, binarised to (H, W) of
+            0 or 1. Otherwise it is kept as (H, W, 3) RGB
+        cache_directory: Directory to cache decoded images under
+
+    Returns:
+        Path to .npy array
     """
-    Load train/test data
+    stat = os.stat(path)
+    key = hashlib.sha256(
+        repr(
+            (
+                PLAN_CACHE_VERSION,
+                labels,
+                os.path.abspath(path),
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+        ).encode()
+    )
+    array_path = os.path.join(cache_directory, f"{key.hexdigest()}.npy")
+    if os.path.isfile(array_path):
+        return array_path
+
+    # Deck plans are far larger than PIL's decompression bomb limit
+    PIL.Image.MAX_IMAGE_PIXELS = None
+
+    os.makedirs(cache_directory, exist_ok=True)
+    staging_fd, staging = tempfile.mkstemp(dir=cache_directory, suffix=".npy")
+    os.close(staging_fd)
+    try:
+        with PIL.Image.open(path) as img:
+            width, height = img.size
+            array = np.lib.format.open_memmap(
+                staging,
+                mode="w+",
+                dtype=np.uint8,
+                shape=(height, width) if labels else (height, width, 3),
+            )
+            for row in range(0, height, PLAN_CACHE_STRIP_HEIGHT):
+                # Convert each strip as it's cropped, so the decoded image is never
+                # copied whole
+                strip = img.crop(
+                    (0, row, width, min(row + PLAN_CACHE_STRIP_HEIGHT, height))
+                )
+                strip = np.asarray(
+                    strip.getchannel("A") if labels else strip.convert("RGB")
+                )
+                # Binarise labels
+                array[row : row + len(strip)] = strip > 128 if labels else strip
+        array.flush()
+        del array
+        os.replace(staging, array_path)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+    return array_path
+
+
+def tile_origins(length: int, tile_size: int, stride: int) -> List[int]:
+    """
+    Origins of tiles along one side of a plan, the last tile moved back to end at the
+    edge so every pixel is covered
+
+    Args:
+        length: Length of side (pixels)
+        tile_size: Length of tiles (pixels)
+        stride: Distance between tile origins (pixels)
+
+    Returns:
+        Origin of each tile, none if the plan is smaller than a tile
+    """
+    if length < tile_size:
+        return []
+    origins = list(range(0, length - tile_size + 1, stride))
+    if origins[-1] != length - tile_size:
+        origins.append(length - tile_size)
+    return origins
+
+
+class WWDDataset(torch.utils.data.Dataset):
     """
+    Square tiles of a plan and its labels, read from memory-mapped arrays
 
-    def __init__(self, rgb_path: str, labels_path: str) -> None:
+    Only the origin of each tile is held in memory, and tiles are returned as uint8
+    tensors sharing memory with the arrays, such that plans of any size train in bounded
+    memory. Batches are converted to float once on the device, see `to_device`
+    """
+
+    def __init__(
+        self,
+        rgb_path: str,
+        labels_path: str,
+        tile_size: int = TILE_SIZE,
+        stride: Optional[int] = None,
+        overlap: int = 0,
+        cache_directory: str = PLAN_CACHE_DIRECTORY,
+    ) -> None:
         """
-        Construct the datatset object
+        Construct the datatset object, decoding the plan into the cache if need be
 
         Args:
             rgb_path: Path to input rgb image
             labels_path: Path to ground truth labels mask
+            tile_size: Width and height of tiles (pixels)
+            stride: Distance between the origins of neighbouring tiles (pixels).
+                Defaults to the tile size less the overlap
+            overlap: Pixels neighbouring tiles share, if stride isn't given
+            cache_directory: Directory to cache decoded plans under
         """
         # Run parent class constructor
         super().__init__()
-        self.tile_size = 64
-
-        # Load data from file
-        self.rgb = np.array(PIL.Image.open(rgb_path)).transpose(2, 1, 0)
-        self.labels = np.array(PIL.Image.open(labels_path))
-
-        # Normalise and reshape RGB
-        self.rgb = self.rgb.astype(np.float32) / 255
+        if stride is None:
+            stride = tile_size - overlap
+        if not 0 < stride <= tile_size:
+            raise ValueError(f"Tile stride must be in (0, {tile_size}], not {stride}")
+        self.tile_size = tile_size
+        self.stride = stride
+        self.rgb_path = image_cache(path=rgb_path, cache_directory=cache_directory)
+        self.labels_path = image_cache(
+            path=labels_path, labels=True, cache_directory=cache_directory
+        )
+        self._rgb: Optional[np.ndarray] = None
+        self._labels: Optional[np.ndarray] = None
+
+        height, width = self.rgb.shape[:2]
+        if self.labels.shape != (height, width):
+            raise ValueError(
+                f"Labels {labels_path} are {self.labels.shape}, "
+                f"unlike {rgb_path} {(height, width)}"
+            )
+        self.tiles = np.array(
+            [
+                (row, col)
+                for row in tile_origins(height, tile_size, stride)
+                for col in tile_origins(width, tile_size, stride)
+            ],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+
+    @property
+    def rgb(self) -> np.ndarray:
+        """
+        Plan as (H, W, 3) uint8 array, memory-mapped on first use in each process
+        """
+        if self._rgb is None:
+            self._rgb = np.load(self.rgb_path, mmap_mode="c")
+        return self._rgb
 
-        # Binarise labels
-        self.labels = self.labels[..., 3]
-        self.labels = (self.labels > 128).astype(np.int64)
+    @property
+    def labels(self) -> np.ndarray:
+        """
+        Labels as (H, W) uint8 array, memory-mapped on first use in each process
+        """
+        if self._labels is None:
+            self._labels = np.load(self.labels_path, mmap_mode="c")
+        return self._labels
 
-        self.num_rows = self.rgb.shape[2]
-        self.num_cols = self.rgb.shape[1]
-        breakpoint()
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        Pickle without the mapped arrays, so workers map them rather than copy them
+        """
+        return {**self.__dict__, "_rgb": None, "_labels": None}
 
-    def __iter__(self):
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        Yield training examples
+        Tile of the plan and its labels, as (3, T, T) and (1, T, T) uint8 tensors that
+        share memory with the mapped arrays
         """
-        for row in range(0, self.num_rows - 2 * self.tile_size, self.tile_size):
-            for col in range(0, self.num_cols - 2 * self.tile_size, self.tile_size):
-                rgb_tile = self.rgb[
-                    :,
-                    col : col + self.tile_size,
-                    row : row + self.tile_size,
-                ]
-                labels_tile = self.labels[
-                    None,
-                    col : col + self.tile_size,
-                    row : row + self.tile_size,
-                ]
-                training_example = (torch.Tensor(rgb_tile), torch.Tensor(labels_tile))
-                yield training_example
+        row, col = self.tiles[index]
+        rows = slice(row, row + self.tile_size)
+        cols = slice(col, col + self.tile_size)
+        rgb_tile = torch.from_numpy(self.rgb[rows, cols]).permute(2, 0, 1)
+        labels_tile = torch.from_numpy(self.labels[None, rows, cols])
+        return rgb_tile, labels_tile
 
     def __len__(self) -> int:
         """
         Compute the size of the dataset
         """
-        return int(self.num_rows / self.tile_size * self.num_cols / self.tile_size)
+        return len(self.tiles)
 
 
-def train(
-    model: SegmentationNet,
-    device: torch.device,
-    train_loader: DataLoader,
-    optimizer: optim.Optimizer,
-    epoch: int,
-) -> None:
+def to_device(batch: Batch, device: torch.device) -> Batch:
     """
-    Train the model
+    Move a batch of uint8 tiles to a device, and convert them to float there
 
     Args:
-        model: Model to train
-        device: Device to run training on
-        train_loader: Data loader to train from
-        optimizer: Model optimizer
-        epoch: Epoch number
+        batch: Batch of tiles and their labels, as returned by `WWDDataset`
+        device: Device to move the batch to
+
+    Returns:
+        Tiles scaled to [0, 1], and labels as 0.0 or 1.0
     """
-    model.train()
-    for batch_idx, (data, target) in enumerate(train_loader):
-        data, target = data.to(device), target.to(device)
-        optimizer.zero_grad()
-
-        # Predict on input data
-        output = model(data)
-
-        # Compute loss
-        loss = torch.nn.functional.binary_cross_entropy(output, target)
-
-        # Backpropagate loss through network and update weights
-        loss.backward()
-        optimizer.step()
-
-        print(
-            "Train Epoch: {epoch} [{progress}/{num_images} ({progress_percent:.0f}%)]\tLoss: {loss:.6f}".format(
-                epoch=epoch,
-                progress=batch_idx * len(data),
-                num_images=len(train_loader.dataset),
-                progress_percent=100.0 * batch_idx / len(train_loader),
-                loss=loss.item(),
-            )
-        )
+    data, target = batch
+    data = data.to(device, non_blocking=True).float() / 255
+    target = target.to(device, non_blocking=True).float()
+    return data, target
 
 
-def test(
-    model: SegmentationNet,
-    device: torch.device,
-    test_loader: DataLoader,
-) -> None:
+def main(
+    bfloat16: bool = False, channels_last: bool = False, compile_model: bool = False
+) -> int:
     """
-    Test the model on some unseen data
+    Train the segmentation model
 
     Args:
-        model: Model to train
-        device: Device to run training on
-        test_loader: Data loader to test from
-    """
-    model.eval()
-    test_loss = 0
-    correct = 0
-    with torch.no_grad():
-        for data, target in test_loader:
-            data, target = data.to(device), target.to(device)
-            output = model(data)
-            test_loss += F.l1_loss(output, target).item()  # sum up batch loss
-
-    test_loss /= len(test_loader.dataset)
-
-    print(
-        "\nTest set: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n".format(
-            test_loss,
-            correct,
-            len(test_loader.dataset),
-            100.0 * correct / len(test_loader.dataset),
-        )
-    )
-
-
-def main() -> int:
-    """
-    Main CLI routine
+        bfloat16: Train under bfloat16 autocast
+        channels_last: Train with channels last (NHWC) memory format
+        compile_model: Compile the model with torch.compile
 
     Returns:
         Exit status
@@ -302,12 +412,17 @@ def main() -> int:
     else:
         device = torch.device("cpu")
 
+    dataset = WWDDataset(
+        rgb_path="../data/wwd/combined_bg.jpg",
+        labels_path="../data/wwd/walls.png",
+    )
     train_loader = DataLoader(
-        WWDDataset(
-            rgb_path="../data/wwd/combined_bg.jpg",
-            labels_path="../data/wwd/walls.png",
-        ),
+        dataset,
         batch_size=16,
+        sampler=ResumableSampler(len(dataset)),
+        num_workers=os.cpu_count() or 0,
+        pin_memory=use_cuda,
+        persistent_workers=bool(os.cpu_count()),
     )
     torch.manual_seed(7777)
 
@@ -318,15 +433,23 @@ def main() -> int:
     optimizer = optim.Adam(model.parameters(), lr=1e-5)
     scheduler = StepLR(optimizer, step_size=1, gamma=0.7)
 
-    for epoch in range(1, num_epochs + 1):
-        scheduler.step()
-        train(model, device, train_loader, optimizer, epoch)
-        # test(model, device, test_loader)
-
-        torch.save(model.state_dict(), "wwd.pt")
+    trainer = Trainer(
+        model=model,
+        optimizer=optimizer,
+        loss_function=F.binary_cross_entropy,
+        device=device,
+        scheduler=scheduler,
+        checkpoint_directory=WWD_CHECKPOINT_DIRECTORY,
+        bfloat16=bfloat16,
+        channels_last=channels_last,
+        compile_model=compile_model,
+        state_path=WWD_STATE_PATH,
+        prepare_batch=to_device,
+    )
+    trainer.fit(train_loader, num_epochs=num_epochs)
 
     return 0
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    run_typer_app(main)